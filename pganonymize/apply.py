@@ -0,0 +1,115 @@
+"""Tuning of the stage that writes anonymized data back to a source table"""
+
+from __future__ import absolute_import
+
+import logging
+
+from psycopg2.sql import SQL, Identifier
+
+from pganonymize.constants import INDEX_JOIN_MAX_FRACTION
+
+
+def choose_join(connection, temp_table, source_table):
+    """
+    Choose how the temporary table is joined with the source table, based on their row estimates.
+
+    A temporary table with only a small fraction of the rows of the source table is joined row by row through the
+    primary key indexes, a larger one is hashed.
+
+    :param connection: A database connection instance.
+    :param str temp_table: Name of the (analyzed) temporary table.
+    :param str source_table: Name of the source table.
+    :return: ``index`` or ``hash``.
+    :rtype: str
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT (SELECT reltuples FROM pg_class WHERE oid = to_regclass(quote_ident(%s))), '
+        '(SELECT reltuples FROM pg_class WHERE oid = to_regclass(quote_ident(%s)))',
+        (temp_table, source_table)
+    )
+    temp_rows, source_rows = cursor.fetchone()
+    cursor.close()
+    # The estimate of a table that has never been analyzed is -1 (or 0 before PostgreSQL 14)
+    if not source_rows or source_rows <= 0:
+        source_rows = temp_rows
+    if source_rows and temp_rows > source_rows * INDEX_JOIN_MAX_FRACTION:
+        return 'hash'
+    return 'index'
+
+
+class ApplyStage(object):
+    """
+    Prepare a temporary table and the session to write the anonymized data back to a source table.
+
+    On enter, the given memory settings are raised, the temporary table is analyzed, so the planner knows its real
+    size, and the join strategy is chosen (see :func:`choose_join`). The ``index`` strategy creates an index on the
+    primary key of the temporary table, the ``hash`` strategy skips the index and disables nested loop and merge joins.
+    All changed settings are restored on exit.
+    """
+
+    def __init__(self, connection, temp_table, source_table, primary_key, join='auto', work_mem=None,
+                 maintenance_work_mem=None):
+        """
+        :param connection: A database connection instance.
+        :param str temp_table: Name of the temporary table with the anonymized data.
+        :param str source_table: Name of the source table.
+        :param str primary_key: The primary key of the table.
+        :param str join: The join strategy, ``index``, ``hash`` or ``auto`` to choose it from the row estimates.
+        :param str work_mem: The ``work_mem`` setting during the stage, e.g. ``256MB``.
+        :param str maintenance_work_mem: The ``maintenance_work_mem`` setting during the stage.
+        """
+        self.connection = connection
+        self.temp_table = temp_table
+        self.source_table = source_table
+        self.primary_key = primary_key
+        self.join = join
+        self.settings = {'work_mem': work_mem, 'maintenance_work_mem': maintenance_work_mem}
+        self._previous = {}
+
+    def __enter__(self):
+        self.set(self.settings)
+        cursor = self.connection.cursor()
+        sql = SQL('ANALYZE {temp_table}').format(temp_table=Identifier(self.temp_table))
+        cursor.execute(sql.as_string(self.connection))
+        cursor.close()
+        if self.join in (None, 'auto'):
+            self.join = choose_join(self.connection, self.temp_table, self.source_table)
+        logging.info('Join strategy for table {}: {}'.format(self.source_table, self.join))
+        if self.join == 'index':
+            cursor = self.connection.cursor()
+            sql = SQL('CREATE INDEX ON {temp_table} ({primary_key})').format(
+                temp_table=Identifier(self.temp_table), primary_key=Identifier(self.primary_key)
+            )
+            cursor.execute(sql.as_string(self.connection))
+            cursor.close()
+        else:
+            self.set({'enable_nestloop': 'off', 'enable_mergejoin': 'off'})
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # A failed transaction can't run any statement before it is rolled back
+        if exc_type is None:
+            self.restore()
+
+    def set(self, settings):
+        """
+        Change session settings until the stage is left, the settings survive the commits of batched updates.
+
+        :param dict settings: The new value of each setting, settings without a value are left unchanged.
+        """
+        cursor = self.connection.cursor()
+        for name, value in sorted(settings.items()):
+            if value is None:
+                continue
+            cursor.execute('SELECT current_setting(%s), set_config(%s, %s, false)', (name, name, str(value)))
+            self._previous.setdefault(name, cursor.fetchone()[0])
+        cursor.close()
+
+    def restore(self):
+        """Restore all settings that have been changed by :meth:`set`."""
+        cursor = self.connection.cursor()
+        for name, value in sorted(self._previous.items()):
+            cursor.execute('SELECT set_config(%s, %s, false)', (name, value))
+        cursor.close()
+        self._previous = {}
@@ -0,0 +1,106 @@
+"""Memoization of deterministic providers"""
+
+from __future__ import absolute_import
+
+from collections import OrderedDict
+
+
+def format_statistics(hits, misses, evictions):
+    """
+    Return a summary of the work of a cache.
+
+    :param int hits: Number of values that have been found in the cache.
+    :param int misses: Number of values that have been passed to the provider.
+    :param int evictions: Number of values that have been removed from the cache.
+    :rtype: str
+    """
+    lookups = hits + misses
+    return '{} hits, {} misses, {} evictions, hit rate {:.1%}'.format(
+        hits, misses, evictions, hits / lookups if lookups else 0.0
+    )
+
+
+class ValueCache(object):
+    """
+    A bounded least recently used cache of the anonymized values of a column, keyed by their original value.
+
+    Only providers that return the same value for the same original value (see
+    :attr:`pganonymize.providers.Provider.deterministic`) may be cached. Original values that can't be hashed, e.g.
+    nested JSON objects, are passed to the provider on every call.
+    """
+
+    def __init__(self, size):
+        """
+        :param int size: Maximum number of cached values.
+        """
+        self.size = size
+        self.values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __str__(self):
+        return format_statistics(self.hits, self.misses, self.evictions)
+
+    def alter_value(self, alter_value, value):
+        """
+        Return the cached anonymized version of a single value.
+
+        :param alter_value: The provider method that alters a single value.
+        :param value: The original value.
+        """
+        try:
+            new_value = self.values[value]
+        except KeyError:
+            pass
+        except TypeError:
+            return alter_value(value)
+        else:
+            self.hits += 1
+            self.values.move_to_end(value)
+            return new_value
+        self.misses += 1
+        new_value = self.values[value] = alter_value(value)
+        if len(self.values) > self.size:
+            self.values.popitem(last=False)
+            self.evictions += 1
+        return new_value
+
+    def alter_values(self, alter_values, values):
+        """
+        Return the cached anonymized versions of a batch of values.
+
+        All values that are not cached yet are passed to the provider in a single batch, each distinct value once.
+
+        :param alter_values: The provider method that alters a batch of values.
+        :param list values: The original values.
+        :rtype: list
+        """
+        cached = self.values
+        new_values = [None] * len(values)
+        missing = OrderedDict()
+        uncacheable = []
+        for index, value in enumerate(values):
+            try:
+                new_values[index] = cached[value]
+            except KeyError:
+                missing.setdefault(value, []).append(index)
+            except TypeError:
+                uncacheable.append(index)
+            else:
+                cached.move_to_end(value)
+        self.hits += len(values) - len(uncacheable) - len(missing)
+        if missing:
+            self.misses += len(missing)
+            for value, new_value in zip(missing, alter_values(list(missing))):
+                for index in missing[value]:
+                    new_values[index] = new_value
+                cached[value] = new_value
+            overflow = len(cached) - self.size
+            for _ in range(max(overflow, 0)):
+                cached.popitem(last=False)
+            self.evictions += max(overflow, 0)
+        if uncacheable:
+            for index, new_value in zip(uncacheable, alter_values([values[index] for index in uncacheable])):
+                new_values[index] = new_value
+        return new_values
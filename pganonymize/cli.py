@@ -5,8 +5,12 @@ from __future__ import absolute_import, print_function
 import argparse
 import logging
 import time
+from functools import partial
 
-from pganonymize.constants import DATABASE_ARGS, DEFAULT_SCHEMA_FILE
+from psycopg2.extensions import ISOLATION_LEVEL_REPEATABLE_READ
+
+from pganonymize.constants import (COUNT_STRATEGIES, DATABASE_ARGS, DEFAULT_COUNT_STRATEGY, DEFAULT_LOCK_TIMEOUT,
+                                   DEFAULT_OVERWRITE_STRATEGY, DEFAULT_SCHEMA_FILE, OVERWRITE_STRATEGIES)
 from pganonymize.exceptions import BadSchemaFormat
 from pganonymize.providers import provider_registry
 from pganonymize.utils import (
@@ -35,6 +39,45 @@ def get_pg_args(args):
     }
 
 
+def init_connection(connection, schema_name, init_sql=None, snapshot=None):
+    """
+    Prepare a database connection for the anonymization of a schema.
+
+    :param connection: A database connection instance.
+    :param str schema_name: The schema to switch the search path to.
+    :param str init_sql: SQL to run after switching the search path.
+    :param str snapshot: An exported snapshot the transaction of the connection should use.
+    """
+    cursor = connection.cursor()
+    if snapshot:
+        connection.set_session(isolation_level=ISOLATION_LEVEL_REPEATABLE_READ)
+        cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+
+    logging.info("Switching to search_path - {}".format(schema_name))
+    cursor.execute(f"SET search_path TO {schema_name};")
+
+    if init_sql:
+        logging.info("Executing initialisation sql {}".format(init_sql))
+        cursor.execute(init_sql)
+
+    cursor.close()
+
+
+def connect(pg_args, schema_name, init_sql=None, snapshot=None):
+    """
+    Return a new database connection, prepared for the anonymization of a schema.
+
+    :param dict pg_args: A dictionary with database arguments.
+    :param str schema_name: The schema to switch the search path to.
+    :param str init_sql: SQL to run after switching the search path.
+    :param str snapshot: An exported snapshot the transaction of the connection should use.
+    :return: A psycopg connection instance
+    """
+    connection = get_connection(pg_args)
+    init_connection(connection, schema_name, init_sql, snapshot)
+    return connection
+
+
 def list_provider_classes():
     """List all available provider classes."""
     print("Available provider classes:\n")
@@ -84,6 +127,72 @@ def get_arg_parser():
         help="SQL to run before starting anonymization",
         default=False,
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of worker processes that anonymize the data of a table",
+        default=1,
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="Number of threads that encrypt the values of a table in each process",
+        default=1,
+    )
+    parser.add_argument(
+        "--parallel-tables",
+        type=int,
+        help="Number of tables that are anonymized at the same time",
+        default=1,
+    )
+    parser.add_argument(
+        "--count",
+        choices=COUNT_STRATEGIES,
+        help="How to count the rows of a table for the progress bar",
+        default=DEFAULT_COUNT_STRATEGY,
+    )
+    parser.add_argument(
+        "--apply-batch-size",
+        type=int,
+        help="Write the anonymized data back to the source tables in committed batches of this many rows",
+        default=None,
+    )
+    parser.add_argument(
+        "--lock-timeout",
+        help="Lock timeout of each batch written back with --apply-batch-size",
+        default=DEFAULT_LOCK_TIMEOUT,
+    )
+    parser.add_argument(
+        "--overwrite-strategy",
+        choices=OVERWRITE_STRATEGIES,
+        help="How to write the anonymized data back to the source tables: update them in place or rebuild and swap "
+        "them",
+        default=DEFAULT_OVERWRITE_STRATEGY,
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Commit each table with a checkpoint and skip the tables completed by an interrupted run",
+        default=False,
+    )
+    parser.add_argument(
+        "--no-pushdown",
+        action="store_false",
+        dest="pushdown",
+        help="Don't anonymize tables with a single SQL statement, even if all providers support it",
+    )
+    parser.add_argument(
+        "--copy-out",
+        action="store_true",
+        help="Read the data of a table with COPY TO STDOUT instead of a cursor",
+        default=False,
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Fetch, anonymize and import the data of a table concurrently",
+        default=False,
+    )
 
     return parser
 
@@ -118,19 +227,7 @@ def main(args):
                 "One of target_schema or overwrite_values_in_source_tables parameters must be defined!"
             )
 
-        switch_to_schema = f"SET search_path TO {schema_name};"
-
-        cursor = connection.cursor()
-        logging.info("Switching to search_path - {}".format(schema_name))
-        cursor.execute(switch_to_schema)
-
-        if args.init_sql:
-            logging.info(
-                "Executing initialisation sql {}".format(args.init_sql)
-            )
-            cursor.execute(args.init_sql)
-
-        cursor.close()
+        init_connection(connection, schema_name, args.init_sql)
 
         start_time = time.time()
         truncate_tables(connection, tables.get("truncate", []))
@@ -141,6 +238,20 @@ def main(args):
             verbose=args.verbose,
             dry_run=args.dry_run,
             overwrite_values_in_source_tables=overwrite_values_in_source_tables,
+            workers=args.workers,
+            threads=args.threads,
+            pipeline=args.pipeline,
+            parallel_tables=args.parallel_tables,
+            copy_out=args.copy_out,
+            count=args.count,
+            pushdown=args.pushdown,
+            apply_batch_size=args.apply_batch_size,
+            lock_timeout=args.lock_timeout,
+            overwrite_strategy=args.overwrite_strategy,
+            resume=args.resume,
+            connection_factory=partial(
+                connect, pg_args, schema_name, args.init_sql
+            ),
         )
 
         if not args.dry_run:
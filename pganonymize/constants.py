@@ -9,3 +9,66 @@ DEFAULT_SCHEMA_FILE = 'schema.yml'
 
 # Default chunk size for data fetch
 DEFAULT_CHUNK_SIZE = 100000
+
+# Strategies to count the rows of a table before it gets anonymized
+COUNT_STRATEGIES = ('exact', 'estimate', 'none')
+
+# Default strategy to count the rows of a table
+DEFAULT_COUNT_STRATEGY = 'exact'
+
+# Number of bytes the COPY writer sends to the database at once
+COPY_BUFFER_SIZE = 64 * 1024
+
+# Default number of chunks that may wait between two stages of the streaming pipeline
+DEFAULT_PIPELINE_QUEUE_SIZE = 2
+
+# Table that stores the progress of batched updates
+PROGRESS_TABLE = 'pganonymize_progress'
+
+# Table that stores the watermark of each incrementally anonymized table
+WATERMARK_TABLE = 'pganonymize_watermarks'
+
+# Default lock timeout of a batched update
+DEFAULT_LOCK_TIMEOUT = '5s'
+
+# Strategies to write the anonymized data back to the source tables
+OVERWRITE_STRATEGIES = ('update', 'swap')
+
+# Default strategy to write the anonymized data back to the source tables
+DEFAULT_OVERWRITE_STRATEGY = 'update'
+
+# Strategies to join the anonymized data with the source table
+APPLY_JOINS = ('auto', 'index', 'hash')
+
+# Largest fraction of the rows of a source table that is joined through an index by the automatic join strategy
+INDEX_JOIN_MAX_FRACTION = 0.05
+
+# Number of times a batched update is retried after its lock timeout has expired
+LOCK_RETRIES = 5
+
+# Maximum number of provider ids whose resolved provider class is cached by the registry
+PROVIDER_CACHE_SIZE = 1024
+
+# Number of keys looked up in a persistent mapping with one query
+MAPPING_LOOKUP_SIZE = 500
+
+# Default number of pseudonyms of a persistent mapping that are kept in memory
+DEFAULT_MAPPING_CACHE_SIZE = 100000
+
+# Default expected number of values of a unique fake column, the memory of its Bloom filter grows with it
+DEFAULT_UNIQUE_CAPACITY = 1000000
+
+# Default probability that a unique fake value is mistaken for a duplicate and generated again
+DEFAULT_UNIQUE_ERROR_RATE = 0.001
+
+# Default number of times a duplicate fake value is generated again before a counter is added to it
+DEFAULT_UNIQUE_MAX_RETRIES = 10
+
+# Default format of a unique fake value with a counter
+DEFAULT_UNIQUE_FALLBACK_FORMAT = '{counter}.{value}'
+
+# How often the pbkdf2 provider derives a new key: for every value, for every chunk or once per field of a table
+PBKDF2_KEY_SCOPES = ('cell', 'chunk', 'table')
+
+# Maximum number of values encrypted with one key and random nonces before a new key is derived
+PBKDF2_MAX_KEY_USES = 2 ** 32
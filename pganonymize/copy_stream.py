@@ -0,0 +1,470 @@
+"""Streaming binary COPY of table data"""
+
+from __future__ import absolute_import
+
+import json
+import logging
+import queue
+import struct
+import threading
+from datetime import date, datetime, timedelta, timezone
+from uuid import UUID
+
+from pgcopy import CopyManager
+from psycopg2.extensions import encodings
+from psycopg2.sql import SQL, Identifier
+
+from pganonymize.constants import COPY_BUFFER_SIZE, DEFAULT_PIPELINE_QUEUE_SIZE
+
+BINARY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+"""The signature at the beginning of each binary COPY stream."""
+
+BINARY_HEADER = BINARY_SIGNATURE + struct.pack('>ii', 0, 0)
+"""The signature followed by the flags field and the length of the (empty) header extension."""
+
+BINARY_TRAILER = struct.pack('>h', -1)
+"""The field count that marks the end of a binary COPY stream."""
+
+POSTGRES_EPOCH = datetime(2000, 1, 1)
+POSTGRES_EPOCH_DATE = POSTGRES_EPOCH.date()
+POSTGRES_EPOCH_UTC = POSTGRES_EPOCH.replace(tzinfo=timezone.utc)
+
+_int16 = struct.Struct('>h')
+_int32 = struct.Struct('>i')
+_int64 = struct.Struct('>q')
+_float32 = struct.Struct('>f')
+_float64 = struct.Struct('>d')
+_NULL = _int32.pack(-1)
+_DONE = object()
+"""Marks the end of the COPY stream."""
+
+
+def _decode_date(data):
+    days = _int32.unpack(data)[0]
+    if days == 0x7FFFFFFF:
+        return date.max
+    if days == -0x80000000:
+        return date.min
+    return POSTGRES_EPOCH_DATE + timedelta(days=days)
+
+
+def _decode_jsonb(data):
+    # The binary jsonb format is a version byte followed by the textual representation
+    return json.loads(data[1:].decode('utf8'))
+
+
+def get_decoders(encoding):
+    """
+    Return the binary COPY decoders for all supported type names.
+
+    The decoders return the same Python values as the psycopg2 type casters of the cursor based reader.
+
+    :param str encoding: The Python encoding of the connection.
+    :rtype: dict
+    """
+    def decode_text(data):
+        return data.decode(encoding)
+
+    return {
+        'bool': lambda data: data == b'\x01',
+        'int2': lambda data: _int16.unpack(data)[0],
+        'int4': lambda data: _int32.unpack(data)[0],
+        'int8': lambda data: struct.unpack('>q', data)[0],
+        'float4': lambda data: struct.unpack('>f', data)[0],
+        'float8': lambda data: struct.unpack('>d', data)[0],
+        'text': decode_text,
+        'varchar': decode_text,
+        'bpchar': decode_text,
+        'name': decode_text,
+        'citext': decode_text,
+        'bytea': memoryview,
+        'uuid': lambda data: str(UUID(bytes=data)),
+        'date': _decode_date,
+        'timestamp': lambda data: POSTGRES_EPOCH + timedelta(microseconds=struct.unpack('>q', data)[0]),
+        'timestamptz': lambda data: POSTGRES_EPOCH_UTC + timedelta(microseconds=struct.unpack('>q', data)[0]),
+        'json': lambda data: json.loads(data.decode('utf8')),
+        'jsonb': _decode_jsonb,
+    }
+
+
+def _encode_date(value):
+    if value == date.max:
+        return _int32.pack(0x7FFFFFFF)
+    if value == date.min:
+        return _int32.pack(-0x80000000)
+    return _int32.pack(value.toordinal() - POSTGRES_EPOCH_DATE.toordinal())
+
+
+def _encode_timestamp(value):
+    delta = value - (POSTGRES_EPOCH if value.tzinfo is None else POSTGRES_EPOCH_UTC)
+    return _int64.pack((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+def _encode_uuid(value):
+    try:
+        return value.bytes
+    except AttributeError:
+        return UUID(value).bytes
+
+
+def get_encoders(encoding):
+    """
+    Return the binary COPY encoders for all supported type names.
+
+    An encoder returns the binary representation of a single (not null) value. Values of text, json and bytea columns
+    which are already ``bytes`` are written as they are, so providers can return data in its wire format.
+
+    :param str encoding: The Python encoding of the connection.
+    :rtype: dict
+    """
+    def encode_text(value):
+        try:
+            return value.encode(encoding)
+        except AttributeError:
+            if isinstance(value, (bytes, bytearray, memoryview)):
+                return bytes(value)
+            if isinstance(value, (dict, list)):
+                return json.dumps(value).encode(encoding)
+            return str(value).encode(encoding)
+
+    return {
+        'bool': lambda value: b'\x01' if value else b'\x00',
+        'int2': lambda value: _int16.pack(int(value)),
+        'int4': lambda value: _int32.pack(int(value)),
+        'int8': lambda value: _int64.pack(int(value)),
+        'float4': lambda value: _float32.pack(float(value)),
+        'float8': lambda value: _float64.pack(float(value)),
+        'text': encode_text,
+        'varchar': encode_text,
+        'bpchar': encode_text,
+        'name': encode_text,
+        'citext': encode_text,
+        'bytea': encode_text,
+        'uuid': _encode_uuid,
+        'date': _encode_date,
+        'timestamp': _encode_timestamp,
+        'timestamptz': _encode_timestamp,
+        'json': encode_text,
+        'jsonb': lambda value: b'\x01' + encode_text(value),
+    }
+
+
+def get_column_types(connection, table, schema=None):
+    """
+    Return the type names of all columns of a table, domains are resolved to their base type.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table.
+    :param str schema: Name of the schema, the table is looked up with the search path if it is not given.
+    :return: A dictionary with the type name (``pg_type.typname``) of each column.
+    :rtype: dict
+    """
+    if schema:
+        relation, params = "quote_ident(%s) || '.' || quote_ident(%s)", (schema, table)
+    else:
+        relation, params = 'quote_ident(%s)', (table,)
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT a.attname, t.typname FROM pg_attribute a '
+        'JOIN pg_type d ON d.oid = a.atttypid '
+        "JOIN pg_type t ON t.oid = CASE WHEN d.typtype = 'd' THEN d.typbasetype ELSE d.oid END "
+        'WHERE a.attrelid = to_regclass({}) AND a.attnum > 0 AND NOT a.attisdropped'.format(relation),
+        params
+    )
+    column_types = dict(cursor.fetchall())
+    cursor.close()
+    return column_types
+
+
+class BinaryCopyParser(object):
+    """Incremental parser for the binary COPY format."""
+
+    def __init__(self, decoders):
+        """
+        :param list decoders: A decoder callable for each column of the stream.
+        """
+        self.decoders = decoders
+        self.done = False
+        self._buffer = bytearray()
+        self._header = False
+
+    def _parse_header(self, buffer):
+        if len(buffer) < 19:
+            return 0
+        if bytes(buffer[:11]) != BINARY_SIGNATURE:
+            raise ValueError('Invalid binary COPY signature')
+        extension_length = _int32.unpack_from(buffer, 15)[0]
+        if len(buffer) < 19 + extension_length:
+            return 0
+        self._header = True
+        return 19 + extension_length
+
+    def feed(self, data):
+        """
+        Add the next part of the stream and return all data rows that are complete.
+
+        :param bytes data: The next bytes of the COPY stream.
+        :rtype: list[tuple]
+        """
+        buffer = self._buffer
+        buffer += data
+        position = 0
+        if not self._header:
+            position = self._parse_header(buffer)
+            if not self._header:
+                return []
+        rows = []
+        size = len(buffer)
+        decoders = self.decoders
+        while not self.done and size - position >= 2:
+            count = _int16.unpack_from(buffer, position)[0]
+            if count == -1:
+                self.done = True
+                position += 2
+                break
+            offset = position + 2
+            fields = []
+            for _ in range(count):
+                if size - offset < 4:
+                    break
+                length = _int32.unpack_from(buffer, offset)[0]
+                offset += 4
+                if length == -1:
+                    fields.append(None)
+                    continue
+                if size - offset < length:
+                    break
+                fields.append(bytes(buffer[offset:offset + length]))
+                offset += length
+            else:
+                rows.append(tuple(
+                    None if field is None else decoder(field) for decoder, field in zip(decoders, fields)
+                ))
+                position = offset
+                continue
+            break
+        del buffer[:position]
+        return rows
+
+
+class CopyReader(object):
+    """
+    Read the data rows of a select statement with ``COPY ... TO STDOUT WITH BINARY`` in chunks.
+
+    The stream is read on its own connection in a reader thread, decoded incrementally and handed over in chunks of
+    ``chunk_size`` rows. At most ``queue_size`` chunks are waiting to be consumed.
+    """
+
+    poll_interval = 0.1
+    """Seconds to wait on the queue before checking whether the reader has been stopped."""
+
+    def __init__(self, connection_factory, snapshot, query, column_types, chunk_size,
+                 queue_size=DEFAULT_PIPELINE_QUEUE_SIZE):
+        """
+        :param connection_factory: A callable that returns a new database connection, it is called with the
+            ``snapshot`` keyword argument.
+        :param str snapshot: The exported snapshot the reader connection should use.
+        :param str query: The select statement.
+        :param list[str] column_types: The type name of each selected column.
+        :param int chunk_size: Number of data rows per chunk.
+        :param int queue_size: Maximum number of chunks waiting to be consumed.
+        """
+        self.connection_factory = connection_factory
+        self.snapshot = snapshot
+        self.query = query
+        self.column_types = column_types
+        self.chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._rows = []
+
+    @staticmethod
+    def supports(column_types):
+        """
+        Check whether all column types can be decoded.
+
+        :param list[str] column_types: The type names of the selected columns.
+        :rtype: bool
+        """
+        decoders = get_decoders('utf8')
+        return all(column_type in decoders for column_type in column_types)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=self.poll_interval)
+                return
+            except queue.Full:
+                pass
+        raise IOError('COPY reader has been stopped')
+
+    def write(self, data):
+        """Receive the next part of the COPY stream (called by :meth:`psycopg2.cursor.copy_expert`)."""
+        rows = self._rows
+        rows.extend(self._parser.feed(data))
+        while len(rows) >= self.chunk_size:
+            self._put(rows[:self.chunk_size])
+            del rows[:self.chunk_size]
+        return len(data)
+
+    def _read(self):
+        try:
+            connection = self.connection_factory(snapshot=self.snapshot)
+            try:
+                decoders = get_decoders(encodings[connection.encoding])
+                self._parser = BinaryCopyParser([decoders[column_type] for column_type in self.column_types])
+                cursor = connection.cursor()
+                cursor.copy_expert('COPY ({}) TO STDOUT WITH BINARY'.format(self.query), self)
+                cursor.close()
+                if self._rows:
+                    self._put(self._rows)
+            finally:
+                connection.rollback()
+                connection.close()
+        except Exception as exc:
+            item = exc
+        else:
+            item = _DONE
+        try:
+            self._put(item)
+        except IOError:
+            pass
+
+    def __iter__(self):
+        thread = threading.Thread(target=self._read, name='pganonymize-copy-reader')
+        thread.daemon = True
+        thread.start()
+        logging.info('Reading with COPY TO STDOUT')
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self._stop.set()
+            thread.join()
+
+
+class CopyInStream(object):
+    """
+    A file-like object that encodes data rows for ``COPY ... FROM STDIN WITH BINARY`` while it is read.
+
+    Rows are only taken from the iterable when the database connection asks for more data, so no more than the
+    requested number of bytes (plus a single row) is held in memory.
+    """
+
+    def __init__(self, encode_row, rows):
+        """
+        :param encode_row: A callable that returns the binary representation of a single data row.
+        :param rows: An iterable of data rows.
+        """
+        self._encode_row = encode_row
+        self._rows = iter(rows)
+        self._buffer = bytearray(BINARY_HEADER)
+        self._done = False
+
+    def read(self, size=-1):
+        """Return the next ``size`` bytes of the stream (called by :meth:`psycopg2.cursor.copy_expert`)."""
+        buffer = self._buffer
+        while not self._done and (size < 0 or len(buffer) < size):
+            row = next(self._rows, _DONE)
+            if row is _DONE:
+                buffer += BINARY_TRAILER
+                self._done = True
+            else:
+                buffer += self._encode_row(row)
+        if size < 0:
+            size = len(buffer)
+        data = bytes(buffer[:size])
+        del buffer[:size]
+        return data
+
+
+class CopyWriter(object):
+    """
+    Write data rows into a table with ``COPY ... FROM STDIN WITH BINARY``.
+
+    The column types of the table are looked up once, before the first rows are written, and an encoder is chosen
+    for each column (see :func:`get_encoders`). If a column has a type without an encoder (e.g. ``numeric`` or
+    arrays), the generic conversion of :class:`pgcopy.CopyManager` is used instead. Every call of :meth:`copy` then
+    streams its rows in buffers of ``buffer_size`` bytes.
+    """
+
+    def __init__(self, connection, table, column_names, buffer_size=COPY_BUFFER_SIZE):
+        """
+        :param connection: A database connection instance.
+        :param str table: Name of the table to be populated with data.
+        :param list[str] column_names: The columns of the data rows.
+        :param int buffer_size: Number of bytes sent to the database at once.
+        """
+        self.connection = connection
+        self.table = table
+        self.column_names = column_names
+        self.buffer_size = buffer_size
+        self.encoders = None
+        self.formatters = None
+        self.row_encoder = None
+        self.sql = None
+        self._field_count = _int16.pack(len(column_names))
+
+    def compile(self):
+        """Look up the column types of the table, choose the encoders and build the COPY statement."""
+        schema, table = self.table.split('.', 1) if '.' in self.table else (None, self.table)
+        table_types = get_column_types(self.connection, table, schema)
+        column_types = [table_types.get(column_name) for column_name in self.column_names]
+        encoders = get_encoders(encodings[self.connection.encoding])
+        if all(column_type in encoders for column_type in column_types):
+            self.encoders = [encoders[column_type] for column_type in column_types]
+            self.row_encoder = self._encode_row
+            relation = Identifier(schema, table) if schema else Identifier(table)
+        else:
+            logging.info('Using the generic COPY conversion for {}, not all column types are supported'.format(
+                self.table
+            ))
+            manager = CopyManager(self.connection, self.table, self.column_names)
+            self.formatters = manager.formatters
+            self.row_encoder = self._format_row
+            relation = Identifier(manager.schema, manager.table)
+        self.sql = SQL('COPY {relation} ({columns}) FROM STDIN WITH BINARY').format(
+            relation=relation,
+            columns=SQL(', ').join(Identifier(column_name) for column_name in self.column_names)
+        ).as_string(self.connection)
+
+    def _encode_row(self, row):
+        parts = [self._field_count]
+        for encode, value in zip(self.encoders, row):
+            if value is None:
+                parts.append(_NULL)
+            else:
+                data = encode(value)
+                parts.append(_int32.pack(len(data)))
+                parts.append(data)
+        return b''.join(parts)
+
+    def _format_row(self, row):
+        fmt = ['>h']
+        values = [len(self.formatters)]
+        for formatter, value in zip(self.formatters, row):
+            if isinstance(value, dict):
+                value = json.dumps(value).encode()
+            value_fmt, value_data = formatter(value)
+            fmt.append(value_fmt)
+            values.extend(value_data)
+        return struct.pack(''.join(fmt), *values)
+
+    def copy(self, rows):
+        """
+        Write data rows with a single COPY statement.
+
+        :param rows: An iterable of data rows, which is consumed lazily while the data is sent.
+        """
+        if self.sql is None:
+            self.compile()
+        cursor = self.connection.cursor()
+        try:
+            cursor.copy_expert(self.sql, CopyInStream(self.row_encoder, rows), size=self.buffer_size)
+        finally:
+            cursor.close()
@@ -8,22 +8,40 @@ class EncryptingService:
 
     def __init__(self, secret: str):
         self._secret = secret
+        self._key = None
 
     def _deriveKey(self, salt: bytes = None) -> [str, bytes]:
         if salt is None:
             salt = os.urandom(8)
         return hashlib.pbkdf2_hmac("sha256", self._secret.encode("utf8"), salt, 1000), salt
 
+    @property
+    def has_key(self) -> bool:
+        return self._key is not None
+
+    def rotate_key(self):
+        """
+        Derive a new key with a new salt, that is used for all values until the next rotation.
+
+        Without a rotated key, a new key is derived for every value. Every value still gets its own nonce and the
+        salt is stored with the value, so :meth:`decrypt_function` works in both cases.
+        """
+        key, salt = self._deriveKey()
+        self._key = AESGCM(key), hexlify(salt).decode("utf8")
+
     def encrypt_function(self, plaintext: str) -> str:
         if not isinstance(plaintext, str):
             return plaintext
-        key, salt = self._deriveKey()
-        aes = AESGCM(key)
+        if self._key is None:
+            key, salt = self._deriveKey()
+            aes, salt = AESGCM(key), hexlify(salt).decode("utf8")
+        else:
+            aes, salt = self._key
         iv = os.urandom(12)
         plaintext = plaintext.encode("utf8")
         ciphertext = aes.encrypt(iv, plaintext, None)
         return "%s-%s-%s" % (
-            hexlify(salt).decode("utf8"),
+            salt,
             hexlify(iv).decode("utf8"),
             hexlify(ciphertext).decode("utf8")
         )
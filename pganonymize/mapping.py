@@ -0,0 +1,144 @@
+"""Persistent pseudonym mappings"""
+
+from __future__ import absolute_import
+
+import datetime
+import decimal
+import json
+import os
+import sqlite3
+import uuid
+
+from pganonymize.constants import MAPPING_LOOKUP_SIZE
+from pganonymize.exceptions import InvalidProviderArgument
+
+VALUE_TYPES = (
+    ('datetime', datetime.datetime, datetime.datetime.fromisoformat),
+    ('date', datetime.date, datetime.date.fromisoformat),
+    ('time', datetime.time, datetime.time.fromisoformat),
+    ('decimal', decimal.Decimal, decimal.Decimal),
+    ('uuid', uuid.UUID, uuid.UUID),
+)
+"""The tag, type and parser of the pseudonyms that are stored as text, ``datetime`` is checked before ``date``."""
+
+
+def dump_value(value):
+    """
+    Encode a pseudonym as JSON, together with a tag of its type.
+
+    :param value: The pseudonym, a JSON compatible value or one of the :data:`VALUE_TYPES`.
+    :rtype: str
+    :raises InvalidProviderArgument: If the pseudonym has another type.
+    """
+    for tag, value_type, _ in VALUE_TYPES:
+        if isinstance(value, value_type):
+            return json.dumps([tag, value.isoformat() if hasattr(value, 'isoformat') else str(value)])
+    try:
+        return json.dumps(['json', value])
+    except TypeError:
+        raise InvalidProviderArgument('Pseudonyms of type {} can\'t be stored in a mapping'.format(
+            type(value).__name__
+        ))
+
+
+def load_value(text):
+    """
+    Decode a pseudonym that has been encoded by :func:`dump_value`.
+
+    :param str text: The encoded pseudonym.
+    """
+    tag, value = json.loads(text)
+    for value_tag, _, parse in VALUE_TYPES:
+        if tag == value_tag:
+            return parse(value)
+    return value
+
+
+class MappingStore(object):
+    """
+    A disk resident mapping of original values to their pseudonyms, stored in a SQLite database.
+
+    Mappings are grouped by a namespace, so different columns (even of different tables) can share the pseudonyms of
+    one namespace, while other columns use their own. The keys are the text representation of the original values,
+    the pseudonyms are stored as JSON with a tag of their type (see :func:`dump_value`), so they keep their type. Only
+    the looked up keys are read, so the mapping can be much larger than the available memory.
+
+    The SQLite connection is opened on first use, so every worker process gets its own connection. Concurrent writers
+    wait for each other and the first stored pseudonym of a key wins.
+    """
+
+    def __init__(self, path, namespace):
+        """
+        :param str path: Path of the SQLite database, it is created if it does not exist.
+        :param str namespace: Name of the mapping within the database.
+        """
+        self.path = path
+        self.namespace = namespace
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'] = state['_pid'] = None
+        return state
+
+    @property
+    def connection(self):
+        """
+        The SQLite connection of the current process.
+
+        :rtype: sqlite3.Connection
+        """
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._pid = os.getpid()
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS mapping '
+                '(namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT, PRIMARY KEY (namespace, key)) WITHOUT ROWID'
+            )
+            self._connection.commit()
+        return self._connection
+
+    def get_many(self, keys):
+        """
+        Look up the pseudonyms of a batch of keys.
+
+        :param list[str] keys: The keys to look up.
+        :return: A dictionary with the pseudonym of each key that has one.
+        :rtype: dict
+        """
+        connection = self.connection
+        found = {}
+        for offset in range(0, len(keys), MAPPING_LOOKUP_SIZE):
+            batch = keys[offset:offset + MAPPING_LOOKUP_SIZE]
+            placeholders = ', '.join('?' * len(batch))
+            sql = 'SELECT key, value FROM mapping WHERE namespace = ? AND key IN ({})'.format(placeholders)
+            rows = connection.execute(sql, [self.namespace] + batch)
+            for key, value in rows:
+                found[key] = load_value(value)
+        return found
+
+    def add_many(self, items):
+        """
+        Store the pseudonyms of a batch of new keys in a single transaction.
+
+        :param list[tuple] items: Tuples of a key and its pseudonym.
+        :return: A dictionary with the stored pseudonym of each key, which is the pseudonym of another process if it
+            has stored the key first.
+        :rtype: dict
+        """
+        connection = self.connection
+        with connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO mapping (namespace, key, value) VALUES (?, ?, ?)',
+                [(self.namespace, key, dump_value(value)) for key, value in items]
+            )
+        return self.get_many([key for key, _ in items])
+
+    def close(self):
+        """Close the SQLite connection of the current process."""
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
@@ -0,0 +1,136 @@
+"""Parallel transformation of data chunks"""
+
+from __future__ import absolute_import
+
+import multiprocessing
+import os
+import threading
+from collections import deque
+
+from pganonymize.providers import fake_data
+
+_worker_plan = None
+"""The table plan of the current worker process, compiled once by :func:`init_worker`."""
+
+
+def init_worker(plan, threads=1):
+    """
+    Initialize a worker process of a :class:`ChunkTransformer` pool.
+
+    :param pganonymize.plan.TablePlan plan: The table plan, which is compiled again from its definition when it gets
+        unpickled in the worker process.
+    :param int threads: Number of threads of the plan (see :meth:`~pganonymize.plan.TablePlan.start_threads`).
+    """
+    global _worker_plan
+    _worker_plan = plan
+    # Forked workers inherit the random state of Faker, which would make them generate the same fake values
+    fake_data.seed_instance(int.from_bytes(os.urandom(8), 'little'))
+    if threads and threads > 1:
+        plan.start_threads(threads)
+
+
+def transform_chunk(rows):
+    """
+    Anonymize a chunk of data rows inside a worker process.
+
+    :param list[tuple] rows: The data rows of the chunk.
+    :return: The altered rows, the process id of the worker and the statistics of its plan so far (see
+        :meth:`~pganonymize.plan.TablePlan.get_statistics`).
+    :rtype: tuple
+    """
+    return _worker_plan.process_chunk(rows), os.getpid(), _worker_plan.get_statistics()
+
+
+def get_context():
+    """
+    Return the multiprocessing context of a new worker pool.
+
+    A process that is forked while other threads are running (e.g. the connections of ``--parallel-tables``) may
+    inherit locks that are held by these threads, like the locks of the logging module, and hang on them. The worker
+    processes are spawned in that case.
+
+    :rtype: multiprocessing.context.BaseContext
+    """
+    if threading.active_count() > 1:
+        return multiprocessing.get_context('spawn')
+    return multiprocessing.get_context()
+
+
+class ChunkTransformer(object):
+    """A persistent pool of worker processes that anonymizes chunks of data rows."""
+
+    def __init__(self, plan, workers, threads=1):
+        """
+        :param pganonymize.plan.TablePlan plan: The plan of the table to be anonymized.
+        :param int workers: The number of worker processes.
+        :param int threads: The number of threads of each worker process.
+        """
+        self.workers = workers
+        self.max_pending = 2 * workers
+        self.statistics = {}
+        self._pool = get_context().Pool(workers, initializer=init_worker, initargs=(plan, threads))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(terminate=exc_type is not None)
+
+    def close(self, terminate=False):
+        """
+        Shut down the worker processes.
+
+        :param bool terminate: Stop the workers immediately instead of waiting for pending chunks.
+        """
+        if terminate:
+            self._pool.terminate()
+        else:
+            self._pool.close()
+        self._pool.join()
+
+    def submit(self, records):
+        """
+        Send a chunk of data rows to the pool.
+
+        :param list[tuple] records: The data rows of the chunk.
+        :rtype: multiprocessing.pool.AsyncResult
+        """
+        return self._pool.apply_async(transform_chunk, (records,))
+
+    def receive(self, result):
+        """
+        Wait for the altered rows of a chunk and remember the statistics of the worker that altered it.
+
+        :param multiprocessing.pool.AsyncResult result: The result of :meth:`submit`.
+        :rtype: list[tuple]
+        """
+        rows, pid, statistics = result.get()
+        # Each worker takes its chunks in order, so the statistics of its latest chunk include all earlier ones
+        self.statistics[pid] = statistics
+        return rows
+
+    def get_statistics(self):
+        """
+        Return the statistics of the plan in each worker process that has altered a chunk.
+
+        :rtype: list[list[tuple]]
+        """
+        return list(self.statistics.values())
+
+    def imap(self, chunks):
+        """
+        Anonymize chunks of data rows in the worker processes.
+
+        At most ``2 * workers`` chunks are in flight at the same time, so the memory usage stays bounded no matter
+        how fast the chunks are fetched.
+
+        :param chunks: An iterable of chunks.
+        :return: A generator with the altered rows of each chunk, in the order of the given chunks.
+        """
+        pending = deque()
+        for records in chunks:
+            pending.append(self.submit(records))
+            if len(pending) >= self.max_pending:
+                yield self.receive(pending.popleft())
+        while pending:
+            yield self.receive(pending.popleft())
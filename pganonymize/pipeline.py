@@ -0,0 +1,162 @@
+"""Overlapped fetch, transform and COPY stages"""
+
+from __future__ import absolute_import
+
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from pganonymize.constants import DEFAULT_PIPELINE_QUEUE_SIZE
+
+_DONE = object()
+"""Marks the end of a stream of chunks."""
+
+
+class PipelineAborted(Exception):
+    """Raised inside of a stage if another stage of the pipeline has failed."""
+
+
+class PipelineStage(object):
+    """Timing statistics of a single pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.chunks = 0
+        self.busy = 0.0
+        self.input_stall = 0.0
+        self.output_stall = 0.0
+
+    def __str__(self):
+        return '{}: {} chunks, busy {:.2f}s, waiting for input {:.2f}s, waiting for output {:.2f}s'.format(
+            self.name, self.chunks, self.busy, self.input_stall, self.output_stall
+        )
+
+
+class Pipeline(object):
+    """
+    Run the fetch, transform and COPY stages of a table concurrently.
+
+    The chunks are read in a reader thread, anonymized in the calling thread (or the worker processes the transform
+    callable hands them to) and written in a writer thread. The stages are connected by bounded queues, so no more
+    than ``queue_size`` chunks are waiting between two stages.
+    """
+
+    poll_interval = 0.1
+    """Seconds to wait on a queue before checking whether another stage has failed."""
+
+    def __init__(self, queue_size=DEFAULT_PIPELINE_QUEUE_SIZE):
+        """
+        :param int queue_size: Maximum number of chunks waiting between two stages.
+        """
+        self.queue_size = queue_size
+        self.stages = OrderedDict(
+            (name, PipelineStage(name)) for name in ('read', 'transform', 'write')
+        )
+        self._stop = threading.Event()
+        self._errors = []
+
+    def _get(self, source, stage):
+        start = time.time()
+        try:
+            while True:
+                try:
+                    return source.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    if self._stop.is_set():
+                        raise PipelineAborted()
+        finally:
+            stage.input_stall += time.time() - start
+
+    def _put(self, target, item, stage):
+        start = time.time()
+        try:
+            while True:
+                try:
+                    return target.put(item, timeout=self.poll_interval)
+                except queue.Full:
+                    if self._stop.is_set():
+                        raise PipelineAborted()
+        finally:
+            stage.output_stall += time.time() - start
+
+    def _run_stage(self, func, *args):
+        try:
+            func(*args)
+        except PipelineAborted:
+            pass
+        except BaseException as exc:
+            self._errors.append(exc)
+            self._stop.set()
+
+    def _read(self, chunks, target):
+        stage = self.stages['read']
+        iterator = iter(chunks)
+        while True:
+            start = time.time()
+            records = next(iterator, _DONE)
+            stage.busy += time.time() - start
+            self._put(target, records, stage)
+            if records is _DONE:
+                return
+            stage.chunks += 1
+
+    def _transform(self, transform, source, target):
+        stage = self.stages['transform']
+
+        def input_chunks():
+            while True:
+                records = self._get(source, stage)
+                if records is _DONE:
+                    return
+                yield records
+
+        start = time.time()
+        for data in transform(input_chunks()):
+            self._put(target, data, stage)
+            stage.chunks += 1
+        self._put(target, _DONE, stage)
+        stage.busy += time.time() - start - stage.input_stall - stage.output_stall
+
+    def _write(self, write, source):
+        stage = self.stages['write']
+        while True:
+            data = self._get(source, stage)
+            if data is _DONE:
+                return
+            start = time.time()
+            write(data)
+            stage.busy += time.time() - start
+            stage.chunks += 1
+
+    def run(self, chunks, transform, write):
+        """
+        Run the pipeline until all chunks are written.
+
+        :param chunks: An iterable of fetched chunks, consumed by the reader thread.
+        :param transform: A callable that takes an iterable of chunks and returns an iterable of altered chunks, e.g.
+            :meth:`pganonymize.plan.TablePlan.process_chunks`.
+        :param write: A callable that writes a single altered chunk, called by the writer thread.
+        :return: The statistics of all stages.
+        :rtype: OrderedDict
+        """
+        fetched = queue.Queue(maxsize=self.queue_size)
+        transformed = queue.Queue(maxsize=self.queue_size)
+        threads = [
+            threading.Thread(target=self._run_stage, args=(self._read, chunks, fetched), name='pganonymize-read'),
+            threading.Thread(target=self._run_stage, args=(self._write, write, transformed), name='pganonymize-write'),
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        self._run_stage(self._transform, transform, fetched, transformed)
+        if self._errors:
+            self._stop.set()
+        for thread in threads:
+            thread.join()
+        if self._errors:
+            raise self._errors[0]
+        for stage in self.stages.values():
+            logging.info('Pipeline stage %s', stage)
+        return self.stages
@@ -0,0 +1,430 @@
+"""Compiled per-table anonymization plans"""
+
+from __future__ import absolute_import
+
+import logging
+import math
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from pganonymize.cache import ValueCache, format_statistics
+from pganonymize.constants import DEFAULT_CHUNK_SIZE, DEFAULT_PRIMARY_KEY
+from pganonymize.exceptions import BadSchemaFormat
+from pganonymize.providers import provider_registry
+
+
+def get_path(dic, keys):
+    """
+    Get a value from a nested dictionary by an already split path.
+
+    :param dict dic: Source dictionary.
+    :param tuple keys: The path within the dictionary, e.g. ``('data', 'email')``.
+    :return: The value at the path or None if the path does not exist.
+    """
+    try:
+        for key in keys[:-1]:
+            dic = dic.get(key, {})
+        return dic[keys[-1]]
+    except (AttributeError, KeyError, TypeError):
+        return None
+
+
+def set_path(dic, keys, value):
+    """
+    Set a value in a nested dictionary by an already split path.
+
+    :param dict dic: Target dictionary.
+    :param tuple keys: The path within the dictionary, e.g. ``('data', 'email')``.
+    :param value: The value to be set.
+    """
+    for key in keys[:-1]:
+        dic = dic.get(key, {})
+    dic[keys[-1]] = value
+
+
+class ColumnPlan(object):
+    """The compiled anonymization rule of a single field definition."""
+
+    def __init__(self, definition):
+        """
+        :param dict definition: A single field definition from the YAML schema, e.g.:
+
+        >>> {'guest_email': {'append': '@localhost', 'provider': {'name': 'md5'}}}
+        """
+        self.full_name = list(definition.keys())[0]
+        self.name = self.full_name.split('.', 2)[0]
+        self.path = tuple(self.full_name.split('.'))
+        self.json_path = self.path[1:]
+        column_definition = definition[self.full_name]
+        provider_config = column_definition.get('provider')
+        self.provider = provider_registry.get_provider(provider_config['name'])(**provider_config)
+        self.append = column_definition.get('append')
+        self.format = column_definition.get('format')
+        self.cache = None
+        cache_size = column_definition.get('cache_size')
+        if cache_size and self.provider.deterministic:
+            self.cache = ValueCache(cache_size)
+        elif cache_size:
+            logging.warning('The provider of field "{}" is not deterministic, its values are not cached'.format(
+                self.full_name
+            ))
+        self.transform = self.build_transform()
+
+    def build_transform(self):
+        """
+        Build the callable that turns an original value into its anonymized version.
+
+        The callable expects the original value and the (partially altered) data row, which is needed to resolve
+        the placeholders of the ``format`` option.
+
+        :rtype: function
+        """
+        alter_value = self.provider.alter_value
+        if self.cache is not None:
+            cache = self.cache
+            provider_alter_value = alter_value
+
+            def alter_value(value):
+                return cache.alter_value(provider_alter_value, value)
+        append = self.append
+        format = self.format
+        if append and format:
+            return lambda value, row: format.format(pga_value=alter_value(value) + append, **row)
+        elif append:
+            return lambda value, row: alter_value(value) + append
+        elif format:
+            return lambda value, row: format.format(pga_value=alter_value(value), **row)
+        return lambda value, row: alter_value(value)
+
+    def transform_values(self, values, rows, batch=False):
+        """
+        Turn a batch of original values into their anonymized versions.
+
+        :param list values: The original values of the column.
+        :param rows: The (partially altered) data rows the values belong to, as a list of dictionaries or a callable
+            returning that list. Only used to resolve the ``format`` option.
+        :param bool batch: The values are a part of a chunk that has been begun with
+            :meth:`~pganonymize.providers.Provider.begin_chunk`.
+        :return: The anonymized values.
+        :rtype: list
+        """
+        alter_values = self.provider.alter_batch if batch else self.provider.alter_values
+        if self.cache is not None:
+            values = self.cache.alter_values(alter_values, values)
+        else:
+            values = alter_values(values)
+        if self.append:
+            append = self.append
+            values = [value + append for value in values]
+        if self.format:
+            format = self.format
+            rows = rows() if callable(rows) else rows
+            values = [format.format(pga_value=value, **row) for value, row in zip(values, rows)]
+        return values
+
+
+class TablePlan(object):
+    """
+    The compiled anonymization rules of a table definition.
+
+    A plan is built once per table and holds everything that does not change between data rows: the provider
+    instances, the split JSON paths, the compiled exclude patterns and the transform callable of each column.
+
+    Chunks are processed as plain tuples in the order of :attr:`row_columns` (the primary key followed by the
+    distinct top level columns), which is also the order of the select statement.
+    """
+
+    def __init__(self, columns, excludes=None, primary_key=None, table=None, chunk_size=None):
+        """
+        :param list columns: A list of field definitions from the YAML schema.
+        :param list[dict] excludes: A list of exclude definitions.
+        :param str primary_key: The primary key of the table.
+        :param str table: Name of the table.
+        :param int chunk_size: Number of data rows to fetch with the cursor.
+        """
+        self.table = table
+        self.primary_key = primary_key or DEFAULT_PRIMARY_KEY
+        self.chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        self.fields = columns
+        self.exclude_definitions = excludes
+        self.columns = [ColumnPlan(definition) for definition in columns]
+        self.column_names = []
+        for column in self.columns:
+            if column.name not in self.column_names:
+                self.column_names.append(column.name)
+        self.row_columns = [self.primary_key] + self.column_names
+        self.row_index = {name: index for index, name in enumerate(self.row_columns)}
+        self.excludes = []
+        for definition in excludes or []:
+            column = list(definition.keys())[0]
+            patterns = [re.compile(exclude, re.IGNORECASE) for exclude in definition.get(column, [])]
+            self.excludes.append((column, patterns))
+        self.exclude_indexes = None
+        if all(column in self.row_index for column, _ in self.excludes):
+            self.exclude_indexes = [(self.row_index[column], patterns) for column, patterns in self.excludes]
+        self.threads = 1
+        self.executor = None
+
+    def __reduce__(self):
+        # Plans are pickled by their definition and compiled again, e.g. inside of worker processes
+        return self.__class__, (self.fields, self.exclude_definitions, self.primary_key, self.table, self.chunk_size)
+
+    @classmethod
+    def from_definition(cls, table, table_definition):
+        """
+        Build a plan from a table definition of the YAML schema.
+
+        :param str table: Name of the table.
+        :param dict table_definition: The table definition, e.g. ``{'primary_key': 'id', 'fields': [...]}``.
+        :rtype: TablePlan
+        """
+        return cls(
+            table_definition.get('fields', []),
+            excludes=table_definition.get('excludes', []),
+            primary_key=table_definition.get('primary_key', DEFAULT_PRIMARY_KEY),
+            table=table,
+            chunk_size=table_definition.get('chunk_size', DEFAULT_CHUNK_SIZE),
+        )
+
+    def matches_excludes(self, row):
+        """
+        Check whether a row matches one of the exclude patterns.
+
+        :param row: The data row.
+        :rtype: bool
+        """
+        for column, patterns in self.excludes:
+            value = row[column]
+            if value is None:
+                continue
+            for pattern in patterns:
+                if pattern.match(value):
+                    return True
+        return False
+
+    def get_column_values(self, row):
+        """
+        Alter a single data row and return the values of all altered columns.
+
+        :param row: A data row from the current table to be altered.
+        :return: A dictionary with all altered top level columns and their new value.
+        :rtype: dict
+        """
+        column_dict = {}
+        for column in self.columns:
+            orig_value = get_path(row, column.path)
+            # Skip the current column if there is no value to be altered
+            if orig_value is not None:
+                set_path(row, column.path, column.transform(orig_value, row))
+                column_dict[column.name] = row[column.name]
+        return column_dict
+
+    def process_row(self, row):
+        """
+        Anonymize a single data row.
+
+        :param row: A data row from the current table.
+        :return: The altered row or None if the row is excluded or has nothing to alter.
+        """
+        if self.matches_excludes(row):
+            return None
+        if not self.get_column_values(row):
+            return None
+        return row
+
+    def process_chunk(self, records):
+        """
+        Anonymize a chunk of data rows column by column.
+
+        The rows are transposed into one list per column, each provider gets all values of its column at once (see
+        :meth:`pganonymize.providers.Provider.alter_values`).
+
+        :param list[tuple] records: The data rows of the current chunk, in the order of :attr:`row_columns`.
+        :return: The altered rows, without rows that are excluded or have nothing to alter.
+        :rtype: list[tuple]
+        """
+        if self.excludes:
+            if self.exclude_indexes is None:
+                raise BadSchemaFormat(
+                    'All exclude columns of table "{}" have to be one of its fields'.format(self.table)
+                )
+            records = [row for row in records if not self.matches_excludes_tuple(row)]
+        if not records:
+            return []
+        data = [list(values) for values in zip(*records)]
+        altered = [False] * len(records)
+        pending = []
+        for column in self.columns:
+            if pending and (column.format or column.name in [pending_column.name for pending_column, _, _ in pending]):
+                # The column depends on the altered values of the columns that are still processed by the threads
+                self.set_pending_values(data, pending)
+            column_values = data[self.row_index[column.name]]
+            json_path = column.json_path
+            indexes = []
+            values = []
+            for index, value in enumerate(column_values):
+                if json_path:
+                    value = get_path(value, json_path)
+                # Skip the current column if there is no value to be altered
+                if value is not None:
+                    indexes.append(index)
+                    values.append(value)
+                    altered[index] = True
+            if not values:
+                continue
+            if self.executor is not None and column.provider.releases_gil and column.cache is None:
+                rows = self.get_rows(data, indexes) if column.format else None
+                pending.append((column, indexes, self.submit_values(column, values, rows)))
+                continue
+            new_values = column.transform_values(values, lambda: self.get_rows(data, indexes))
+            self.set_values(data, column, indexes, new_values)
+        if pending:
+            self.set_pending_values(data, pending)
+        return [row for row, is_altered in zip(zip(*data), altered) if is_altered]
+
+    def get_rows(self, data, indexes):
+        """
+        Return data rows of a transposed chunk as dictionaries.
+
+        :param list[list] data: The values of the chunk, one list per column of :attr:`row_columns`.
+        :param list[int] indexes: The indexes of the rows.
+        :rtype: list[dict]
+        """
+        return [dict(zip(self.row_columns, [item[index] for item in data])) for index in indexes]
+
+    def set_values(self, data, column, indexes, new_values):
+        """
+        Store the altered values of a column in a transposed chunk.
+
+        :param list[list] data: The values of the chunk, one list per column of :attr:`row_columns`.
+        :param ColumnPlan column: The altered column.
+        :param list[int] indexes: The indexes of the altered rows.
+        :param list new_values: The altered values.
+        """
+        column_values = data[self.row_index[column.name]]
+        json_path = column.json_path
+        for index, value in zip(indexes, new_values):
+            if json_path:
+                set_path(column_values[index], json_path, value)
+            else:
+                column_values[index] = value
+
+    def start_threads(self, threads):
+        """
+        Start a pool of threads for the columns whose provider releases the GIL (see
+        :attr:`pganonymize.providers.Provider.releases_gil`).
+
+        The values of these columns are split into one batch per thread and altered while the other columns of the
+        chunk are processed.
+
+        :param int threads: The number of threads.
+        :return: The executor, which has to be shut down after the last chunk.
+        :rtype: concurrent.futures.ThreadPoolExecutor
+        """
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(threads)
+        return self.executor
+
+    def submit_values(self, column, values, rows):
+        """
+        Send the values of a column to the thread pool, in one batch per thread. The chunk is begun (see
+        :meth:`~pganonymize.providers.Provider.begin_chunk`) before, so e.g. the ``chunk`` key scope of the ``pbkdf2``
+        provider still derives a single key for all batches.
+
+        :param ColumnPlan column: The column.
+        :param list values: The original values.
+        :param list[dict] rows: The data rows of the values, only needed for the ``format`` option.
+        :return: The futures of the batches.
+        :rtype: list[concurrent.futures.Future]
+        """
+        size = int(math.ceil(len(values) / self.threads))
+        column.provider.begin_chunk(len(values))
+        return [
+            self.executor.submit(
+                column.transform_values, values[offset:offset + size], rows and rows[offset:offset + size], True
+            )
+            for offset in range(0, len(values), size)
+        ]
+
+    def set_pending_values(self, data, pending):
+        """
+        Wait for the columns that are altered by the thread pool and store their values.
+
+        :param list[list] data: The values of the chunk, one list per column of :attr:`row_columns`.
+        :param list[tuple] pending: The column, the row indexes and the futures of each pending column, the list is
+            emptied.
+        """
+        for column, indexes, futures in pending:
+            new_values = []
+            for future in futures:
+                new_values.extend(future.result())
+            self.set_values(data, column, indexes, new_values)
+        del pending[:]
+
+    def matches_excludes_tuple(self, row):
+        """
+        Check whether a tuple row matches one of the exclude patterns.
+
+        :param tuple row: The data row, in the order of :attr:`row_columns`.
+        :rtype: bool
+        """
+        for index, patterns in self.exclude_indexes:
+            value = row[index]
+            if value is None:
+                continue
+            for pattern in patterns:
+                if pattern.match(value):
+                    return True
+        return False
+
+    def get_statistics(self):
+        """
+        Return the counters of the caches and the statistics of the providers of all columns.
+
+        :return: A tuple of the cache hits, misses and evictions (or None if the column is not cached) and the
+            provider statistics (see :meth:`~pganonymize.providers.Provider.get_statistics`) of each column.
+        :rtype: list[tuple]
+        """
+        return [
+            (
+                None if column.cache is None else (column.cache.hits, column.cache.misses, column.cache.evictions),
+                column.provider.get_statistics(),
+            )
+            for column in self.columns
+        ]
+
+    def log_statistics(self, statistics=None):
+        """
+        Log the hits, misses and evictions of all cached columns and the statistics of their providers.
+
+        :param list statistics: The statistics of the plan in each worker process (see :meth:`get_statistics`). The
+            cache counters of all workers are added up, the provider statistics are logged for each worker. The
+            statistics of this plan are logged if not given.
+        """
+        if statistics is None:
+            statistics = [self.get_statistics()]
+        for index, column in enumerate(self.columns):
+            if column.cache is not None:
+                counters = [worker[index][0] for worker in statistics]
+                totals = [sum(values) for values in zip(*counters)] if counters else [0, 0, 0]
+                logging.info('Cache of field "{}" of table {}: {}'.format(
+                    column.full_name, self.table, format_statistics(*totals)
+                ))
+            for number, worker in enumerate(statistics, 1):
+                provider_statistics = worker[index][1]
+                if provider_statistics is None:
+                    continue
+                logging.info('Provider of field "{}" of table {}{}: {}'.format(
+                    column.full_name, self.table, ' (worker {})'.format(number) if len(statistics) > 1 else '',
+                    provider_statistics
+                ))
+
+    def process_chunks(self, chunks):
+        """
+        Anonymize a stream of chunks.
+
+        :param chunks: An iterable of chunks.
+        :return: A generator with the altered rows of each chunk.
+        """
+        for records in chunks:
+            yield self.process_chunk(records)
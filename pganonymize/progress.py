@@ -0,0 +1,145 @@
+"""Persistent progress of anonymized tables"""
+
+from __future__ import absolute_import
+
+import psycopg2.errors
+from psycopg2.sql import SQL, Identifier
+
+from pganonymize.constants import PROGRESS_TABLE
+
+
+def create_progress_table(connection):
+    """
+    Create the table that stores the progress of batched updates and resumable runs, if it does not exist yet.
+
+    The table is created in its own transaction, which is committed.
+
+    :param connection: A database connection instance.
+    """
+    sql = SQL(
+        'CREATE TABLE IF NOT EXISTS {table} '
+        '(table_name text PRIMARY KEY, last_primary_key text, completed_definitions integer NOT NULL DEFAULT 0)'
+    ).format(table=Identifier(PROGRESS_TABLE))
+    cursor = connection.cursor()
+    try:
+        cursor.execute(sql.as_string(connection))
+        connection.commit()
+    except (psycopg2.errors.UniqueViolation, psycopg2.errors.DuplicateTable):
+        # Another connection has created the table at the same time
+        connection.rollback()
+    finally:
+        cursor.close()
+
+
+def progress_table_exists(connection):
+    """
+    Check whether the progress table exists.
+
+    :param connection: A database connection instance.
+    :rtype: bool
+    """
+    cursor = connection.cursor()
+    cursor.execute('SELECT to_regclass(%s)', (PROGRESS_TABLE,))
+    exists = cursor.fetchone()[0] is not None
+    cursor.close()
+    return exists
+
+
+def get_progress(connection, table):
+    """
+    Return the primary key of the last data row that has been written back to a table.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table.
+    :return: The primary key (as text) or None if there is no unfinished run for the table.
+    :rtype: str
+    """
+    if not progress_table_exists(connection):
+        return None
+    cursor = connection.cursor()
+    sql = SQL('SELECT last_primary_key FROM {table} WHERE table_name = %s').format(table=Identifier(PROGRESS_TABLE))
+    cursor.execute(sql.as_string(connection), (table,))
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0] if row else None
+
+
+def set_progress(connection, table, last_primary_key):
+    """
+    Store the primary key of the last data row that has been written back to a table.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table.
+    :param last_primary_key: The primary key, it is stored as text.
+    """
+    sql = SQL(
+        'INSERT INTO {table} (table_name, last_primary_key) VALUES (%s, %s) '
+        'ON CONFLICT (table_name) DO UPDATE SET last_primary_key = EXCLUDED.last_primary_key'
+    ).format(table=Identifier(PROGRESS_TABLE))
+    cursor = connection.cursor()
+    cursor.execute(sql.as_string(connection), (table, str(last_primary_key)))
+    cursor.close()
+
+
+def clear_progress(connection, table):
+    """
+    Remove the progress of a table, after all of its data rows have been written back.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table.
+    """
+    sql = SQL(
+        'UPDATE {table} SET last_primary_key = NULL WHERE table_name = %(table)s; '
+        'DELETE FROM {table} WHERE table_name = %(table)s AND completed_definitions = 0'
+    ).format(table=Identifier(PROGRESS_TABLE))
+    cursor = connection.cursor()
+    cursor.execute(sql.as_string(connection), {'table': table})
+    cursor.close()
+
+
+def get_completed_definitions(connection):
+    """
+    Return the number of completed definitions of each table of an interrupted run.
+
+    :param connection: A database connection instance.
+    :return: A dictionary with the number of completed definitions by table name.
+    :rtype: dict
+    """
+    if not progress_table_exists(connection):
+        return {}
+    sql = SQL('SELECT table_name, completed_definitions FROM {table} WHERE completed_definitions > 0').format(
+        table=Identifier(PROGRESS_TABLE)
+    )
+    cursor = connection.cursor()
+    cursor.execute(sql.as_string(connection))
+    completed = dict(cursor.fetchall())
+    cursor.close()
+    return completed
+
+
+def complete_definition(connection, table):
+    """
+    Count a table definition as completed, it is skipped when an interrupted run is resumed.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table.
+    """
+    sql = SQL(
+        'INSERT INTO {table} (table_name, completed_definitions) VALUES (%s, 1) '
+        'ON CONFLICT (table_name) DO UPDATE SET completed_definitions = {table}.completed_definitions + 1'
+    ).format(table=Identifier(PROGRESS_TABLE))
+    cursor = connection.cursor()
+    cursor.execute(sql.as_string(connection), (table,))
+    cursor.close()
+
+
+def clear_checkpoints(connection):
+    """
+    Remove the progress of all tables, after a resumable run has been completed.
+
+    :param connection: A database connection instance.
+    """
+    sql = SQL('DELETE FROM {table}').format(table=Identifier(PROGRESS_TABLE))
+    cursor = connection.cursor()
+    cursor.execute(sql.as_string(connection))
+    cursor.close()
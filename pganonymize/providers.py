@@ -1,28 +1,46 @@
+import hmac
 import operator
+import os
 import random
 import re
+import threading
 from collections import OrderedDict
 from datetime import datetime
-from hashlib import md5
-from uuid import uuid4
+from hashlib import md5, sha256
+from uuid import UUID, uuid4
 
 from faker import Faker
+from psycopg2.sql import SQL, Placeholder
 
+from pganonymize.cache import ValueCache
+from pganonymize.constants import (
+    DEFAULT_MAPPING_CACHE_SIZE, DEFAULT_UNIQUE_CAPACITY, DEFAULT_UNIQUE_ERROR_RATE, DEFAULT_UNIQUE_FALLBACK_FORMAT,
+    DEFAULT_UNIQUE_MAX_RETRIES, PBKDF2_KEY_SCOPES, PBKDF2_MAX_KEY_USES, PROVIDER_CACHE_SIZE
+)
 from pganonymize.encrypting.encrypt_service import EncryptingService
 from pganonymize.exceptions import (
     InvalidProvider,
     InvalidProviderArgument,
     ProviderAlreadyRegistered,
 )
+from pganonymize.mapping import MappingStore
+from pganonymize.unique import UniqueValues
 
 fake_data = Faker()
 
+SQL_VALUE_TYPES = (str, int, float, bool)
+"""Types of provider arguments that can be passed to the database as query parameters."""
+
 
 class ProviderRegistry(object):
     """A registry for provider classes."""
 
-    def __init__(self):
+    def __init__(self, cache_size=PROVIDER_CACHE_SIZE):
         self._registry = OrderedDict()
+        self._index = None
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
 
     def register(self, provider_class, provider_id):
         """
@@ -39,23 +57,68 @@ class ProviderRegistry(object):
                 )
             )
         self._registry[provider_id] = provider_class
+        self.clear_cache()
+
+    def clear_cache(self):
+        """Drop the lookup index and all cached provider resolutions."""
+        with self._lock:
+            self._index = None
+            self._cache.clear()
+
+    def _build_index(self):
+        """
+        Build the lookup index for the registered providers.
+
+        The index consists of a dictionary for exact id matches and a list of precompiled patterns for all
+        providers using regular expressions, both with the registration position of the provider, so that the
+        first registered provider still wins if more than one provider matches.
+        """
+        exact = {}
+        patterns = []
+        for position, (key, cls) in enumerate(self._registry.items()):
+            exact.setdefault(key, (position, cls))
+            if cls.regex_match is True:
+                patterns.append((position, re.compile(key), cls))
+        return self._registry, exact, patterns
+
+    def _resolve(self, provider_id):
+        _, exact, patterns = self._index
+        position, cls = exact.get(provider_id, (len(self._registry), None))
+        for pattern_position, pattern, pattern_cls in patterns:
+            if pattern_position >= position:
+                break
+            if pattern.match(provider_id) is not None:
+                return pattern_cls
+        return cls
 
     def get_provider(self, provider_id):
         """
         Return a provider by it's provider id.
 
+        Resolved provider ids are cached, the cache is invalidated whenever a new provider gets registered.
+
         :param str provider_id: The string id of the desired provider.
         :raises InvalidProvider: If no provider can be found with the given id.
         """
-        for key, cls in self._registry.items():
-            if (
-                cls.regex_match is True
-                and re.match(re.compile(key), provider_id) is not None  # noqa
-            ) or key == provider_id:
+        with self._lock:
+            if self._index is None or self._index[0] is not self._registry:
+                self._index = self._build_index()
+                self._cache.clear()
+            try:
+                cls = self._cache[provider_id]
+                self._cache.move_to_end(provider_id)
                 return cls
-        raise InvalidProvider(
-            'Could not find provider with id "{}"'.format(provider_id)
-        )
+            except KeyError:
+                pass
+            cls = self._resolve(provider_id)
+            if cls is None:
+                raise InvalidProvider(
+                    'Could not find provider with id "{}"'.format(provider_id)
+                )
+            self._cache[provider_id] = cls
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+            return cls
 
     @property
     def providers(self):
@@ -94,6 +157,22 @@ class Provider(object):
     regex_match = False
     """Defines whether a provider matches it's id using regular expressions."""
 
+    deterministic = False
+    """Defines whether a provider always returns the same value for the same original value, so that its values can
+    be cached (see the ``cache_size`` option of a field)."""
+
+    unique = False
+    """Defines whether a provider returns unique values. The values are only unique within one process, so such a
+    provider can't be used in a table with ``workers``."""
+
+    sql_functions = ()
+    """The names of the database functions the SQL expression of :meth:`to_sql` depends on, the expression is only
+    used if all of them exist."""
+
+    releases_gil = False
+    """Defines whether a provider spends most of its time in code that releases the GIL, so that its values can be
+    altered by a pool of threads (see the ``threads`` option of a table)."""
+
     def __init__(self, **kwargs):
         self.kwargs = kwargs
 
@@ -105,6 +184,63 @@ class Provider(object):
         """
         raise NotImplementedError()
 
+    def alter_values(self, values):
+        """
+        Alter or replace a batch of original values of the database column.
+
+        Providers can override this method to process a whole chunk of data rows at once, the default
+        implementation calls :meth:`alter_value` for each value.
+
+        :param list values: The original values of the database column.
+        :return: The altered values, in the same order as the original values.
+        :rtype: list
+        """
+        alter_value = self.alter_value
+        return [alter_value(value) for value in values]
+
+    def begin_chunk(self, count):
+        """
+        Prepare the provider for the values of a chunk that are altered in several batches with :meth:`alter_batch`,
+        e.g. by the threads of :meth:`pganonymize.plan.TablePlan.start_threads`.
+
+        :param int count: The number of values of the chunk.
+        """
+
+    def alter_batch(self, values):
+        """
+        Alter a batch of the values of a chunk that has been prepared with :meth:`begin_chunk`. The default
+        implementation calls :meth:`alter_values`.
+
+        :param list values: The original values of the batch.
+        :return: The altered values, in the same order as the original values.
+        :rtype: list
+        """
+        return self.alter_values(values)
+
+    def to_sql(self, column, params):
+        """
+        Return a SQL expression that alters the column within the database.
+
+        Providers that PostgreSQL can compute itself override this method, so that a table can be anonymized with a
+        single statement (see :mod:`pganonymize.pushdown`).
+
+        :param psycopg2.sql.Composable column: The column with the original value.
+        :param list params: The query parameters, the values used by the expression have to be appended in the order
+            of their placeholders.
+        :return: The SQL expression or None if the values can only be altered in Python.
+        :rtype: psycopg2.sql.Composable
+        """
+        return None
+
+    def get_statistics(self):
+        """
+        Return a summary of the work of the provider, that is logged after a table has been anonymized.
+
+        :return: The summary or None if the provider has nothing to report.
+        :rtype: str
+        """
+        return None
+
 
 @register("choice")
 class ChoiceProvider(Provider):
@@ -113,34 +249,185 @@ class ChoiceProvider(Provider):
     def alter_value(self, value):
         return random.choice(self.kwargs.get("values"))
 
+    def alter_values(self, values):
+        return random.choices(self.kwargs.get("values"), k=len(values))
+
+    def to_sql(self, column, params):
+        values = self.kwargs.get("values")
+        if not values or not isinstance(values, list):
+            return None
+        if len(set(type(value) for value in values)) > 1 or not isinstance(values[0], SQL_VALUE_TYPES):
+            return None
+        params.append(values)
+        return SQL("({values})[1 + floor(random() * {count})::int]").format(
+            values=Placeholder(), count=SQL(str(len(values)))
+        )
+
 
 @register("clear")
 class ClearProvider(Provider):
     """Provider to set a field value to None."""
 
+    deterministic = True
+
     def alter_value(self, value):
         return None
 
+    def alter_values(self, values):
+        return [None] * len(values)
+
+    def to_sql(self, column, params):
+        return SQL("NULL")
+
 
 @register("fake.+")
 class FakeProvider(Provider):
-    """Provider to generate fake data."""
+    """
+    Provider to generate fake data.
+
+    With the ``pool_size`` argument, a pool of fake values is generated once and the values of a column are drawn
+    from it at random, instead of calling Faker for every value. The pool is generated again after ``pool_refresh``
+    values have been drawn, if it's set.
+
+    With the ``unique`` argument, the generated values are unique without keeping all of them in memory, see
+    :class:`pganonymize.unique.UniqueValues`. The ``capacity`` argument is the expected number of values.
+
+    With the ``deterministic`` argument, Faker is seeded with a keyed hash of the provider name and the original value
+    before every value, so the same original value always gets the same fake value. The secret of the hash is the
+    ``key`` argument or the environment variable named by ``key_env``, one of them is required.
+    """
 
     regex_match = True
 
-    def alter_value(self, value):
+    def __init__(self, **kwargs):
+        super(FakeProvider, self).__init__(**kwargs)
+        self.pool = None
+        self.pool_draws = 0
+        self.unique_values = None
+        self.deterministic = bool(kwargs.get("deterministic"))
+        self.unique = bool(kwargs.get("unique")) or kwargs["name"].startswith("fake.unique.")
+        self.faker = None
+        self.key = None
+        if self.deterministic:
+            if kwargs.get("pool_size") or self.unique:
+                raise InvalidProviderArgument("deterministic fake values can't be drawn from a pool or be unique")
+            self.key = self.get_key()
+
+    def get_function(self):
+        """
+        Return the Faker method of the provider.
+
+        :raises InvalidProviderArgument: If Faker has no such method.
+        """
         func_name = self.kwargs["name"].split(".", 1)[1]
+        if self.kwargs.get("unique") and func_name.startswith("unique."):
+            # Faker would remember every value as well
+            func_name = func_name.split(".", 1)[1]
+        faker = fake_data
+        if self.deterministic:
+            # Seeding the shared instance would make the values of all other providers predictable
+            if self.faker is None:
+                self.faker = Faker()
+            faker = self.faker
         try:
-            func = operator.attrgetter(func_name)(fake_data)
+            return operator.attrgetter(func_name)(faker)
         except AttributeError as exc:
             raise InvalidProviderArgument(exc)
-        return func()
+
+    def get_key(self):
+        """
+        Return the secret of the deterministic fake values, the ``key`` argument or the environment variable named by
+        the ``key_env`` argument.
+
+        :rtype: bytes
+        :raises InvalidProviderArgument: If there is no key, without it anyone could compute the fake values.
+        """
+        key_env = self.kwargs.get("key_env")
+        key = os.environ.get(key_env) if key_env else self.kwargs.get("key")
+        if not key:
+            if key_env:
+                raise InvalidProviderArgument('environment variable {} of fake provider is not set'.format(key_env))
+            raise InvalidProviderArgument('attribute "key" or "key_env" of deterministic fake provider is not set')
+        return key.encode("utf-8")
+
+    def get_seed(self, value):
+        """
+        Return the seed of the fake value of an original value.
+
+        :param value: The original value.
+        :rtype: int
+        """
+        message = "{}\0{}".format(self.kwargs["name"], value).encode("utf-8")
+        digest = hmac.new(self.key, message, sha256).digest()
+        return int.from_bytes(digest[:8], "little")
+
+    def get_pool(self):
+        """
+        Return the pool of fake values, it is generated on first use and after ``pool_refresh`` draws.
+
+        :rtype: list
+        """
+        pool_refresh = self.kwargs.get("pool_refresh")
+        if self.pool is None or (pool_refresh and self.pool_draws >= pool_refresh):
+            if self.kwargs["name"].startswith("fake.unique.") or self.kwargs.get("unique"):
+                raise InvalidProviderArgument("unique fake values can't be drawn from a pool")
+            func = self.get_function()
+            self.pool = [func() for _ in range(self.kwargs["pool_size"])]
+            self.pool_draws = 0
+        return self.pool
+
+    def get_unique_values(self):
+        """
+        Return the generator of unique values, it is created on first use.
+
+        :rtype: pganonymize.unique.UniqueValues
+        """
+        if self.unique_values is None:
+            self.unique_values = UniqueValues(
+                self.get_function(),
+                capacity=self.kwargs.get("capacity", DEFAULT_UNIQUE_CAPACITY),
+                error_rate=self.kwargs.get("error_rate", DEFAULT_UNIQUE_ERROR_RATE),
+                max_retries=self.kwargs.get("max_retries", DEFAULT_UNIQUE_MAX_RETRIES),
+                fallback_format=self.kwargs.get("fallback_format", DEFAULT_UNIQUE_FALLBACK_FORMAT),
+            )
+        return self.unique_values
+
+    def get_statistics(self):
+        if self.unique_values is None:
+            return None
+        return str(self.unique_values)
+
+    def alter_value(self, value):
+        if self.kwargs.get("pool_size") or self.kwargs.get("unique") or self.deterministic:
+            return self.alter_values([value])[0]
+        return self.get_function()()
+
+    def alter_values(self, values):
+        if self.kwargs.get("pool_size"):
+            pool = self.get_pool()
+            self.pool_draws += len(values)
+            return random.choices(pool, k=len(values))
+        if self.kwargs.get("unique"):
+            next_value = self.get_unique_values().next_value
+            return [next_value() for _ in values]
+        func = self.get_function()
+        if self.deterministic:
+            seed_instance = self.faker.seed_instance
+            get_seed = self.get_seed
+            new_values = []
+            for value in values:
+                seed_instance(get_seed(value))
+                new_values.append(func())
+            return new_values
+        return [func() for _ in values]
 
 
 @register("mask")
 class MaskProvider(Provider):
     """Provider that masks the original value."""
 
+    deterministic = True
+
     default_sign = "X"
     """The default string used to replace each character."""
 
@@ -148,11 +435,21 @@ class MaskProvider(Provider):
         sign = self.kwargs.get("sign", self.default_sign) or self.default_sign
         return sign * len(value)
 
+    def alter_values(self, values):
+        sign = self.kwargs.get("sign", self.default_sign) or self.default_sign
+        return [sign * len(value) for value in values]
+
+    def to_sql(self, column, params):
+        params.append(self.kwargs.get("sign", self.default_sign) or self.default_sign)
+        return SQL("repeat({sign}, char_length({column}::text))").format(sign=Placeholder(), column=column)
+
 
 @register("md5")
 class MD5Provider(Provider):
     """Provider to hash a value with the md5 algorithm."""
 
+    deterministic = True
+
     default_max_length = 8
     """The default length used for the number representation."""
 
@@ -167,53 +464,219 @@ class MD5Provider(Provider):
         else:
             return hashed
 
+    def alter_values(self, values):
+        if self.kwargs.get("as_number", False):
+            modulo = 10 ** self.kwargs.get(
+                "as_number_length", self.default_max_length
+            )
+            return [
+                int(md5(value.encode("utf-8")).hexdigest(), 16) % modulo
+                for value in values
+            ]
+        return [md5(value.encode("utf-8")).hexdigest() for value in values]
+
+    def to_sql(self, column, params):
+        hashed = SQL("md5({column}::text)").format(column=column)
+        if not self.kwargs.get("as_number", False):
+            return hashed
+        # The 128 bit hash is assembled from four 32 bit parts, so it can be reduced like its Python integer
+        parts = [
+            SQL("('x' || substr({hashed}, {start}, 8))::bit(32)::bigint").format(hashed=hashed, start=SQL(str(start)))
+            for start in (1, 9, 17, 25)
+        ]
+        number = SQL("{part}::numeric").format(part=parts[0])
+        for part in parts[1:]:
+            number = SQL("({number} * 4294967296 + {part})").format(number=number, part=part)
+        modulo = 10 ** self.kwargs.get("as_number_length", self.default_max_length)
+        return SQL("mod({number}, {modulo})").format(number=number, modulo=SQL(str(modulo)))
+
 
 @register("set")
 class SetProvider(Provider):
     """Provider to set a static value."""
 
+    deterministic = True
+
     def alter_value(self, value):
         return self.kwargs.get("value")
 
+    def alter_values(self, values):
+        return [self.kwargs.get("value")] * len(values)
+
+    def to_sql(self, column, params):
+        value = self.kwargs.get("value")
+        if value is None:
+            return SQL("NULL")
+        if not isinstance(value, SQL_VALUE_TYPES):
+            return None
+        params.append(value)
+        return Placeholder()
+
 
 @register("uuid4")
 class UUID4Provider(Provider):
     """Provider to set a random uuid value."""
 
+    sql_functions = ("gen_random_uuid",)
+
     def alter_value(self, value):
         return uuid4()
 
+    def alter_values(self, values):
+        random_bytes = os.urandom(16 * len(values))
+        return [
+            UUID(bytes=random_bytes[offset:offset + 16], version=4)
+            for offset in range(0, len(random_bytes), 16)
+        ]
+
+    def to_sql(self, column, params):
+        return SQL("gen_random_uuid()")
+
 
 @register("pbkdf2")
 class PBKDF2Provider(Provider):
-    """Provider to encrypt a value with the pbkdf2 algorithm."""
+    """
+    Provider to encrypt a value with the pbkdf2 algorithm.
+
+    The ``key_scope`` argument defines how often a new key is derived: for every value (``cell``, the default), for
+    every chunk (``chunk``) or once for the field of a table (``table``). A chunk is the batch of values passed to
+    :meth:`alter_values`, or all values of a field in a chunk of rows if they are split between threads (see
+    :meth:`begin_chunk`).
+    """
+
+    releases_gil = True
+
+    def __init__(self, **kwargs):
+        super(PBKDF2Provider, self).__init__(**kwargs)
+        self.service = None
+        self.key_uses = 0
+        # Chunks of the same column may be begun by several threads
+        self.lock = threading.Lock()
+
+    def get_service(self):
+        """
+        Return the encrypting service, it is created on first use.
+
+        :rtype: pganonymize.encrypting.encrypt_service.EncryptingService
+        :raises InvalidProviderArgument: If the secret or the key scope is invalid.
+        """
+        if self.service is None:
+            pbkdf2_passphrase: str = self.kwargs.get("secret", False)
+            if not pbkdf2_passphrase:
+                raise InvalidProviderArgument(
+                    'attribute "secret" of pbkdf2 provider is not set'
+                )
+            if pbkdf2_passphrase == "DA_SECRET_PHRASE":
+                raise InvalidProviderArgument(
+                    "cannot find environment variable DA_SECRET_PHRASE "
+                    "check your .env file"
+                )
+            if self.kwargs.get("key_scope", "cell") not in PBKDF2_KEY_SCOPES:
+                raise InvalidProviderArgument(
+                    'attribute "key_scope" of pbkdf2 provider must be one of {}'.format(", ".join(PBKDF2_KEY_SCOPES))
+                )
+            self.service = EncryptingService(pbkdf2_passphrase)
+        return self.service
 
     def alter_value(self, value: str):
-        pbkdf2_passphrase: str = self.kwargs.get("secret", False)
-        if not pbkdf2_passphrase:
-            raise InvalidProviderArgument(
-                'attribute "secret" of pbkdf2 provider is not set'
-            )
-        if pbkdf2_passphrase == "DA_SECRET_PHRASE":
-            raise InvalidProviderArgument(
-                "cannot find environment variable DA_SECRET_PHRASE "
-                "check your .env file"
+        return self.alter_values([value])[0]
+
+    def alter_values(self, values):
+        self.begin_chunk(len(values))
+        return self.alter_batch(values)
+
+    def begin_chunk(self, count):
+        key_scope = self.kwargs.get("key_scope", "cell")
+        with self.lock:
+            service = self.get_service()
+            rotate = key_scope == "chunk" or (
+                key_scope == "table" and (not service.has_key or self.key_uses + count > PBKDF2_MAX_KEY_USES)
             )
+            if rotate:
+                self.key_uses = 0
+            self.key_uses += count
+        if rotate:
+            # The key is derived outside of the lock, other threads keep encrypting with the previous key meanwhile
+            service.rotate_key()
 
-        return EncryptingService(pbkdf2_passphrase).encrypt_function(value)
+    def alter_batch(self, values):
+        encrypt_function = self.get_service().encrypt_function
+        return [encrypt_function(value) for value in values]
 
 
 @register("date_today")
 class DatetimeProvider(Provider):
     """Provider to set current datetime value."""
 
+    deterministic = True
+
     def alter_value(self, value: str):
         return datetime.now().date()
 
+    def alter_values(self, values):
+        return [datetime.now().date()] * len(values)
+
+    def to_sql(self, column, params):
+        return SQL("CURRENT_DATE")
+
 
 @register("keep")
 class KeepProvider(Provider):
     """Provider to set value without changes."""
 
+    deterministic = True
+
     def alter_value(self, value):
         return value
+
+    def to_sql(self, column, params):
+        return column
+
+
+@register("mapping")
+class MappingProvider(Provider):
+    """
+    Provider that maps each original value to a pseudonym, which is stored on disk and reused by all columns and runs
+    sharing the same ``store`` and ``namespace``.
+
+    Pseudonyms for new values are generated by the nested ``provider``. Each chunk is looked up and stored in bulk
+    (see :class:`~pganonymize.mapping.MappingStore`), the recently used pseudonyms are also kept in memory.
+    """
+
+    deterministic = True
+
+    def __init__(self, **kwargs):
+        super(MappingProvider, self).__init__(**kwargs)
+        path = kwargs.get("store")
+        if not path:
+            raise InvalidProviderArgument('attribute "store" of mapping provider is not set')
+        provider_config = kwargs.get("provider")
+        if not isinstance(provider_config, dict) or "name" not in provider_config:
+            raise InvalidProviderArgument('attribute "provider" of mapping provider is not set')
+        self.provider = provider_registry.get_provider(provider_config["name"])(**provider_config)
+        self.store = MappingStore(path, kwargs.get("namespace", "default"))
+        self.cache = ValueCache(kwargs.get("cache_size", DEFAULT_MAPPING_CACHE_SIZE))
+
+    def alter_value(self, value):
+        return self.alter_values([value])[0]
+
+    def alter_values(self, values):
+        return self.cache.alter_values(self.map_values, values)
+
+    def map_values(self, values):
+        """
+        Return the stored pseudonyms of a batch of values, new pseudonyms are generated and stored.
+
+        :param list values: The original values.
+        :rtype: list
+        """
+        keys = [str(value) for value in values]
+        mapped = self.store.get_many(keys)
+        missing = {}
+        for key, value in zip(keys, values):
+            if key not in mapped:
+                missing.setdefault(key, value)
+        if missing:
+            pseudonyms = self.provider.alter_values(list(missing.values()))
+            mapped.update(self.store.add_many(list(zip(missing.keys(), pseudonyms))))
+        return [mapped[key] for key in keys]
@@ -0,0 +1,223 @@
+"""Set-based anonymization of tables within the database"""
+
+from __future__ import absolute_import
+
+import logging
+import re
+import threading
+import weakref
+
+from psycopg2.sql import SQL, Composed, Identifier, Placeholder
+
+UNSUPPORTED_PATTERN = re.compile(r'\(\?(?![:=!])|\\[bB]')
+"""
+Matches regular expression syntax that PostgreSQL interprets differently than Python, e.g. named groups or ``\\b``,
+which is a backspace and not a word boundary in PostgreSQL.
+"""
+
+_function_cache = weakref.WeakKeyDictionary()
+"""The existence of the probed database functions of each connection."""
+
+_function_cache_lock = threading.Lock()
+
+
+def get_missing_functions(connection, names):
+    """
+    Return the database functions that don't exist, e.g. ``gen_random_uuid`` before PostgreSQL 13 without pgcrypto.
+
+    Every function is only looked up once per connection.
+
+    :param connection: A database connection instance.
+    :param names: The names of the functions.
+    :return: The names of the missing functions.
+    :rtype: list[str]
+    """
+    with _function_cache_lock:
+        known = _function_cache.setdefault(connection, {})
+        unknown = [name for name in names if name not in known]
+    if unknown:
+        cursor = connection.cursor()
+        cursor.execute(
+            'SELECT name, to_regproc(name) IS NOT NULL FROM unnest(%s::text[]) AS t(name)', (unknown,)
+        )
+        found = dict(cursor.fetchall())
+        cursor.close()
+        with _function_cache_lock:
+            known.update(found)
+    return [name for name in names if not known.get(name)]
+
+
+def get_column_sql_types(connection, table):
+    """
+    Return the SQL types of all columns of a table, without type modifiers.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table.
+    :return: A dictionary with the formatted type name of each column, e.g. ``character varying``.
+    :rtype: dict
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT attname, format_type(atttypid, NULL) FROM pg_attribute '
+        'WHERE attrelid = to_regclass(quote_ident(%s)) AND attnum > 0 AND NOT attisdropped',
+        (table,)
+    )
+    column_types = dict(cursor.fetchall())
+    cursor.close()
+    return column_types
+
+
+def get_column_expression(column, params):
+    """
+    Return the SQL expression of a single field definition.
+
+    :param pganonymize.plan.ColumnPlan column: The compiled field definition.
+    :param list params: The query parameters, the values used by the expression are appended.
+    :return: The SQL expression or None if the field can only be anonymized in Python.
+    :rtype: psycopg2.sql.Composable
+    """
+    if column.json_path or column.format:
+        return None
+    column_params = []
+    expression = column.provider.to_sql(Identifier(column.name), column_params)
+    if expression is None:
+        return None
+    if column.append:
+        expression = SQL('({expression})::text || {append}').format(expression=expression, append=Placeholder())
+        column_params.append(column.append)
+    params.extend(column_params)
+    return expression
+
+
+def get_exclude_condition(plan, params):
+    """
+    Return a SQL condition that matches all data rows which are not excluded.
+
+    :param pganonymize.plan.TablePlan plan: The plan of the table.
+    :param list params: The query parameters, the exclude patterns are appended.
+    :return: The SQL condition or None if one of the patterns can only be matched in Python.
+    :rtype: psycopg2.sql.Composable
+    """
+    matches = []
+    exclude_params = []
+    for column, patterns in plan.excludes:
+        for pattern in patterns:
+            if UNSUPPORTED_PATTERN.search(pattern.pattern):
+                return None
+            # re.match() is anchored at the beginning of the value and the patterns are compiled with re.IGNORECASE
+            matches.append(SQL('coalesce({column}::text ~* {pattern}, false)').format(
+                column=Identifier(column), pattern=Placeholder()
+            ))
+            exclude_params.append('^(?:{})'.format(pattern.pattern))
+    params.extend(exclude_params)
+    return SQL('NOT ({matches})').format(matches=SQL(' OR ').join(matches))
+
+
+def build_pushdown(plan, search=None, connection=None):
+    """
+    Translate a table plan into SQL, if all of its fields and excludes can be expressed in SQL.
+
+    A field can be expressed in SQL if its provider implements :meth:`~pganonymize.providers.Provider.to_sql`, it is
+    not nested into a JSON column and has no ``format``.
+
+    :param pganonymize.plan.TablePlan plan: The plan of the table.
+    :param str search: A SQL WHERE (search_condition) that limits the rows of the table.
+    :param connection: A database connection instance, used to check whether the database functions of the
+        providers exist (see :attr:`~pganonymize.providers.Provider.sql_functions`).
+    :return: A tuple of the expression for each column, the condition for the data rows to be altered and the query
+        parameters, or None if the table can only be anonymized in Python.
+    :rtype: tuple
+    """
+    if len(plan.columns) != len(plan.column_names) or (plan.excludes and plan.exclude_indexes is None):
+        return None
+    params = []
+    expressions = []
+    for column in plan.columns:
+        expression = get_column_expression(column, params)
+        if expression is None:
+            return None
+        expressions.append((column.name, expression))
+    if connection is not None:
+        functions = []
+        for column in plan.columns:
+            functions.extend(name for name in column.provider.sql_functions if name not in functions)
+        missing = get_missing_functions(connection, functions) if functions else []
+        if missing:
+            logging.info('Anonymizing table {} in Python, the database has no function {}'.format(
+                plan.table, ', '.join(missing)
+            ))
+            return None
+    conditions = []
+    if search:
+        # The statement is executed with parameters, so percent signs of the search condition have to be escaped
+        conditions.append(SQL('({search})'.format(search=search.replace('%', '%%'))))
+    if plan.excludes:
+        exclude_condition = get_exclude_condition(plan, params)
+        if exclude_condition is None:
+            return None
+        conditions.append(exclude_condition)
+    # Data rows without any value to be altered are skipped, just like in Python
+    conditions.append(SQL('({})').format(SQL(' OR ').join(
+        SQL('{column} IS NOT NULL').format(column=Identifier(name)) for name in plan.column_names
+    )))
+    return expressions, SQL(' AND ').join(conditions), params
+
+
+def anonymize_table_with_sql(connection, plan, search=None, target_schema=None,
+                             overwrite_values_in_source_tables=False):
+    """
+    Anonymize a table with a single ``UPDATE`` or ``CREATE TABLE AS`` statement, if all of its fields and excludes
+    can be expressed in SQL (see :func:`build_pushdown`).
+
+    :param connection: A database connection instance.
+    :param pganonymize.plan.TablePlan plan: The plan of the table.
+    :param str search: A SQL WHERE (search_condition) that limits the rows of the table.
+    :param str target_schema: Target schema where the anonymized table will be created or replaced.
+    :param bool overwrite_values_in_source_tables: Update the source table instead of creating a new table.
+    :return: True if the table has been anonymized, False if it can only be anonymized in Python.
+    :rtype: bool
+    """
+    pushdown = build_pushdown(plan, search, connection)
+    if pushdown is None:
+        return False
+    expressions, condition, params = pushdown
+    column_types = get_column_sql_types(connection, plan.table)
+    if any(name not in column_types for name, _ in expressions):
+        return False
+    # Cast the result to the column type, NULL values stay NULL like in Python
+    columns = [
+        (name, SQL('CASE WHEN {column} IS NULL THEN NULL ELSE ({expression})::{type} END').format(
+            column=Identifier(name), expression=expression, type=SQL(column_types[name])
+        ))
+        for name, expression in expressions
+    ]
+    table = Identifier(plan.table)
+    if overwrite_values_in_source_tables:
+        sql = SQL('UPDATE {table} SET {columns} WHERE {condition}').format(
+            table=table,
+            columns=SQL(', ').join(
+                SQL('{column} = {expression}').format(column=Identifier(name), expression=expression)
+                for name, expression in columns
+            ),
+            condition=condition
+        )
+    else:
+        target = Composed([Identifier(target_schema), SQL('.'), table])
+        sql = SQL(
+            'DROP TABLE IF EXISTS {target}; '
+            'CREATE TABLE {target} AS (SELECT {primary_key}, {columns} FROM {table} WHERE {condition})'
+        ).format(
+            target=target,
+            primary_key=Identifier(plan.primary_key),
+            columns=SQL(', ').join(
+                SQL('{expression} AS {column}').format(column=Identifier(name), expression=expression)
+                for name, expression in columns
+            ),
+            table=table,
+            condition=condition
+        )
+    logging.info('Anonymizing table {} within the database'.format(plan.table))
+    cursor = connection.cursor()
+    cursor.execute(sql.as_string(connection), params)
+    cursor.close()
+    return True
@@ -0,0 +1,152 @@
+"""Concurrent anonymization of multiple tables"""
+
+from __future__ import absolute_import
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+import psycopg2
+
+
+def export_snapshot(connection):
+    """
+    Export the snapshot of the current transaction, so that other connections can share it.
+
+    :param connection: A database connection instance.
+    :return: The snapshot id
+    :rtype: str
+    """
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_export_snapshot()')
+    snapshot = cursor.fetchone()[0]
+    cursor.close()
+    return snapshot
+
+
+def is_table_locked(connection, table):
+    """
+    Check whether the current transaction has modified or locked a table, e.g. by a ``TRUNCATE`` or ``UPDATE``.
+
+    Connections that import the snapshot of the transaction don't see its uncommitted changes of the table and may
+    have to wait for its locks.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table.
+    :rtype: bool
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT EXISTS (SELECT 1 FROM pg_locks WHERE pid = pg_backend_pid() AND locktype = 'relation' "
+        "AND relation = to_regclass(quote_ident(%s)) AND mode <> 'AccessShareLock')",
+        (table,)
+    )
+    locked = cursor.fetchone()[0]
+    cursor.close()
+    return locked
+
+
+def get_table_sizes(connection, tables):
+    """
+    Return the estimated size of tables, taken from the statistics of the ``pg_class`` catalog.
+
+    :param connection: A database connection instance.
+    :param list[str] tables: A list of table names.
+    :return: A dictionary with a ``(relpages, reltuples)`` tuple for each existing table.
+    :rtype: dict
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT t.name, c.relpages, c.reltuples '
+        'FROM unnest(%s::text[]) AS t(name) '
+        'JOIN pg_class c ON c.oid = to_regclass(quote_ident(t.name))',
+        (list(tables),)
+    )
+    sizes = {name: (relpages, reltuples) for name, relpages, reltuples in cursor.fetchall()}
+    cursor.close()
+    return sizes
+
+
+def schedule_tables(connection, definitions):
+    """
+    Group the table definitions by table and order the groups by table size, largest first.
+
+    Definitions of the same table stay in one group (in their original order), so that a table is never anonymized by
+    two connections at the same time.
+
+    :param connection: A database connection instance.
+    :param list definitions: A list of table definitions from the YAML schema.
+    :return: A list of definition lists.
+    :rtype: list[list]
+    """
+    groups = OrderedDict()
+    for definition in definitions:
+        groups.setdefault(list(definition.keys())[0], []).append(definition)
+    sizes = get_table_sizes(connection, groups.keys())
+    ordered = sorted(groups, key=lambda table: sizes.get(table, (0, 0)), reverse=True)
+    return [groups[table] for table in ordered]
+
+
+def anonymize_tables_concurrently(connection, definitions, anonymize_table, connection_factory, max_tables,
+                                  dry_run=False):
+    """
+    Anonymize a list of tables with up to ``max_tables`` tables at once, each on its own connection.
+
+    All connections share the exported snapshot of ``connection``, so they see the same consistent state of the
+    database. The connections are only committed after all tables have been anonymized successfully, if one table
+    fails all of them are rolled back. The commits of the connections are not atomic though: if a commit fails, the
+    tables of the connections that have already been committed stay anonymized, they are logged as an error.
+
+    :param connection: A database connection instance.
+    :param list definitions: A list of table definitions from the YAML schema.
+    :param anonymize_table: A callable that anonymizes a single table definition on the given connection.
+    :param connection_factory: A callable that returns a new database connection, it is called with the ``snapshot``
+        keyword argument.
+    :param int max_tables: Maximum number of tables anonymized at the same time.
+    :param bool dry_run: Script is running in dry-run mode, no commit expected.
+    """
+    snapshot = export_snapshot(connection)
+    groups = schedule_tables(connection, definitions)
+    logging.info('Anonymizing %d tables with up to %d connections', len(groups), max_tables)
+    connections = OrderedDict()
+    lock = threading.Lock()
+    local = threading.local()
+
+    def run(group):
+        if getattr(local, 'connection', None) is None:
+            local.connection = connection_factory(snapshot=snapshot)
+            with lock:
+                connections[local.connection] = []
+        for definition in group:
+            anonymize_table(local.connection, definition)
+            with lock:
+                connections[local.connection].append(list(definition.keys())[0])
+
+    committed = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_tables) as executor:
+            futures = [executor.submit(run, group) for group in groups]
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in not_done:
+                future.cancel()
+            for future in futures:
+                if future.done() and not future.cancelled():
+                    future.result()
+        if not dry_run:
+            for worker_connection, tables in connections.items():
+                worker_connection.commit()
+                committed.extend(tables)
+                logging.info('Committed tables %s', ', '.join(tables))
+    except BaseException:
+        if committed:
+            logging.error('The run failed after the tables %s have been committed', ', '.join(committed))
+        for worker_connection in connections:
+            try:
+                worker_connection.rollback()
+            except psycopg2.Error:
+                logging.exception('Rollback failed')
+        raise
+    finally:
+        for worker_connection in connections:
+            worker_connection.close()
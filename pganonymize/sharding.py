@@ -0,0 +1,157 @@
+"""Primary key range sharding of large tables"""
+
+from __future__ import absolute_import
+
+import logging
+import queue
+import threading
+
+from psycopg2.sql import SQL, Identifier
+
+from pganonymize.constants import DEFAULT_PIPELINE_QUEUE_SIZE
+
+INTEGER_TYPES = ('smallint', 'integer', 'bigint')
+"""Primary key types that are split into ranges by their bounds, all other types are split by their hash."""
+
+_DONE = object()
+"""Marks the end of the chunks of a single shard."""
+
+
+def get_column_type(connection, table, column):
+    """
+    Return the SQL type of a table column.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table.
+    :param str column: Name of the column.
+    :return: The formatted type name, e.g. ``integer`` or ``uuid``.
+    :rtype: str
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT format_type(atttypid, atttypmod) FROM pg_attribute '
+        'WHERE attrelid = to_regclass(quote_ident(%s)) AND attname = %s',
+        (table, column)
+    )
+    column_type = cursor.fetchone()[0]
+    cursor.close()
+    return column_type
+
+
+def get_shard_conditions(connection, table, primary_key, shards, search=None):
+    """
+    Split a table into shards by its primary key.
+
+    Integer primary keys are split into ranges of the same width between the lowest and highest key, all other keys
+    (e.g. UUIDs or text) are split by ``hashtext(primary_key) % shards``.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table.
+    :param str primary_key: The primary key of the table.
+    :param int shards: The number of shards.
+    :param str search: A SQL WHERE (search_condition) that limits the rows of the table.
+    :return: A list with a SQL condition for each shard or an empty list if the table has no rows.
+    :rtype: list[psycopg2.sql.Composed]
+    """
+    pk = Identifier(primary_key)
+    if get_column_type(connection, table, primary_key) not in INTEGER_TYPES:
+        return [
+            SQL('(hashtext({pk}::text) & 2147483647) % {shards} = {shard}').format(
+                pk=pk, shards=SQL(str(int(shards))), shard=SQL(str(shard))
+            )
+            for shard in range(shards)
+        ]
+    sql = SQL('SELECT min({pk}), max({pk}) FROM {table}').format(pk=pk, table=Identifier(table))
+    if search:
+        sql = sql + SQL(" WHERE {search_condition}".format(search_condition=search))
+    cursor = connection.cursor()
+    cursor.execute(sql.as_string(connection))
+    lowest, highest = cursor.fetchone()
+    cursor.close()
+    if lowest is None:
+        return []
+    width = -(-(highest - lowest + 1) // shards)
+    return [
+        SQL('{pk} >= {start} AND {pk} < {end}').format(pk=pk, start=SQL(str(start)), end=SQL(str(start + width)))
+        for start in range(lowest, highest + 1, width)
+    ]
+
+
+class ShardedReader(object):
+    """
+    Read the chunks of all shards of a table concurrently, each shard on its own connection.
+
+    Iterating over the reader yields the chunks of all shards in the order they are fetched. At most ``queue_size``
+    chunks are waiting to be consumed.
+    """
+
+    poll_interval = 0.1
+    """Seconds to wait on the queue before checking whether the reader has been stopped."""
+
+    def __init__(self, connection_factory, snapshot, queries, chunk_size, queue_size=DEFAULT_PIPELINE_QUEUE_SIZE):
+        """
+        :param connection_factory: A callable that returns a new database connection, it is called with the
+            ``snapshot`` keyword argument.
+        :param str snapshot: The exported snapshot all shard connections should use.
+        :param list[str] queries: The select statement of each shard.
+        :param int chunk_size: Number of data rows to fetch at once.
+        :param int queue_size: Maximum number of fetched chunks waiting to be consumed.
+        """
+        self.connection_factory = connection_factory
+        self.snapshot = snapshot
+        self.queries = queries
+        self.chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read(self, query):
+        try:
+            connection = self.connection_factory(snapshot=self.snapshot)
+            try:
+                cursor = connection.cursor(name='fetch_shard')
+                cursor.execute(query)
+                while True:
+                    records = cursor.fetchmany(size=self.chunk_size)
+                    if not records or not self._put(records):
+                        break
+                cursor.close()
+            finally:
+                connection.rollback()
+                connection.close()
+        except Exception as exc:
+            self._put(exc)
+        else:
+            self._put(_DONE)
+
+    def __iter__(self):
+        threads = [
+            threading.Thread(target=self._read, args=(query,), name='pganonymize-shard-{}'.format(index))
+            for index, query in enumerate(self.queries)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        logging.info('Reading %d shards', len(threads))
+        try:
+            running = len(threads)
+            while running:
+                item = self._queue.get()
+                if item is _DONE:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,258 @@
+"""Build-and-swap overwrite of source tables"""
+
+from __future__ import absolute_import
+
+import logging
+
+from psycopg2.sql import SQL, Identifier, Literal
+
+SWAP_BLOCKERS = (
+    'not a plain table',
+    'table inheritance',
+    'referencing foreign keys',
+    'dependent views or rules',
+    'triggers',
+    'identity columns',
+    'row level security',
+    'column privileges',
+    'publications',
+    'extended statistics',
+    'column statistics settings',
+)
+"""Table features that can't be carried over to a rebuilt table, in the order of the blocker query."""
+
+BLOCKER_SQL = """
+    SELECT
+        c.relkind <> 'r',
+        EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = c.oid OR inhparent = c.oid),
+        EXISTS (SELECT 1 FROM pg_constraint WHERE confrelid = c.oid AND contype = 'f'),
+        EXISTS (
+            SELECT 1 FROM pg_depend d JOIN pg_rewrite r ON r.oid = d.objid
+            WHERE d.classid = 'pg_rewrite'::regclass AND d.refobjid = c.oid AND r.ev_class <> c.oid
+        ),
+        EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = c.oid AND NOT tgisinternal),
+        EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = c.oid AND attnum > 0 AND attidentity <> ''),
+        c.relrowsecurity OR EXISTS (SELECT 1 FROM pg_policy WHERE polrelid = c.oid),
+        EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = c.oid AND attnum > 0 AND attacl IS NOT NULL),
+        EXISTS (SELECT 1 FROM pg_publication_rel WHERE prrelid = c.oid),
+        EXISTS (SELECT 1 FROM pg_statistic_ext WHERE stxrelid = c.oid),
+        EXISTS (
+            SELECT 1 FROM pg_attribute WHERE attrelid = c.oid AND attnum > 0 AND NOT attisdropped
+                AND (coalesce(attstattarget, -1) >= 0 OR attoptions IS NOT NULL)
+        )
+    FROM pg_class c WHERE c.oid = %s
+"""
+
+TABLE_SQL = (
+    'SELECT c.oid, n.nspname, pg_get_userbyid(c.relowner), obj_description(c.oid, \'pg_class\'), c.relpersistence, '
+    'c.relreplident, c.reloptions '
+    'FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE c.oid = to_regclass(quote_ident(%s))'
+)
+
+COLUMNS_SQL = (
+    'SELECT attname FROM pg_attribute '
+    "WHERE attrelid = %s AND attnum > 0 AND NOT attisdropped AND attgenerated = '' ORDER BY attnum"
+)
+
+INDEXES_SQL = """
+    SELECT ic.relname, pg_get_indexdef(i.indexrelid), con.conname, pg_get_constraintdef(con.oid), i.indisreplident
+    FROM pg_index i
+    JOIN pg_class ic ON ic.oid = i.indexrelid
+    LEFT JOIN pg_constraint con ON con.conindid = i.indexrelid AND con.conrelid = i.indrelid
+        AND con.contype IN ('p', 'u', 'x')
+    WHERE i.indrelid = %s
+    ORDER BY i.indisprimary DESC, ic.relname
+"""
+
+FOREIGN_KEYS_SQL = "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s AND contype = 'f'"
+
+SEQUENCES_SQL = """
+    SELECT sn.nspname, s.relname, a.attname
+    FROM pg_depend d
+    JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+    JOIN pg_namespace sn ON sn.oid = s.relnamespace
+    JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+    WHERE d.classid = 'pg_class'::regclass AND d.refobjid = %s AND d.deptype = 'a'
+"""
+
+GRANTS_SQL = """
+    SELECT CASE WHEN a.grantee = 0 THEN NULL ELSE pg_get_userbyid(a.grantee) END, a.privilege_type, a.is_grantable
+    FROM pg_class c, aclexplode(c.relacl) a
+    WHERE c.oid = %s
+"""
+
+
+def _fetchall(connection, sql, params):
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+
+def get_swap_info(connection, table):
+    """
+    Collect everything that is needed to rebuild a table.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table.
+    :return: A dictionary with the table details, its ``blockers`` list is empty if the table can be swapped.
+    :rtype: dict
+    """
+    oid, schema, owner, comment, persistence, replica_identity, options = _fetchall(connection, TABLE_SQL, (table,))[0]
+    info = {
+        'oid': oid, 'schema': schema, 'table': table, 'owner': owner, 'comment': comment, 'persistence': persistence,
+        'replica_identity': replica_identity, 'options': options,
+    }
+    if connection.server_version < 120000:
+        info['blockers'] = ['PostgreSQL before version 12']
+        return info
+    flags = _fetchall(connection, BLOCKER_SQL, (oid,))[0]
+    info['blockers'] = [reason for reason, flag in zip(SWAP_BLOCKERS, flags) if flag]
+    if info['blockers']:
+        return info
+    info['columns'] = [row[0] for row in _fetchall(connection, COLUMNS_SQL, (oid,))]
+    info['indexes'] = _fetchall(connection, INDEXES_SQL, (oid,))
+    info['foreign_keys'] = _fetchall(connection, FOREIGN_KEYS_SQL, (oid,))
+    info['sequences'] = _fetchall(connection, SEQUENCES_SQL, (oid,))
+    info['grants'] = _fetchall(connection, GRANTS_SQL, (oid,))
+    return info
+
+
+def build_swap_statements(info, temp_table, primary_key, column_names):
+    """
+    Return the statements that rebuild a table with its anonymized values and swap it with the original one.
+
+    The new table is created with the columns, defaults, check constraints, storage settings, comments, persistence
+    and storage parameters of the original table. The data rows are copied over once, anonymized columns are taken
+    from the temporary table and all other columns from the original one. Indexes, primary key, unique and foreign key
+    constraints are created after the data has been copied, owned sequences, the owner and the privileges are carried
+    over, before the original table is dropped and the new table gets its name and replica identity.
+
+    :param dict info: The table details of :func:`get_swap_info`.
+    :param str temp_table: Name of the temporary table with the anonymized data.
+    :param str primary_key: The primary key of the table.
+    :param list[str] column_names: The anonymized columns.
+    :rtype: list[psycopg2.sql.Composable]
+    """
+    schema = info['schema']
+    table = Identifier(schema, info['table'])
+    new_name = 'pga_new_{}'.format(info['oid'])
+    new_table = Identifier(schema, new_name)
+    pk = Identifier(primary_key)
+    statements = [
+        SQL(
+            'CREATE {unlogged}TABLE {new_table} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS '
+            'INCLUDING GENERATED INCLUDING STORAGE INCLUDING COMMENTS){options}'
+        ).format(
+            unlogged=SQL('UNLOGGED ') if info['persistence'] == 'u' else SQL(''),
+            new_table=new_table,
+            table=table,
+            # The storage parameters come from the catalog, where they have been validated, e.g. fillfactor=70
+            options=SQL(' WITH ({})'.format(', '.join(info['options']))) if info['options'] else SQL(''),
+        ),
+    ]
+    values = []
+    for column in info['columns']:
+        if column in column_names:
+            values.append(SQL('CASE WHEN s.{pk} IS NULL THEN t.{column} ELSE s.{column} END').format(
+                pk=pk, column=Identifier(column)
+            ))
+        else:
+            values.append(SQL('t.{column}').format(column=Identifier(column)))
+    statements.append(SQL(
+        'INSERT INTO {new_table} ({columns}) SELECT {values} FROM {table} t LEFT JOIN {temp_table} s ON s.{pk} = t.{pk}'
+    ).format(
+        new_table=new_table,
+        columns=SQL(', ').join(Identifier(column) for column in info['columns']),
+        values=SQL(', ').join(values),
+        table=table,
+        temp_table=Identifier(temp_table),
+        pk=pk,
+    ))
+    renames = []
+    replica_identity = {'f': SQL('FULL'), 'n': SQL('NOTHING')}.get(info['replica_identity'])
+    for index, (index_name, index_def, constraint_name, constraint_def, is_replica_identity) in enumerate(
+        info['indexes']
+    ):
+        if is_replica_identity and info['replica_identity'] == 'i':
+            replica_identity = SQL('USING INDEX {name}').format(name=Identifier(index_name))
+        # Index names are unique within a schema, so they get a temporary name until the original table is dropped
+        temp_name = 'pga_{}_{}'.format(info['oid'], index)
+        if constraint_name:
+            statements.append(SQL('ALTER TABLE {new_table} ADD CONSTRAINT {name} {definition}').format(
+                new_table=new_table, name=Identifier(temp_name), definition=SQL(constraint_def)
+            ))
+            renames.append(SQL('ALTER TABLE {table} RENAME CONSTRAINT {temp_name} TO {name}').format(
+                table=table, temp_name=Identifier(temp_name), name=Identifier(constraint_name)
+            ))
+        else:
+            unique = SQL('UNIQUE ') if index_def.startswith('CREATE UNIQUE ') else SQL('')
+            statements.append(SQL('CREATE {unique}INDEX {name} ON {new_table}{definition}').format(
+                unique=unique, name=Identifier(temp_name), new_table=new_table,
+                definition=SQL(index_def[index_def.index(' USING '):])
+            ))
+            renames.append(SQL('ALTER INDEX {temp_name} RENAME TO {name}').format(
+                temp_name=Identifier(schema, temp_name), name=Identifier(index_name)
+            ))
+    for constraint_name, constraint_def in info['foreign_keys']:
+        statements.append(SQL('ALTER TABLE {new_table} ADD CONSTRAINT {name} {definition}').format(
+            new_table=new_table, name=Identifier(constraint_name), definition=SQL(constraint_def)
+        ))
+    for sequence_schema, sequence, column in info['sequences']:
+        statements.append(SQL('ALTER SEQUENCE {sequence} OWNED BY {column}').format(
+            sequence=Identifier(sequence_schema, sequence), column=Identifier(schema, new_name, column)
+        ))
+    statements.append(SQL('ALTER TABLE {new_table} OWNER TO {owner}').format(
+        new_table=new_table, owner=Identifier(info['owner'])
+    ))
+    for grantee, privilege, grantable in info['grants']:
+        statements.append(SQL('GRANT {privilege} ON {new_table} TO {grantee}{grant_option}').format(
+            privilege=SQL(privilege),
+            new_table=new_table,
+            grantee=SQL('PUBLIC') if grantee is None else Identifier(grantee),
+            grant_option=SQL(' WITH GRANT OPTION') if grantable else SQL(''),
+        ))
+    statements.append(SQL('DROP TABLE {table}').format(table=table))
+    statements.append(SQL('ALTER TABLE {new_table} RENAME TO {name}').format(
+        new_table=new_table, name=Identifier(info['table'])
+    ))
+    statements.extend(renames)
+    if replica_identity is not None:
+        statements.append(SQL('ALTER TABLE {table} REPLICA IDENTITY {replica_identity}').format(
+            table=table, replica_identity=replica_identity
+        ))
+    if info['comment'] is not None:
+        statements.append(SQL('COMMENT ON TABLE {table} IS {comment}').format(
+            table=table, comment=Literal(info['comment'])
+        ))
+    statements.append(SQL('ANALYZE {table}').format(table=table))
+    return statements
+
+
+def apply_anonymized_data_by_swap(connection, temp_table, source_table, primary_key, column_names):
+    """
+    Replace a table with a rebuilt copy that contains the anonymized values (see :func:`build_swap_statements`).
+
+    Unlike an ``UPDATE`` of every row, the rebuilt table has no dead tuples. All statements run in the current
+    transaction, so the original table stays untouched until it is committed.
+
+    :param connection: A database connection instance.
+    :param str temp_table: Name of the temporary table with the anonymized data.
+    :param str source_table: Name of the table to be replaced.
+    :param str primary_key: The primary key of the table.
+    :param list[str] column_names: The anonymized columns.
+    :return: True if the table has been swapped, False if it has a feature that can't be carried over.
+    :rtype: bool
+    """
+    info = get_swap_info(connection, source_table)
+    if info['blockers']:
+        logging.info('Updating table {} instead of rebuilding it, because of its {}'.format(
+            source_table, ', '.join(info['blockers'])
+        ))
+        return False
+    cursor = connection.cursor()
+    for statement in build_swap_statements(info, temp_table, primary_key, column_names):
+        cursor.execute(statement.as_string(connection))
+    cursor.close()
+    return True
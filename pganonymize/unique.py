@@ -0,0 +1,152 @@
+"""Memory efficient generation of unique values"""
+
+from __future__ import absolute_import
+
+import math
+from hashlib import blake2b
+
+from pganonymize.exceptions import InvalidProviderArgument
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter, a set that only stores a few bits per value.
+
+    A value that has been added is always found, but a value that has not been added is found with a probability of
+    about ``error_rate`` (if no more than ``capacity`` values have been added).
+    """
+
+    def __init__(self, capacity, error_rate):
+        """
+        :param int capacity: The expected number of values.
+        :param float error_rate: The probability that a value is found although it has not been added.
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        digest = blake2b(str(value).encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        size = self.size
+        return [(first + index * second) % size for index in range(self.hash_count)]
+
+    def __contains__(self, value):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    def add(self, value):
+        """
+        Add a value, unless it has been found.
+
+        :param value: The value, it is compared by its text representation.
+        :return: True if the value has been added, False if it has been found.
+        :rtype: bool
+        """
+        positions = self._positions(value)
+        bits = self.bits
+        if all(bits[position >> 3] & (1 << (position & 7)) for position in positions):
+            return False
+        for position in positions:
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+        return True
+
+
+class ScalableBloomFilter(object):
+    """
+    A Bloom filter that grows when more values than expected are added.
+
+    When the last :class:`BloomFilter` is full, a new one with twice the capacity and half the error rate is added,
+    so the overall error rate stays below twice the ``error_rate`` for any number of values.
+    """
+
+    def __init__(self, capacity, error_rate):
+        """
+        :param int capacity: The expected number of values.
+        :param float error_rate: The probability that a value is found although it has not been added.
+        """
+        self.filters = [BloomFilter(capacity, error_rate)]
+
+    @property
+    def count(self):
+        return sum(bloom_filter.count for bloom_filter in self.filters)
+
+    def add(self, value):
+        """
+        Add a value, unless it has been found.
+
+        :param value: The value, it is compared by its text representation.
+        :return: True if the value has been added, False if it has been found.
+        :rtype: bool
+        """
+        if any(value in bloom_filter for bloom_filter in self.filters):
+            return False
+        last = self.filters[-1]
+        if last.count >= last.capacity:
+            last = BloomFilter(last.capacity * 2, last.error_rate / 2)
+            self.filters.append(last)
+        return last.add(value)
+
+
+class UniqueValues(object):
+    """
+    Generate unique values with a generator function that may return duplicates.
+
+    The generated values are remembered in a :class:`ScalableBloomFilter`. A value that is found there is generated
+    again, up to ``max_retries`` times. After that, a counter is added to the value with ``fallback_format``, e.g.
+    ``17.john@example.com``. A value that is falsely found by the filter is only retried, so no duplicates are
+    returned.
+    """
+
+    def __init__(self, generate, capacity, error_rate, max_retries, fallback_format):
+        """
+        :param generate: A function without arguments that returns a new value.
+        :param int capacity: The expected number of values.
+        :param float error_rate: The false positive rate of the filter.
+        :param int max_retries: Number of retries before a counter is added to a value.
+        :param str fallback_format: The format of a value with a counter, with the ``value`` and ``counter`` fields.
+        """
+        self.generate = generate
+        self.filter = ScalableBloomFilter(capacity, error_rate)
+        self.max_retries = max_retries
+        self.fallback_format = fallback_format
+        self.counter = 0
+        self.generated = 0
+        self.collisions = 0
+        self.fallbacks = 0
+
+    def __str__(self):
+        attempts = self.generated + self.collisions
+        return '{} unique values, {} collisions ({:.2%}), {} values with a counter'.format(
+            self.generated, self.collisions, self.collisions / attempts if attempts else 0.0, self.fallbacks
+        )
+
+    def next_value(self):
+        """
+        Return a value that has not been returned before.
+
+        :raises InvalidProviderArgument: If no unique value has been found and the value is not a string.
+        """
+        for _ in range(self.max_retries + 1):
+            value = self.generate()
+            if self.filter.add(value):
+                self.generated += 1
+                return value
+            self.collisions += 1
+        if not isinstance(value, str):
+            raise InvalidProviderArgument('Could not generate a unique value after {} retries'.format(
+                self.max_retries
+            ))
+        self.fallbacks += 1
+        while True:
+            self.counter += 1
+            candidate = self.fallback_format.format(value=value, counter=self.counter)
+            if self.filter.add(candidate):
+                self.generated += 1
+                return candidate
+            self.collisions += 1
@@ -9,18 +9,32 @@ import os
 import re
 import subprocess
 import time
+from contextlib import ExitStack
+from functools import partial
+from itertools import chain
 from typing import Optional
 
-import parmap
 import psycopg2
-import psycopg2.extras
+import psycopg2.errors
 import yaml
-from pgcopy import CopyManager
-from psycopg2.sql import SQL, Composed, Identifier
-from tqdm import trange
-
-from pganonymize.constants import DEFAULT_CHUNK_SIZE, DEFAULT_PRIMARY_KEY
-from pganonymize.providers import provider_registry
+from psycopg2.sql import SQL, Composed, Identifier, Literal
+from tqdm import tqdm
+
+from pganonymize.apply import ApplyStage
+from pganonymize.constants import (DEFAULT_CHUNK_SIZE, DEFAULT_COUNT_STRATEGY, DEFAULT_LOCK_TIMEOUT,
+                                   DEFAULT_OVERWRITE_STRATEGY, DEFAULT_PRIMARY_KEY, LOCK_RETRIES)
+from pganonymize.copy_stream import CopyReader, CopyWriter, get_column_types
+from pganonymize.exceptions import BadSchemaFormat, InvalidProviderArgument
+from pganonymize.parallel import ChunkTransformer
+from pganonymize.pipeline import Pipeline
+from pganonymize.plan import TablePlan, get_path, set_path
+from pganonymize.progress import (clear_checkpoints, clear_progress, complete_definition, create_progress_table,
+                                  get_completed_definitions, get_progress, set_progress)
+from pganonymize.pushdown import anonymize_table_with_sql
+from pganonymize.scheduler import anonymize_tables_concurrently, export_snapshot, is_table_locked
+from pganonymize.sharding import ShardedReader, get_shard_conditions
+from pganonymize.swap import apply_anonymized_data_by_swap
+from pganonymize.watermark import create_watermark_table, get_watermark, get_watermark_window, set_watermark
 
 
 def branch(tree, path, value):
@@ -71,7 +85,10 @@ def build_pg_json_object(nested_obj: dict, root_col: str) -> str:
 
 
 def anonymize_tables(
-    connection, definitions, target_schema=None, verbose=False, dry_run=False, overwrite_values_in_source_tables=False
+    connection, definitions, target_schema=None, verbose=False, dry_run=False, overwrite_values_in_source_tables=False,
+    workers=1, pipeline=False, parallel_tables=1, connection_factory=None, copy_out=False,
+    count=DEFAULT_COUNT_STRATEGY, pushdown=True, apply_batch_size=None, lock_timeout=DEFAULT_LOCK_TIMEOUT,
+    overwrite_strategy=DEFAULT_OVERWRITE_STRATEGY, resume=False, threads=1
 ):
     """
     Anonymize a list of tables according to the schema definition.
@@ -81,47 +98,232 @@ def anonymize_tables(
     :param str target_schema: Target schema where will be created or replaced anonymized table.
     :param bool verbose: Display logging information and a progress bar.
     :param bool dry_run: Script is runnin in dry-run mode, no commit expected.
+    :param int workers: Default number of worker processes that anonymize the data of a table, can be overridden
+        with the ``workers`` key of a table definition.
+    :param bool pipeline: Fetch, anonymize and import the data of a table concurrently, can be overridden with the
+        ``pipeline`` key of a table definition.
+    :param int parallel_tables: Maximum number of tables that are anonymized at the same time, each on its own
+        connection created by ``connection_factory``.
+    :param connection_factory: A callable that returns a new database connection, called with the ``snapshot``
+        keyword argument. Required to anonymize more than one table at a time.
+    :param bool copy_out: Read the data of a table with ``COPY ... TO STDOUT``, can be overridden with the
+        ``copy_out`` key of a table definition.
+    :param str count: Default strategy to count the rows of a table (see :func:`get_table_count`), can be
+        overridden with the ``count`` key of a table definition.
+    :param bool pushdown: Anonymize tables whose fields can all be expressed in SQL with a single statement (see
+        :func:`~pganonymize.pushdown.anonymize_table_with_sql`), can be overridden with the ``pushdown`` key of a
+        table definition.
+    :param int apply_batch_size: Write the anonymized data back to the source tables in committed batches of this
+        many rows (see :func:`apply_anonymized_data_in_batches`), can be overridden with the ``apply_batch_size`` key
+        of a table definition.
+    :param str lock_timeout: The lock timeout of each batch, can be overridden with the ``lock_timeout`` key of a
+        table definition.
+    :param str overwrite_strategy: How the anonymized data is written back to the source tables, ``update`` them in
+        place or rebuild and ``swap`` them (see :func:`~pganonymize.swap.apply_anonymized_data_by_swap`), can be
+        overridden with the ``overwrite_strategy`` key of a table definition.
+    :param bool resume: Commit each table definition together with a checkpoint and skip the definitions that have
+        been completed by an interrupted run. The checkpoints are removed after all tables have been anonymized.
+    :param int threads: Default number of threads that alter the values of providers releasing the GIL, e.g.
+        ``pbkdf2``, can be overridden with the ``threads`` key of a table definition.
+    """
+    parallel = bool(
+        parallel_tables and parallel_tables > 1 and connection_factory is not None and len(definitions) > 1
+    )
+    anonymize = partial(
+        anonymize_table,
+        target_schema=target_schema,
+        verbose=verbose,
+        dry_run=dry_run,
+        overwrite_values_in_source_tables=overwrite_values_in_source_tables,
+        workers=workers,
+        pipeline=pipeline,
+        connection_factory=connection_factory,
+        copy_out=copy_out,
+        count=count,
+        pushdown=pushdown,
+        apply_batch_size=apply_batch_size,
+        lock_timeout=lock_timeout,
+        overwrite_strategy=overwrite_strategy,
+        threads=threads,
+        parallel=parallel
+    )
+    if overwrite_values_in_source_tables and not dry_run and any(
+        list(definition.values())[0].get('watermark') for definition in definitions
+    ):
+        if connection_factory is None:
+            create_watermark_table(connection, commit=False)
+        else:
+            # Committing the table on this connection would also commit the truncated tables and the init SQL
+            watermark_connection = connection_factory()
+            try:
+                create_watermark_table(watermark_connection)
+            finally:
+                watermark_connection.close()
+    resume = resume and not dry_run
+    if resume:
+        create_progress_table(connection)
+        definitions = skip_completed_definitions(definitions, get_completed_definitions(connection))
+        anonymize = partial(anonymize_with_checkpoint, anonymize)
+    if parallel:
+        anonymize_tables_concurrently(
+            connection, definitions, anonymize, connection_factory, parallel_tables, dry_run=dry_run
+        )
+    else:
+        for definition in definitions:
+            anonymize(connection, definition)
+    if resume:
+        clear_checkpoints(connection)
+
+
+def skip_completed_definitions(definitions, completed):
     """
+    Remove the table definitions that have been completed by an interrupted run.
+
+    :param list definitions: A list of table definitions from the YAML schema.
+    :param dict completed: The number of completed definitions by table name, the first definitions of each table
+        are skipped.
+    :return: The remaining table definitions.
+    :rtype: list
+    """
+    remaining = dict(completed)
+    pending = []
     for definition in definitions:
-        start_time = time.time()
         table_name = list(definition.keys())[0]
-        logging.info('Found table definition "%s"', table_name)
-        table_definition = definition[table_name]
-        columns = table_definition.get('fields', [])
-        excludes = table_definition.get('excludes', [])
-        search = table_definition.get('search')
-        primary_key = table_definition.get('primary_key', DEFAULT_PRIMARY_KEY)
-        total_count = get_table_count(connection, table_name, dry_run)
-        chunk_size = table_definition.get('chunk_size', DEFAULT_CHUNK_SIZE)
-        build_and_then_import_data(
-            connection,
-            table_name,
-            primary_key,
-            columns,
-            excludes,
-            search,
-            total_count,
-            chunk_size,
-            target_schema,
-            verbose=verbose,
-            dry_run=dry_run,
-            overwrite_values_in_source_tables=overwrite_values_in_source_tables
+        if remaining.get(table_name, 0) > 0:
+            remaining[table_name] -= 1
+            logging.info('Skipping completed table definition "%s"', table_name)
+        else:
+            pending.append(definition)
+    return pending
+
+
+def anonymize_with_checkpoint(anonymize, connection, definition):
+    """
+    Anonymize a single table definition and commit it together with its checkpoint.
+
+    :param anonymize: A callable that anonymizes a single table definition on the given connection.
+    :param connection: A database connection instance.
+    :param dict definition: A table definition from the YAML schema.
+    """
+    anonymize(connection, definition)
+    complete_definition(connection, list(definition.keys())[0])
+    connection.commit()
+
+
+def anonymize_table(
+    connection, definition, target_schema=None, verbose=False, dry_run=False, overwrite_values_in_source_tables=False,
+    workers=1, pipeline=False, connection_factory=None, copy_out=False, count=DEFAULT_COUNT_STRATEGY,
+    pushdown=True, apply_batch_size=None, lock_timeout=DEFAULT_LOCK_TIMEOUT,
+    overwrite_strategy=DEFAULT_OVERWRITE_STRATEGY, threads=1, parallel=False
+):
+    """
+    Anonymize a single table according to its definition.
+
+    :param connection: A database connection instance.
+    :param dict definition: A table definition from the YAML schema.
+    :param bool parallel: Other tables are anonymized at the same time on other connections (see
+        :func:`~pganonymize.scheduler.anonymize_tables_concurrently`).
+
+    See :func:`anonymize_tables` for the remaining arguments.
+    """
+    start_time = time.time()
+    table_name = list(definition.keys())[0]
+    logging.info('Found table definition "%s"', table_name)
+    table_definition = definition[table_name]
+    columns = table_definition.get('fields', [])
+    excludes = table_definition.get('excludes', [])
+    search = table_definition.get('search')
+    primary_key = table_definition.get('primary_key', DEFAULT_PRIMARY_KEY)
+    plan = TablePlan.from_definition(table_name, table_definition)
+    apply_batch_size = table_definition.get('apply_batch_size', apply_batch_size)
+    overwrite_strategy = table_definition.get('overwrite_strategy', overwrite_strategy)
+    if not overwrite_values_in_source_tables or dry_run:
+        apply_batch_size = overwrite_strategy = None
+    if overwrite_strategy == 'swap' and parallel:
+        # The swap locks the table and the tables it references until all connections are committed, so the other
+        # connections could wait for these locks forever
+        logging.warning('Updating table {} in place, tables are not swapped with --parallel-tables'.format(table_name))
+        overwrite_strategy = 'update'
+    pushdown = table_definition.get('pushdown', pushdown) and not dry_run
+    # Only data rows that have been added or changed since the last run are anonymized
+    watermark_column = table_definition.get('watermark') if overwrite_values_in_source_tables else None
+    if watermark_column == 'xmin' and apply_batch_size and overwrite_strategy != 'swap':
+        # Every committed batch gets a newer transaction id than the watermark, so all rows would be selected again
+        raise BadSchemaFormat(
+            'The xmin watermark of table "{}" can\'t be used together with apply_batch_size'.format(table_name)
         )
-        end_time = time.time()
-        logging.info('{} anonymization took {:.2f}s'.format(table_name, end_time - start_time))
+    if watermark_column:
+        last_watermark = get_watermark(connection, table_name)
+        condition, watermark = get_watermark_window(connection, table_name, watermark_column, last_watermark, search)
+        if watermark is None or watermark == last_watermark:
+            logging.info('No new or changed rows in table {}'.format(table_name))
+            return
+        if condition:
+            search = '({}) AND {}'.format(search, condition) if search else condition
+    if overwrite_strategy == 'swap':
+        # The table is rebuilt from the temporary table in a single transaction
+        apply_batch_size = None
+        pushdown = False
+    if apply_batch_size:
+        # Data rows that have been written back by an interrupted run are already anonymized
+        resume_after = get_progress(connection, table_name)
+        if resume_after is not None:
+            logging.info('Resuming table {} after primary key {}'.format(table_name, resume_after))
+            search = get_resume_condition(connection, primary_key, resume_after, search)
+    elif pushdown and anonymize_table_with_sql(
+        connection, plan, search, target_schema, overwrite_values_in_source_tables
+    ):
+        if watermark_column:
+            set_watermark(connection, table_name, watermark)
+        logging.info('{} anonymization took {:.2f}s'.format(table_name, time.time() - start_time))
+        return
+    total_count = get_table_count(connection, table_name, dry_run, table_definition.get('count', count))
+    chunk_size = table_definition.get('chunk_size', DEFAULT_CHUNK_SIZE)
+    build_and_then_import_data(
+        connection,
+        table_name,
+        primary_key,
+        columns,
+        excludes,
+        search,
+        total_count,
+        chunk_size,
+        target_schema,
+        verbose=verbose,
+        dry_run=dry_run,
+        overwrite_values_in_source_tables=overwrite_values_in_source_tables,
+        plan=plan,
+        workers=table_definition.get('workers', workers),
+        threads=table_definition.get('threads', threads),
+        pipeline=table_definition.get('pipeline', pipeline),
+        shards=table_definition.get('shards', 1),
+        connection_factory=connection_factory,
+        copy_out=table_definition.get('copy_out', copy_out),
+        apply_batch_size=apply_batch_size,
+        lock_timeout=table_definition.get('lock_timeout', lock_timeout),
+        overwrite_strategy=overwrite_strategy,
+        apply_join=table_definition.get('apply_join', 'auto'),
+        work_mem=table_definition.get('work_mem'),
+        maintenance_work_mem=table_definition.get('maintenance_work_mem')
+    )
+    if watermark_column and not dry_run:
+        set_watermark(connection, table_name, watermark)
+    end_time = time.time()
+    logging.info('{} anonymization took {:.2f}s'.format(table_name, end_time - start_time))
 
 
 def process_row(row, columns, excludes):
-    if row_matches_excludes(row, excludes):
-        return None
-    else:
-        row_column_dict = get_column_values(row, columns)
-        if row_column_dict:
-            for key, value in row_column_dict.items():
-                row[key] = value
-        else:
-            return None
-        return row
+    """
+    Anonymize a single data row.
+
+    :param row: A data row from the current table.
+    :param columns: A list of table columns with their provider rules or an already compiled
+        :class:`~pganonymize.plan.TablePlan`.
+    :param list[dict] excludes: A list of exclude definitions (ignored if a plan is given).
+    :return: The altered row or None if the row is excluded or has nothing to alter.
+    """
+    plan = columns if isinstance(columns, TablePlan) else TablePlan(columns, excludes)
+    return plan.process_row(row)
 
 
 def build_and_then_import_data(
@@ -136,7 +338,20 @@ def build_and_then_import_data(
     target_schema: Optional[str] = None,
     verbose=False,
     dry_run=False,
-    overwrite_values_in_source_tables=False
+    overwrite_values_in_source_tables=False,
+    plan=None,
+    workers=1,
+    threads=1,
+    pipeline=False,
+    shards=1,
+    connection_factory=None,
+    copy_out=False,
+    apply_batch_size=None,
+    lock_timeout=DEFAULT_LOCK_TIMEOUT,
+    overwrite_strategy=DEFAULT_OVERWRITE_STRATEGY,
+    apply_join='auto',
+    work_mem=None,
+    maintenance_work_mem=None
 ):
     """
     Select all data from a table and return it together with a list of table columns.
@@ -147,44 +362,176 @@ def build_and_then_import_data(
     :param list columns: A list of table fields
     :param list[dict] excludes: A list of exclude definitions.
     :param str search: A SQL WHERE (search_condition) to filter and keep only the searched rows.
-    :param int total_count: The amount of rows for the current table
+    :param int total_count: The (expected) amount of rows for the current table, or None if it is unknown
     :param int chunk_size: Number of data rows to fetch with the cursor
     :param str target_schema: Name of the pg schema of target table.
     :param bool verbose: Display logging information and a progress bar.
     :param bool dry_run: Script is running in dry-run mode, no commit expected.
+    :param pganonymize.plan.TablePlan plan: The compiled table plan, built from ``columns`` and ``excludes`` if
+        not given.
+    :param int workers: Number of worker processes that anonymize the fetched chunks, the chunks are anonymized in
+        the current process if it's lower than 2.
+    :param int threads: Number of threads in each process that alter the values of providers releasing the GIL (see
+        :meth:`~pganonymize.plan.TablePlan.start_threads`), no threads are used if it's lower than 2.
+    :param bool pipeline: Run the fetch, transform and import stages concurrently (see
+        :class:`~pganonymize.pipeline.Pipeline`). The data is read on a connection created by ``connection_factory``,
+        because the import runs on ``connection`` at the same time.
+    :param int shards: Split the table by its primary key and read the shards concurrently, each on its own
+        connection created by ``connection_factory`` (see :class:`~pganonymize.sharding.ShardedReader`).
+    :param connection_factory: A callable that returns a new database connection, called with the ``snapshot``
+        keyword argument. It isn't used to read a table that has been modified or locked in the current transaction
+        (see :func:`~pganonymize.scheduler.is_table_locked`), e.g. by a truncate or an earlier table definition.
+    :param bool copy_out: Read the data with ``COPY ... TO STDOUT WITH BINARY`` on a connection created by
+        ``connection_factory`` (see :class:`~pganonymize.copy_stream.CopyReader`). The server side cursor is used
+        as a fallback if one of the selected columns has an unsupported type.
+    :param int apply_batch_size: Write the anonymized data back in committed batches of this many rows (see
+        :func:`apply_anonymized_data_in_batches`), only used if ``overwrite_values_in_source_tables`` is set.
+    :param str lock_timeout: The lock timeout of each batch.
+    :param str overwrite_strategy: Rebuild the table and swap it with the original one if it's ``swap`` (see
+        :func:`~pganonymize.swap.apply_anonymized_data_by_swap`), only used if ``overwrite_values_in_source_tables``
+        is set. Tables that can't be rebuilt are updated in place.
+    :param str apply_join: How the anonymized data is joined with the source table, ``index``, ``hash`` or ``auto``
+        (see :class:`~pganonymize.apply.ApplyStage`), batched updates always use an index.
+    :param str work_mem: The ``work_mem`` setting while the anonymized data is written back to the source table.
+    :param str maintenance_work_mem: The ``maintenance_work_mem`` setting while the anonymized data is written back to
+        the source table.
     """
+    if plan is None:
+        plan = TablePlan(columns, excludes, primary_key, table, chunk_size)
+    if workers and workers > 1:
+        for column in plan.columns:
+            if column.provider.unique:
+                raise InvalidProviderArgument(
+                    'The unique values of field "{}" of table {} can\'t be generated by several workers'.format(
+                        column.full_name, table
+                    )
+                )
     column_names = get_column_names(columns)
     sql_columns = SQL(', ').join([Identifier(column_name) for column_name in [primary_key] + column_names])
-    sql_select = SQL('SELECT {columns} FROM {table}').format(table=Identifier(table), columns=sql_columns)
+    sql_select = sql_select_all = SQL('SELECT {columns} FROM {table}').format(
+        table=Identifier(table), columns=sql_columns
+    )
     if search:
         sql_select = Composed([sql_select, SQL(" WHERE {search_condition}".format(search_condition=search))])
     if dry_run:
         sql_select = Composed([sql_select, SQL(" LIMIT 100")])
         logging.info(sql_select.as_string(connection))
-    cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor, name='fetch_large_result')
-    cursor.execute(sql_select.as_string(connection))
+    batches = None if total_count is None else int(math.ceil((1.0 * total_count) / (1.0 * chunk_size)))
+    cursor = records = shard_conditions = None
+    if connection_factory is not None and (pipeline or copy_out or (shards and shards > 1)) and is_table_locked(
+        connection, table
+    ):
+        # Other connections would neither see the changes of this transaction nor get past its locks
+        if pipeline:
+            raise BadSchemaFormat(
+                'The pipeline of table "{}" can\'t read the table, it has been modified or locked in this '
+                'transaction'.format(table)
+            )
+        logging.info('Reading {} with the cursor, it has been modified or locked in this transaction'.format(table))
+        connection_factory = None
+    if shards and shards > 1 and connection_factory is not None and not dry_run:
+        shard_conditions = get_shard_conditions(connection, table, primary_key, shards, search)
+    if shard_conditions:
+        snapshot = export_snapshot(connection)
+        sql_where = SQL(" WHERE ({search_condition}) AND ".format(search_condition=search) if search else " WHERE ")
+        queries = [
+            Composed([sql_select_all, sql_where, condition]).as_string(connection)
+            for condition in shard_conditions
+        ]
+        records = ShardedReader(connection_factory, snapshot, queries, chunk_size)
+    elif copy_out and connection_factory is not None:
+        table_types = get_column_types(connection, table)
+        column_types = [table_types.get(column_name) for column_name in [primary_key] + column_names]
+        if CopyReader.supports(column_types):
+            records = CopyReader(
+                connection_factory, export_snapshot(connection), sql_select.as_string(connection), column_types,
+                chunk_size
+            )
+        else:
+            logging.info('Falling back to the cursor for {}, not all column types are supported'.format(table))
+    if records is None and pipeline:
+        # The fetches of a cursor would collide with the COPY of the writer stage on the same connection
+        if connection_factory is None:
+            raise BadSchemaFormat(
+                'The pipeline of table "{}" needs a connection factory to read the data on its own connection'.format(
+                    table
+                )
+            )
+        records = ShardedReader(
+            connection_factory, export_snapshot(connection), [sql_select.as_string(connection)], chunk_size
+        )
+    if records is None:
+        cursor = connection.cursor(name='fetch_large_result')
+        cursor.execute(sql_select.as_string(connection))
+        records = fetch_chunks(cursor, chunk_size)
     temp_table = 'tmp_{table}'.format(table=table)
     create_temporary_table(connection, columns, table, temp_table, primary_key)
-    batches = int(math.ceil((1.0 * total_count) / (1.0 * chunk_size)))
-    for i in trange(batches, desc="Processing {} batches for {}".format(batches, table), disable=not verbose):
-        records = cursor.fetchmany(size=chunk_size)
-        if records:
-            data = parmap.map(process_row, records, columns, excludes, pm_pbar=verbose, pm_parallel=False)
-            import_data(connection, temp_table, [primary_key] + column_names, filter(None, data))
-    if overwrite_values_in_source_tables:
-        apply_anonymized_data_to_current_table(connection, temp_table, table, primary_key, columns)
-    else:
+    chunks = tqdm(
+        records,
+        total=batches,
+        desc="Processing {} batches for {}".format('all' if batches is None else batches, table),
+        disable=not verbose
+    )
+    writer = CopyWriter(connection, temp_table, [primary_key] + column_names)
+    transformer = None
+    with ExitStack() as stack:
+        if workers and workers > 1:
+            transformer = stack.enter_context(ChunkTransformer(plan, workers, threads))
+            transform = transformer.imap
+        else:
+            if threads and threads > 1:
+                stack.enter_context(plan.start_threads(threads))
+            transform = plan.process_chunks
+        if pipeline:
+            Pipeline().run(chunks, transform, writer.copy)
+        elif cursor is None:
+            # The rows are read on other connections, so a single COPY can stream all of them
+            writer.copy(chain.from_iterable(transform(chunks)))
+        else:
+            for data in transform(chunks):
+                writer.copy(data)
+    # The caches and providers of worker processes are not shared with the current process
+    plan.log_statistics(None if transformer is None else transformer.get_statistics())
+    if cursor is not None:
+        # An open cursor on the table would prevent it from being dropped
+        cursor.close()
+    if not overwrite_values_in_source_tables:
         apply_anonymized_data_to_new_table(connection, target_schema, temp_table, table, primary_key, columns)
-    cursor.close()
+        return
+    if apply_batch_size and overwrite_strategy != 'swap':
+        # The batches are selected by primary key ranges of the temporary table
+        apply_join = 'index'
+    with ApplyStage(connection, temp_table, table, primary_key, apply_join, work_mem, maintenance_work_mem):
+        if overwrite_strategy == 'swap' and apply_anonymized_data_by_swap(
+            connection, temp_table, table, primary_key, column_names
+        ):
+            logging.info('Replaced table {} with its anonymized copy'.format(table))
+        elif apply_batch_size:
+            apply_anonymized_data_in_batches(
+                connection, temp_table, table, primary_key, columns, apply_batch_size, lock_timeout
+            )
+        else:
+            apply_anonymized_data_to_current_table(connection, temp_table, table, primary_key, columns)
+
+
+def fetch_chunks(cursor, chunk_size):
+    """
+    Fetch the data rows of a cursor in chunks, until the cursor is exhausted.
+
+    :param cursor: A cursor with an executed select statement.
+    :param int chunk_size: Number of data rows to fetch at once.
+    :return: A generator with all non-empty chunks.
+    """
+    while True:
+        records = cursor.fetchmany(size=chunk_size)
+        if not records:
+            return
+        yield records
 
 
 def apply_anonymized_data_to_current_table(connection, temp_table, source_table, primary_key, definitions):
     logging.info('Applying changes on table {}'.format(source_table))
     cursor = connection.cursor()
-    create_index_sql = SQL('CREATE INDEX ON {temp_table} ({primary_key})')
-    sql = create_index_sql.format(temp_table=Identifier(temp_table), primary_key=Identifier(primary_key))
-    cursor.execute(sql.as_string(connection))
-
     column_names = get_column_names(definitions)
     columns_identifiers = [SQL('{column} = s.{column}').format(column=Identifier(column)) for column in column_names]
     set_columns = SQL(', ').join(columns_identifiers)
@@ -204,6 +551,101 @@ def apply_anonymized_data_to_current_table(connection, temp_table, source_table,
     cursor.close()
 
 
+def apply_anonymized_data_in_batches(connection, temp_table, source_table, primary_key, definitions, batch_size,
+                                     lock_timeout=DEFAULT_LOCK_TIMEOUT, retries=LOCK_RETRIES):
+    """
+    Write the anonymized data back to the source table in batches of primary key ranges.
+
+    The temporary table needs an index on its primary key (see :class:`~pganonymize.apply.ApplyStage`).
+
+    Each batch is committed together with its progress (see :mod:`pganonymize.progress`), so the row locks are only
+    held for a single batch and an interrupted run only repeats its current batch. A batch that can't get its locks
+    within ``lock_timeout`` is rolled back and retried up to ``retries`` times.
+
+    :param connection: A database connection instance.
+    :param str temp_table: Name of the temporary table with the anonymized data.
+    :param str source_table: Name of the table to be updated.
+    :param str primary_key: The primary key of the table.
+    :param list definitions: A list of field definitions from the YAML schema.
+    :param int batch_size: Number of data rows updated in one transaction.
+    :param str lock_timeout: The lock timeout of each batch, e.g. ``5s``.
+    :param int retries: Number of retries of a batch after its lock timeout has expired.
+    """
+    logging.info('Applying changes on table {} in batches of {} rows'.format(source_table, batch_size))
+    # The temporary table has to survive a rolled back batch
+    connection.commit()
+    create_progress_table(connection)
+
+    column_names = get_column_names(definitions)
+    sql_args = {
+        "table": Identifier(source_table),
+        "columns": SQL(', ').join(
+            SQL('{column} = s.{column}').format(column=Identifier(column)) for column in column_names
+        ),
+        "source": Identifier(temp_table),
+        "primary_key": Identifier(primary_key),
+    }
+    # Not every primary key type has a max() aggregate (e.g. uuid), so the batch is sorted again
+    next_sql = SQL(
+        'SELECT {primary_key} FROM '
+        '(SELECT {primary_key} FROM {source} WHERE %(last)s IS NULL OR {primary_key} > %(last)s '
+        'ORDER BY {primary_key} LIMIT %(limit)s) b ORDER BY {primary_key} DESC LIMIT 1'
+    ).format(**sql_args).as_string(connection)
+    update_sql = SQL(
+        'UPDATE {table} t '
+        'SET {columns} '
+        'FROM {source} s '
+        'WHERE t.{primary_key} = s.{primary_key} AND (%(last)s IS NULL OR s.{primary_key} > %(last)s) '
+        'AND s.{primary_key} <= %(upper)s'
+    ).format(**sql_args).as_string(connection)
+    last = None
+    while True:
+        cursor = connection.cursor()
+        cursor.execute(next_sql, {'last': last, 'limit': batch_size})
+        row = cursor.fetchone()
+        cursor.close()
+        if row is None:
+            break
+        upper = row[0]
+        for attempt in range(retries + 1):
+            cursor = connection.cursor()
+            try:
+                cursor.execute('SET LOCAL lock_timeout = %s', (lock_timeout,))
+                cursor.execute(update_sql, {'last': last, 'upper': upper})
+                set_progress(connection, source_table, upper)
+                connection.commit()
+                break
+            except psycopg2.errors.LockNotAvailable:
+                connection.rollback()
+                if attempt == retries:
+                    raise
+                logging.info('Lock timeout on table {}, retrying batch up to {}'.format(source_table, upper))
+                time.sleep(2 ** attempt)
+            finally:
+                cursor.close()
+        last = upper
+    clear_progress(connection, source_table)
+    connection.commit()
+
+
+def get_resume_condition(connection, primary_key, resume_after, search=None):
+    """
+    Return a search condition that skips all data rows up to the given primary key.
+
+    :param connection: A database connection instance.
+    :param str primary_key: The primary key of the table.
+    :param str resume_after: The primary key (as text) of the last data row that has been written back.
+    :param str search: The SQL WHERE (search_condition) of the table definition.
+    :rtype: str
+    """
+    condition = SQL('{primary_key} > {last}').format(
+        primary_key=Identifier(primary_key), last=Literal(resume_after)
+    ).as_string(connection)
+    if search:
+        return '({}) AND {}'.format(search, condition)
+    return condition
+
+
 def apply_anonymized_data_to_new_table(connection, target_schema, temp_table, source_table, primary_key, definitions):
     logging.info('Applying changes on table {}'.format(source_table))
     cursor = connection.cursor()
@@ -279,8 +721,8 @@ def import_data(connection, table_name, column_names, data):
     :param list column_names: A list of table fields
     :param list data: The table data.
     """
-    mgr = CopyManager(connection, table_name, column_names)
-    mgr.copy([[escape_str_replace(val) for col, val in row.items()] for row in data])
+    writer = CopyWriter(connection, table_name, column_names)
+    writer.copy(row.values() if isinstance(row, dict) else row for row in data)
 
 
 def get_connection(pg_args):
@@ -294,25 +736,38 @@ def get_connection(pg_args):
     return psycopg2.connect(**pg_args)
 
 
-def get_table_count(connection, table, dry_run):
+def get_table_count(connection, table, dry_run, strategy=DEFAULT_COUNT_STRATEGY):
     """
     Return the number of table entries.
 
+    The count is only used for the progress bar, the data rows are fetched until the cursor is exhausted.
+
     :param connection: A database connection instance
     :param str table: Name of the database table
     :param bool dry_run: Script is running in dry-run mode, no commit expected.
-    :return: The number of table entries
+    :param str strategy: ``exact`` counts the rows with ``SELECT COUNT(*)``, ``estimate`` uses the row estimate of the
+        ``pg_class`` catalog and ``none`` doesn't count at all.
+    :return: The number of table entries, or None if it is unknown
     :rtype: int
     """
     if dry_run:
         return 100
-    else:
-        sql = SQL('SELECT COUNT(*) FROM {table}').format(table=Identifier(table))
-        cursor = connection.cursor()
-        cursor.execute(sql.as_string(connection))
-        total_count = cursor.fetchone()[0]
+    if strategy == 'none':
+        return None
+    cursor = connection.cursor()
+    if strategy == 'estimate':
+        cursor.execute('SELECT reltuples FROM pg_class WHERE oid = to_regclass(quote_ident(%s))', (table,))
+        row = cursor.fetchone()
         cursor.close()
-        return total_count
+        # Tables that have never been vacuumed or analyzed have an estimate of -1 (or 0 before PostgreSQL 14)
+        if row is None or row[0] is None or row[0] < 0:
+            return None
+        return int(row[0])
+    sql = SQL('SELECT COUNT(*) FROM {table}').format(table=Identifier(table))
+    cursor.execute(sql.as_string(connection))
+    total_count = cursor.fetchone()[0]
+    cursor.close()
+    return total_count
 
 
 def get_column_values(row, columns):
@@ -320,7 +775,8 @@ def get_column_values(row, columns):
     Return a dictionary for a single data row, with altered data.
 
     :param psycopg2.extras.DictRow row: A data row from the current table to be altered
-    :param list columns: A list of table columns with their provider rules, e.g.:
+    :param list columns: A list of table columns with their provider rules or an already compiled
+        :class:`~pganonymize.plan.TablePlan`, e.g.:
 
     >>> [
     >>>     {'guest_email': {'append': '@localhost', 'provider': 'md5'}}
@@ -330,26 +786,8 @@ def get_column_values(row, columns):
         {'guest_email': '12faf5a9bb6f6f067608dca3027c8fcb@localhost'}
     :rtype: dict
     """
-    column_dict = {}
-    for definition in columns:
-        full_column_name = get_column_name(definition, True)
-        column_name = get_column_name(definition, False)
-        column_definition = definition[full_column_name]
-        provider_config = column_definition.get('provider')
-        orig_value = nested_get(row, full_column_name)
-        # Skip the current column if there is no value to be altered
-        if orig_value is not None:
-            provider = provider_registry.get_provider(provider_config['name'])(**provider_config)
-            value = provider.alter_value(orig_value)
-            append = column_definition.get('append')
-            if append:
-                value = value + append
-            format = column_definition.get('format')
-            if format:
-                value = format.format(pga_value=value, **row)
-            nested_set(row, full_column_name, value)
-            column_dict[column_name] = nested_get(row, column_name)
-    return column_dict
+    plan = columns if isinstance(columns, TablePlan) else TablePlan(columns)
+    return plan.get_column_values(row)
 
 
 def truncate_tables(connection, tables):
@@ -439,13 +877,7 @@ def nested_get(dic, path, delimiter='.'):
     :return: Value at path
     :rtype: unknown
     """
-    try:
-        keys = path.split(delimiter)
-        for key in keys[:-1]:
-            dic = dic.get(key, {})
-        return dic[keys[-1]]
-    except (AttributeError, KeyError, TypeError):
-        return None
+    return get_path(dic, path.split(delimiter))
 
 
 def nested_set(dic, path, value, delimiter='.'):
@@ -456,10 +888,7 @@ def nested_set(dic, path, value, delimiter='.'):
     :value unknow Value to be set
     :delimiter string Path delimiter
     """
-    keys = path.split(delimiter)
-    for key in keys[:-1]:
-        dic = dic.get(key, {})
-    dic[keys[-1]] = value
+    set_path(dic, path.split(delimiter), value)
 
 
 def load_config(schema: str) -> dict:
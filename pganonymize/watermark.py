@@ -0,0 +1,121 @@
+"""Watermarks of incrementally anonymized tables"""
+
+from __future__ import absolute_import
+
+import logging
+
+import psycopg2.errors
+from psycopg2.sql import SQL, Identifier, Literal
+
+from pganonymize.constants import WATERMARK_TABLE
+
+XID_MODULUS = 2 ** 32
+"""Transaction ids in the ``xmin`` system column are 32 bit numbers, unlike ``txid_current()``."""
+
+
+def create_watermark_table(connection, commit=True):
+    """
+    Create the table that stores the watermark of each incrementally anonymized table, if it does not exist yet.
+
+    :param connection: A database connection instance.
+    :param bool commit: Create the table in its own transaction, which is committed, so it can be used by all
+        connections. Otherwise it is created in the current transaction of the connection.
+    """
+    cursor = connection.cursor()
+    cursor.execute('SELECT to_regclass(%s)', (WATERMARK_TABLE,))
+    exists = cursor.fetchone()[0] is not None
+    if not exists:
+        sql = SQL('CREATE TABLE IF NOT EXISTS {table} (table_name text PRIMARY KEY, watermark text NOT NULL)').format(
+            table=Identifier(WATERMARK_TABLE)
+        )
+        if not commit:
+            cursor.execute(sql.as_string(connection))
+        else:
+            try:
+                cursor.execute(sql.as_string(connection))
+                connection.commit()
+            except (psycopg2.errors.UniqueViolation, psycopg2.errors.DuplicateTable):
+                # Another connection has created the table at the same time
+                connection.rollback()
+    cursor.close()
+
+
+def get_watermark(connection, table):
+    """
+    Return the watermark of the last successful run of a table.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table.
+    :return: The watermark (as text) or None if the table has not been anonymized incrementally yet.
+    :rtype: str
+    """
+    cursor = connection.cursor()
+    cursor.execute('SELECT to_regclass(%s)', (WATERMARK_TABLE,))
+    if cursor.fetchone()[0] is None:
+        cursor.close()
+        return None
+    sql = SQL('SELECT watermark FROM {table} WHERE table_name = %s').format(table=Identifier(WATERMARK_TABLE))
+    cursor.execute(sql.as_string(connection), (table,))
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0] if row else None
+
+
+def set_watermark(connection, table, watermark):
+    """
+    Store the watermark of a table, it is committed together with the anonymized data.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table.
+    :param watermark: The watermark, it is stored as text.
+    """
+    sql = SQL(
+        'INSERT INTO {table} (table_name, watermark) VALUES (%s, %s) '
+        'ON CONFLICT (table_name) DO UPDATE SET watermark = EXCLUDED.watermark'
+    ).format(table=Identifier(WATERMARK_TABLE))
+    cursor = connection.cursor()
+    cursor.execute(sql.as_string(connection), (table, str(watermark)))
+    cursor.close()
+
+
+def get_watermark_window(connection, table, column, last_watermark=None, search=None):
+    """
+    Return the condition for the data rows that have been added or changed since the last watermark.
+
+    For a regular column, e.g. ``updated_at`` or a monotonic id, the new watermark is the current maximum of the
+    column and the window ends there, so rows that are added while the table is anonymized are left for the next run.
+    For ``xmin`` the new watermark is the id of the current transaction, whose own updates are thereby excluded from
+    the next run. After a transaction id wraparound all rows are selected again.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table.
+    :param str column: The watermark column or ``xmin``.
+    :param str last_watermark: The watermark of the last run or None to select all data rows.
+    :param str search: The SQL WHERE (search_condition) of the table definition.
+    :return: A tuple of the condition (None for all rows) and the new watermark (None if the table has no rows).
+    :rtype: tuple
+    """
+    cursor = connection.cursor()
+    if column == 'xmin':
+        cursor.execute('SELECT txid_current() %% %s', (XID_MODULUS,))
+        watermark = str(cursor.fetchone()[0])
+        cursor.close()
+        if last_watermark is None:
+            return None, watermark
+        if int(last_watermark) > int(watermark):
+            logging.info('Transaction ids of table {} have wrapped around, selecting all rows'.format(table))
+            return None, watermark
+        condition = SQL('xmin::text::bigint > {last}').format(last=Literal(int(last_watermark)))
+        return condition.as_string(connection), watermark
+    sql = SQL('SELECT max({column})::text FROM {table}').format(column=Identifier(column), table=Identifier(table))
+    if search:
+        sql = SQL('{sql} WHERE {search}').format(sql=sql, search=SQL(search))
+    cursor.execute(sql.as_string(connection))
+    watermark = cursor.fetchone()[0]
+    cursor.close()
+    if last_watermark is None or watermark is None:
+        return None, watermark
+    condition = SQL('{column} > {last} AND {column} <= {watermark}').format(
+        column=Identifier(column), last=Literal(last_watermark), watermark=Literal(watermark)
+    )
+    return condition.as_string(connection), watermark
@@ -0,0 +1,49 @@
+import pytest
+from mock import call, patch
+
+from pganonymize.apply import ApplyStage, choose_join
+from tests.utils import get_connection, quote_ident
+
+
+@pytest.mark.parametrize("temp_rows, source_rows, expected", [
+    [10, 1000, "index"],
+    [100, 1000, "hash"],
+    [100, -1, "hash"],
+    [0, 0, "index"],
+])
+def test_choose_join(temp_rows, source_rows, expected):
+    connection, cursor = get_connection([(temp_rows, source_rows)])
+    assert choose_join(connection, "tmp_auth_user", "auth_user") == expected
+    assert cursor.execute.call_args[0][1] == ("tmp_auth_user", "auth_user")
+
+
+@patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+class TestApplyStage:
+    def test_index_join(self, quote_ident):
+        connection, cursor = get_connection([("4MB", "4MB")])
+        with ApplyStage(connection, "tmp_auth_user", "auth_user", "id", join="index", work_mem="256MB") as stage:
+            assert stage.join == "index"
+        assert cursor.execute.call_args_list == [
+            call("SELECT current_setting(%s), set_config(%s, %s, false)", ("work_mem", "work_mem", "256MB")),
+            call('ANALYZE "tmp_auth_user"'),
+            call('CREATE INDEX ON "tmp_auth_user" ("id")'),
+            call("SELECT set_config(%s, %s, false)", ("work_mem", "4MB")),
+        ]
+
+    def test_hash_join(self, quote_ident):
+        connection, cursor = get_connection([(100, 1000), ("on", "off"), ("on", "off")])
+        with ApplyStage(connection, "tmp_auth_user", "auth_user", "id") as stage:
+            assert stage.join == "hash"
+        executed = [args[0][0] for args in cursor.execute.call_args_list]
+        assert 'CREATE INDEX ON "tmp_auth_user" ("id")' not in executed
+        assert cursor.execute.call_args_list[-2:] == [
+            call("SELECT set_config(%s, %s, false)", ("enable_mergejoin", "on")),
+            call("SELECT set_config(%s, %s, false)", ("enable_nestloop", "on")),
+        ]
+
+    def test_no_restore_after_error(self, quote_ident):
+        connection, cursor = get_connection([("4MB", "4MB")])
+        with pytest.raises(ValueError):
+            with ApplyStage(connection, "tmp_auth_user", "auth_user", "id", join="index", work_mem="256MB"):
+                raise ValueError()
+        assert cursor.execute.call_count == 3
@@ -0,0 +1,38 @@
+from mock import Mock
+
+from pganonymize.cache import ValueCache
+
+
+class TestValueCache:
+    def test_alter_value(self):
+        cache = ValueCache(2)
+        alter_value = Mock(side_effect=lambda value: value.upper())
+        assert [cache.alter_value(alter_value, value) for value in ["a", "b", "a", "c", "b"]] == [
+            "A", "B", "A", "C", "B"
+        ]
+        assert alter_value.call_count == 4
+        assert (cache.hits, cache.misses, cache.evictions) == (1, 4, 2)
+        assert list(cache.values) == ["c", "b"]
+
+    def test_alter_values(self):
+        cache = ValueCache(10)
+        alter_values = Mock(side_effect=lambda values: [value.upper() for value in values])
+        assert cache.alter_values(alter_values, ["a", "b", "a"]) == ["A", "B", "A"]
+        assert cache.alter_values(alter_values, ["b", "c"]) == ["B", "C"]
+        assert [args[0][0] for args in alter_values.call_args_list] == [["a", "b"], ["c"]]
+        assert (cache.hits, cache.misses, cache.evictions) == (2, 3, 0)
+        assert str(cache) == "2 hits, 3 misses, 0 evictions, hit rate 40.0%"
+
+    def test_alter_values_evictions(self):
+        cache = ValueCache(2)
+        alter_values = Mock(side_effect=lambda values: [value.upper() for value in values])
+        assert cache.alter_values(alter_values, ["a", "b", "c"]) == ["A", "B", "C"]
+        assert list(cache.values) == ["b", "c"]
+        assert cache.evictions == 1
+
+    def test_uncacheable_values(self):
+        cache = ValueCache(10)
+        alter_values = Mock(side_effect=lambda values: [len(value) for value in values])
+        assert cache.alter_values(alter_values, [{"a": 1}, "ab", ["a", "b", "c"]]) == [1, 2, 3]
+        assert cache.alter_value(len, {"a": 1}) == 1
+        assert list(cache.values) == ["ab"]
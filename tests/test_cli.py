@@ -4,7 +4,7 @@ from argparse import Namespace
 import pytest
 from mock import Mock, call, patch
 
-from pganonymize.cli import get_arg_parser, main
+from pganonymize.cli import get_arg_parser, init_connection, main
 from pganonymize.exceptions import BadSchemaFormat
 from tests.utils import quote_ident
 
@@ -30,6 +30,17 @@ class TestCli:
                     dry_run=False,
                     dump_file=None,
                     init_sql="set work_mem='1GB'",
+                    workers=1,
+                    threads=1,
+                    parallel_tables=1,
+                    count="exact",
+                    pushdown=True,
+                    apply_batch_size=None,
+                    lock_timeout="5s",
+                    overwrite_strategy="update",
+                    resume=False,
+                    copy_out=False,
+                    pipeline=False,
                 ),  # noqa
                 [
                     call("SET search_path TO db;"),
@@ -44,6 +55,12 @@ class TestCli:
                         '                    FROM "auth_user" WITH NO DATA'
                     ),
                     # noqa
+                    call('ANALYZE "tmp_auth_user"'),
+                    call(
+                        'SELECT (SELECT reltuples FROM pg_class WHERE oid = to_regclass(quote_ident(%s))), '
+                        '(SELECT reltuples FROM pg_class WHERE oid = to_regclass(quote_ident(%s)))',
+                        ("tmp_auth_user", "auth_user")
+                    ),
                     call('CREATE INDEX ON "tmp_auth_user" ("id")'),
                     call(
                         'UPDATE "auth_user" t '
@@ -69,6 +86,17 @@ class TestCli:
                     dry_run=True,
                     dump_file=None,
                     init_sql="set work_mem='1GB'",
+                    workers=1,
+                    threads=1,
+                    parallel_tables=1,
+                    count="exact",
+                    pushdown=True,
+                    apply_batch_size=None,
+                    lock_timeout="5s",
+                    overwrite_strategy="update",
+                    resume=False,
+                    copy_out=False,
+                    pipeline=False,
                 ),  # noqa
                 [
                     call("SET search_path TO db;"),
@@ -81,6 +109,12 @@ class TestCli:
                         'CREATE TEMP TABLE "tmp_auth_user" AS SELECT "id", "first_name", "last_name", "email"\n'
                         '                    FROM "auth_user" WITH NO DATA'
                     ),
+                    call('ANALYZE "tmp_auth_user"'),
+                    call(
+                        'SELECT (SELECT reltuples FROM pg_class WHERE oid = to_regclass(quote_ident(%s))), '
+                        '(SELECT reltuples FROM pg_class WHERE oid = to_regclass(quote_ident(%s)))',
+                        ("tmp_auth_user", "auth_user")
+                    ),
                     call('CREATE INDEX ON "tmp_auth_user" ("id")'),
                     call(
                         'UPDATE "auth_user" t '
@@ -107,6 +141,17 @@ class TestCli:
                     dry_run=False,
                     dump_file="./dump.sql",
                     init_sql="set work_mem='1GB'",
+                    workers=1,
+                    threads=1,
+                    parallel_tables=1,
+                    count="exact",
+                    pushdown=True,
+                    apply_batch_size=None,
+                    lock_timeout="5s",
+                    overwrite_strategy="update",
+                    resume=False,
+                    copy_out=False,
+                    pipeline=False,
                 ),
                 [
                     call("SET search_path TO db;"),
@@ -120,6 +165,12 @@ class TestCli:
                         'CREATE TEMP TABLE "tmp_auth_user" AS SELECT "id", "first_name", "last_name", "email"\n'
                         '                    FROM "auth_user" WITH NO DATA'
                     ),
+                    call('ANALYZE "tmp_auth_user"'),
+                    call(
+                        'SELECT (SELECT reltuples FROM pg_class WHERE oid = to_regclass(quote_ident(%s))), '
+                        '(SELECT reltuples FROM pg_class WHERE oid = to_regclass(quote_ident(%s)))',
+                        ("tmp_auth_user", "auth_user")
+                    ),
                     call('CREATE INDEX ON "tmp_auth_user" ("id")'),
                     call(
                         'UPDATE "auth_user" t '
@@ -149,6 +200,17 @@ class TestCli:
                     dry_run=False,
                     dump_file=None,
                     init_sql=False,
+                    workers=1,
+                    threads=1,
+                    parallel_tables=1,
+                    count="exact",
+                    pushdown=True,
+                    apply_batch_size=None,
+                    lock_timeout="5s",
+                    overwrite_strategy="update",
+                    resume=False,
+                    copy_out=False,
+                    pipeline=False,
                 ),
                 [],
                 0,
@@ -171,7 +233,7 @@ class TestCli:
         parsed_args = arg_parser.parse_args(shlex.split(cli_args))
         assert parsed_args == expected
         mock_cursor = Mock()
-        mock_cursor.fetchone.return_value = [0]
+        mock_cursor.fetchone.return_value = (0, 0)
         mock_cursor.fetchmany.return_value = None
 
         connection = Mock()
@@ -199,3 +261,17 @@ class TestCli:
         with pytest.raises(BadSchemaFormat) as exc_info:
             main(parsed_args)
         assert exc_info.value.args[0] == exc_text
+
+
+class TestInitConnection:
+    def test_snapshot(self):
+        mock_cursor = Mock()
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+        init_connection(connection, "public", "set work_mem='1GB'", snapshot="00000003-1")
+        connection.set_session.assert_called_once()
+        assert mock_cursor.execute.call_args_list == [
+            call("SET TRANSACTION SNAPSHOT %s", ("00000003-1",)),
+            call("SET search_path TO public;"),
+            call("set work_mem='1GB'"),
+        ]
@@ -0,0 +1,244 @@
+import struct
+from datetime import date, datetime, timezone
+from uuid import UUID
+
+import pytest
+from mock import Mock, patch
+
+from pganonymize.copy_stream import (BINARY_HEADER, BINARY_SIGNATURE, BinaryCopyParser, CopyInStream, CopyReader,
+                                     CopyWriter, get_column_types, get_decoders, get_encoders)
+from tests.utils import quote_ident
+
+
+def field(data):
+    if data is None:
+        return struct.pack(">i", -1)
+    return struct.pack(">i", len(data)) + data
+
+
+def build_stream(rows):
+    stream = BINARY_SIGNATURE + struct.pack(">ii", 0, 0)
+    for row in rows:
+        stream += struct.pack(">h", len(row)) + b"".join(field(data) for data in row)
+    return stream + struct.pack(">h", -1)
+
+
+ROWS = [
+    (struct.pack(">i", 1), b"foo"),
+    (struct.pack(">i", 2), None),
+    (struct.pack(">i", 3), u"b\xe4r".encode("utf8")),
+]
+EXPECTED = [(1, "foo"), (2, None), (3, u"b\xe4r")]
+
+
+class TestGetDecoders:
+    @pytest.mark.parametrize("type_name, data, expected", [
+        ("bool", b"\x01", True),
+        ("int2", struct.pack(">h", -2), -2),
+        ("int8", struct.pack(">q", 2 ** 40), 2 ** 40),
+        ("float8", struct.pack(">d", 1.5), 1.5),
+        ("varchar", b"foo", "foo"),
+        ("uuid", b"\x12" * 16, "12121212-1212-1212-1212-121212121212"),
+        ("date", struct.pack(">i", 1), date(2000, 1, 2)),
+        ("date", struct.pack(">i", 0x7FFFFFFF), date.max),
+        ("timestamp", struct.pack(">q", 1000000), datetime(2000, 1, 1, 0, 0, 1)),
+        ("timestamptz", struct.pack(">q", 0), datetime(2000, 1, 1, tzinfo=timezone.utc)),
+        ("json", b'{"a": 1}', {"a": 1}),
+        ("jsonb", b'\x01{"a": 1}', {"a": 1}),
+    ])
+    def test(self, type_name, data, expected):
+        assert get_decoders("utf8")[type_name](data) == expected
+
+
+class TestGetEncoders:
+    @pytest.mark.parametrize("type_name, value", [
+        ("int2", -2),
+        ("int4", 2 ** 20),
+        ("int8", 2 ** 40),
+        ("float4", 1.5),
+        ("text", u"b\xe4r"),
+        ("date", date(1970, 1, 1)),
+        ("date", date.min),
+        ("timestamp", datetime(2000, 1, 1, 0, 0, 1)),
+        ("json", {"a": [1, 2]}),
+    ])
+    def test_round_trip(self, type_name, value):
+        data = get_encoders("utf8")[type_name](value)
+        assert get_decoders("utf8")[type_name](data) == value
+
+
+class TestGetColumnTypes:
+    def test(self):
+        cursor = Mock()
+        cursor.fetchall.return_value = [("id", "int4"), ("name", "text")]
+        connection = Mock()
+        connection.cursor.return_value = cursor
+        assert get_column_types(connection, "users") == {"id": "int4", "name": "text"}
+        assert cursor.execute.call_args[0][1] == ("users",)
+        get_column_types(connection, "users", "public")
+        assert cursor.execute.call_args[0][1] == ("public", "users")
+
+
+class TestBinaryCopyParser:
+    def get_parser(self):
+        decoders = get_decoders("utf8")
+        return BinaryCopyParser([decoders["int4"], decoders["text"]])
+
+    def test_feed(self):
+        parser = self.get_parser()
+        assert parser.feed(build_stream(ROWS)) == EXPECTED
+        assert parser.done
+
+    def test_feed_split(self):
+        parser = self.get_parser()
+        rows = []
+        for byte in bytearray(build_stream(ROWS)):
+            rows.extend(parser.feed(bytes(bytearray([byte]))))
+        assert rows == EXPECTED
+        assert parser.done
+
+    def test_invalid_signature(self):
+        with pytest.raises(ValueError):
+            self.get_parser().feed(b"x" * 19)
+
+
+class TestCopyReader:
+    def get_factory(self, stream):
+        connections = []
+
+        def connection_factory(snapshot):
+            assert snapshot == "snapshot-id"
+
+            def copy_expert(sql, file):
+                assert sql == "COPY (SELECT id, name FROM users) TO STDOUT WITH BINARY"
+                for start in range(0, len(stream), 7):
+                    file.write(stream[start:start + 7])
+
+            connection = Mock()
+            connection.encoding = "UTF8"
+            connection.cursor.return_value.copy_expert.side_effect = copy_expert
+            connections.append(connection)
+            return connection
+
+        return connection_factory, connections
+
+    def test_supports(self):
+        assert CopyReader.supports(["int4", "text"])
+        assert not CopyReader.supports(["int4", "tsvector"])
+
+    def test_iter(self):
+        connection_factory, connections = self.get_factory(build_stream(ROWS))
+        reader = CopyReader(
+            connection_factory, "snapshot-id", "SELECT id, name FROM users", ["int4", "text"], 2
+        )
+        assert list(reader) == [EXPECTED[:2], EXPECTED[2:]]
+        assert connections[0].close.call_count == 1
+
+    def test_failing_connection(self):
+        def connection_factory(snapshot):
+            raise ValueError("connection failed")
+
+        reader = CopyReader(connection_factory, "snapshot-id", "SELECT 1", ["int4"], 1)
+        with pytest.raises(ValueError):
+            list(reader)
+
+
+def format_int4(value):
+    return "ii", (4, value)
+
+
+def format_text(value):
+    if value is None:
+        return "i", (-1,)
+    if isinstance(value, str):
+        value = value.encode("utf8")
+    return "i{}s".format(len(value)), (len(value), value)
+
+
+class TestCopyInStream:
+    def test_read_lazily(self):
+        consumed = []
+
+        def rows():
+            for index in range(3):
+                consumed.append(index)
+                yield index
+
+        stream = CopyInStream(lambda row: b"r", rows())
+        assert stream.read(len(BINARY_HEADER)) == BINARY_HEADER
+        assert consumed == []
+        assert stream.read(2) == b"rr"
+        assert consumed == [0, 1]
+        assert stream.read() == b"r" + struct.pack(">h", -1)
+        assert stream.read(10) == b""
+
+
+class TestCopyWriter:
+    def get_connection(self, column_types, written):
+        def copy_expert(sql, file, size):
+            while True:
+                data = file.read(size)
+                if not data:
+                    break
+                assert len(data) <= size
+                written.append(data)
+
+        connection = Mock()
+        connection.encoding = "UTF8"
+        connection.cursor.return_value.fetchall.return_value = column_types
+        connection.cursor.return_value.copy_expert.side_effect = copy_expert
+        return connection
+
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    @patch("pganonymize.copy_stream.CopyManager")
+    def test_copy(self, copy_manager, quote_ident):
+        types = ["int8", "text", "jsonb", "uuid", "date", "timestamptz", "bool", "float8"]
+        rows = [
+            (1, "foo", {"a": 1}, UUID(int=1), date(2022, 3, 15), datetime(2022, 3, 15, 1, 2, 3, tzinfo=timezone.utc),
+             True, 1.5),
+            (2, None, None, "00000000-0000-0000-0000-000000000002", date.max, datetime(1999, 12, 31, 23, 59), False,
+             2),
+            ("3", 42, b'"wire"', None, None, None, None, None),
+        ]
+        written = []
+        connection = self.get_connection(list(zip(["c{}".format(index) for index in range(8)], types)), written)
+        writer = CopyWriter(connection, "tmp_users", ["c{}".format(index) for index in range(8)], buffer_size=16)
+        writer.copy(iter(rows))
+
+        copy_manager.assert_not_called()
+        assert connection.cursor.return_value.copy_expert.call_args[0][0] == (
+            'COPY "tmp_users" ("c0", "c1", "c2", "c3", "c4", "c5", "c6", "c7") FROM STDIN WITH BINARY'
+        )
+        decoders = get_decoders("utf8")
+        parser = BinaryCopyParser([decoders[column_type] for column_type in types])
+        assert parser.feed(b"".join(written)) == [
+            (1, "foo", {"a": 1}, str(UUID(int=1)), date(2022, 3, 15),
+             datetime(2022, 3, 15, 1, 2, 3, tzinfo=timezone.utc), True, 1.5),
+            (2, None, None, "00000000-0000-0000-0000-000000000002", date.max,
+             datetime(1999, 12, 31, 23, 59, tzinfo=timezone.utc), False, 2.0),
+            (3, "42", "wire", None, None, None, None, None),
+        ]
+
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    @patch("pganonymize.copy_stream.CopyManager")
+    def test_copy_generic(self, copy_manager, quote_ident):
+        copy_manager.return_value.schema = "pg_temp_1"
+        copy_manager.return_value.table = "tmp_users"
+        copy_manager.return_value.formatters = [format_int4, format_text]
+        written = []
+        connection = self.get_connection([("id", "int4"), ("name", "tsvector")], written)
+        writer = CopyWriter(connection, "tmp_users", ["id", "name"], buffer_size=8)
+        copy_manager.assert_not_called()
+
+        writer.copy(iter([(1, "foo"), (2, None), (3, {"a": 1})]))
+        writer.copy([(4, u"b\xe4r")])
+
+        copy_manager.assert_called_once_with(connection, "tmp_users", ["id", "name"])
+        assert connection.cursor.return_value.copy_expert.call_args[0][0] == (
+            'COPY "pg_temp_1"."tmp_users" ("id", "name") FROM STDIN WITH BINARY'
+        )
+        decoders = get_decoders("utf8")
+        parser = BinaryCopyParser([decoders["int4"], decoders["text"]])
+        assert parser.feed(b"".join(written)) == [(1, "foo"), (2, None), (3, '{"a": 1}')]
+        assert parser.done
+        assert connection.cursor.return_value.close.call_count == 3
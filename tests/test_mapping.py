@@ -0,0 +1,69 @@
+import datetime
+import decimal
+import pickle
+import uuid
+
+import pytest
+
+from pganonymize.exceptions import InvalidProviderArgument
+from pganonymize.mapping import MappingStore, dump_value, load_value
+
+
+@pytest.mark.parametrize("value", [
+    "x@example.org",
+    42,
+    1.5,
+    None,
+    True,
+    {"email": ["x@example.org"]},
+    datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc),
+    datetime.date(2024, 1, 2),
+    datetime.time(3, 4, 5),
+    decimal.Decimal("1.50"),
+    uuid.UUID("12345678-1234-5678-1234-567812345678"),
+])
+def test_dump_and_load_value(value):
+    loaded = load_value(dump_value(value))
+    assert loaded == value
+    assert type(loaded) is type(value)
+
+
+def test_dump_unsupported_value():
+    with pytest.raises(InvalidProviderArgument):
+        dump_value(object())
+
+
+class TestMappingStore:
+    def test_get_and_add(self, tmp_path):
+        store = MappingStore(str(tmp_path / "mappings.sqlite"), "email")
+        assert store.get_many(["a@example.com"]) == {}
+        assert store.add_many([("a@example.com", "x@example.org"), ("b@example.com", 42)]) == {
+            "a@example.com": "x@example.org",
+            "b@example.com": 42,
+        }
+        assert store.get_many(["a@example.com", "c@example.com"]) == {"a@example.com": "x@example.org"}
+
+    def test_first_pseudonym_wins(self, tmp_path):
+        path = str(tmp_path / "mappings.sqlite")
+        MappingStore(path, "email").add_many([("a@example.com", "first")])
+        store = MappingStore(path, "email")
+        assert store.add_many([("a@example.com", "second")]) == {"a@example.com": "first"}
+
+    def test_namespaces(self, tmp_path):
+        path = str(tmp_path / "mappings.sqlite")
+        MappingStore(path, "email").add_many([("a", "email")])
+        assert MappingStore(path, "name").get_many(["a"]) == {}
+
+    def test_lookup_batches(self, tmp_path, monkeypatch):
+        monkeypatch.setattr("pganonymize.mapping.MAPPING_LOOKUP_SIZE", 2)
+        store = MappingStore(str(tmp_path / "mappings.sqlite"), "id")
+        store.add_many([(str(index), index) for index in range(5)])
+        assert store.get_many([str(index) for index in range(5)]) == {str(index): index for index in range(5)}
+
+    def test_pickle(self, tmp_path):
+        store = MappingStore(str(tmp_path / "mappings.sqlite"), "email")
+        store.add_many([("a", "b")])
+        copy = pickle.loads(pickle.dumps(store))
+        assert copy._connection is None
+        assert copy.get_many(["a"]) == {"a": "b"}
+        store.close()
@@ -0,0 +1,91 @@
+import multiprocessing
+import pickle
+import threading
+
+from mock import patch
+
+from pganonymize.encrypting.encrypt_service import EncryptingService
+from pganonymize.parallel import ChunkTransformer, get_context
+from pganonymize.plan import TablePlan
+
+
+def get_plan():
+    return TablePlan(
+        [
+            {"first_name": {"provider": {"name": "set", "value": "dummy"}}},
+            {"email": {"provider": {"name": "md5"}, "append": "@localhost"}},
+        ],
+        excludes=[{"email": ["\\S[^@]*@example\\.com"]}],
+        table="auth_user",
+    )
+
+
+def test_pickle_plan():
+    plan = pickle.loads(pickle.dumps(get_plan()))
+    assert plan.table == "auth_user"
+    assert plan.row_columns == ["id", "first_name", "email"]
+    assert len(plan.excludes) == 1
+
+
+class TestChunkTransformer:
+    def test_imap(self):
+        chunks = [
+            [
+                (index, "John", "foo@bar.com"),
+                (index + 1, "Jane", "foo@example.com"),
+            ]
+            for index in range(0, 20, 2)
+        ]
+        with ChunkTransformer(get_plan(), 2) as transformer:
+            result = list(transformer.imap(iter(chunks)))
+        assert result == [
+            [(index, "dummy", "f3ada405ce890b6f8204094deb12d8a8@localhost")]
+            for index in range(0, 20, 2)
+        ]
+
+    def test_imap_with_threads(self):
+        plan = TablePlan([{"email": {"provider": {"name": "pbkdf2", "secret": "secret"}}}], table="auth_user")
+        with ChunkTransformer(plan, 2, threads=2) as transformer:
+            result = list(transformer.imap(iter([[(1, "foo@bar.com"), (2, "baz@bar.com")]])))
+        service = EncryptingService("secret")
+        assert [(pk, service.decrypt_function(email)) for pk, email in result[0]] == [
+            (1, "foo@bar.com"), (2, "baz@bar.com")
+        ]
+
+    def test_imap_from_thread(self):
+        result = []
+
+        def run():
+            with ChunkTransformer(get_plan(), 2) as transformer:
+                result.extend(transformer.imap(iter([[(1, "John", "foo@bar.com")]])))
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        assert result == [[(1, "dummy", "f3ada405ce890b6f8204094deb12d8a8@localhost")]]
+
+    def test_statistics(self):
+        plan = TablePlan([{"email": {"provider": {"name": "md5"}, "cache_size": 10}}], table="auth_user")
+        chunks = [[(index, "foo"), (index + 1, "bar")] for index in range(0, 20, 2)]
+        with ChunkTransformer(plan, 2) as transformer:
+            list(transformer.imap(iter(chunks)))
+        statistics = transformer.get_statistics()
+        assert 1 <= len(statistics) <= 2
+        # Every worker looks up each value once before it is cached
+        assert sum(worker[0][0][0] for worker in statistics) == 20 - 2 * len(statistics)
+        assert sum(worker[0][0][1] for worker in statistics) == 2 * len(statistics)
+
+    def test_different_fake_values(self):
+        plan = TablePlan([{"token": {"provider": {"name": "fake.uuid4"}}}], table="auth_user")
+        chunks = [[(index, "x") for index in range(offset, offset + 3)] for offset in range(0, 24, 3)]
+        with ChunkTransformer(plan, 2) as transformer:
+            tokens = [token for rows in transformer.imap(iter(chunks)) for _, token in rows]
+        assert len(set(tokens)) == 24
+
+
+@patch("pganonymize.parallel.threading.active_count")
+def test_get_context(active_count):
+    active_count.return_value = 1
+    assert get_context() is multiprocessing.get_context()
+    active_count.return_value = 2
+    assert get_context().get_start_method() == "spawn"
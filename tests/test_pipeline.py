@@ -0,0 +1,41 @@
+import pytest
+
+from pganonymize.pipeline import Pipeline
+
+
+def double(chunks):
+    for chunk in chunks:
+        yield [value * 2 for value in chunk]
+
+
+class TestPipeline:
+    def test_run(self):
+        written = []
+        stages = Pipeline(queue_size=1).run(
+            ([index] * 3 for index in range(10)), double, written.append
+        )
+        assert written == [[index * 2] * 3 for index in range(10)]
+        assert list(stages.keys()) == ["read", "transform", "write"]
+        assert [stage.chunks for stage in stages.values()] == [10, 10, 10]
+
+    @pytest.mark.parametrize("failing_stage", ["read", "transform", "write"])
+    def test_failing_stage(self, failing_stage):
+        def chunks():
+            for index in range(10):
+                if failing_stage == "read" and index == 5:
+                    raise ValueError("read")
+                yield [index]
+
+        def transform(chunks):
+            for chunk in double(chunks):
+                if failing_stage == "transform" and chunk == [10]:
+                    raise ValueError("transform")
+                yield chunk
+
+        def write(data):
+            if failing_stage == "write" and data == [10]:
+                raise ValueError("write")
+
+        with pytest.raises(ValueError) as exc_info:
+            Pipeline(queue_size=1).run(chunks(), transform, write)
+        assert exc_info.value.args[0] == failing_stage
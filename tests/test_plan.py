@@ -0,0 +1,203 @@
+from collections import OrderedDict
+
+import pytest
+from mock import patch
+
+from pganonymize.encrypting.encrypt_service import EncryptingService
+from pganonymize.exceptions import BadSchemaFormat, InvalidProvider
+from pganonymize.plan import ColumnPlan, TablePlan, get_path, set_path
+
+
+class TestPaths:
+    @pytest.mark.parametrize(
+        "dic, keys, expected",
+        [
+            [{"a": 1}, ("a",), 1],
+            [{"a": {"b": {"c": 2}}}, ("a", "b", "c"), 2],
+            [{"a": {"b": None}}, ("a", "b", "c"), None],
+            [{"a": 1}, ("b",), None],
+        ],
+    )
+    def test_get_path(self, dic, keys, expected):
+        assert get_path(dic, keys) == expected
+
+    def test_set_path(self):
+        dic = {"a": {"b": 1}}
+        set_path(dic, ("a", "b"), 2)
+        assert dic == {"a": {"b": 2}}
+
+
+class TestColumnPlan:
+    def test_compile(self):
+        plan = ColumnPlan(
+            {
+                "data.email": {
+                    "provider": {"name": "set", "value": "foo"},
+                    "append": "@localhost",
+                }
+            }
+        )
+        assert plan.full_name == "data.email"
+        assert plan.name == "data"
+        assert plan.path == ("data", "email")
+        assert plan.transform("bar", {}) == "foo@localhost"
+
+    def test_cache(self):
+        plan = ColumnPlan({"email": {"provider": {"name": "md5"}, "append": "@localhost", "cache_size": 10}})
+        assert plan.cache is not None
+        first = plan.transform_values(["foo", "bar", "foo"], [])
+        assert first[0] == first[2] == plan.transform("foo", {})
+        assert (plan.cache.hits, plan.cache.misses) == (2, 2)
+
+    def test_cache_of_deterministic_fake_provider(self):
+        provider = {"name": "fake.email", "deterministic": True, "key": "secret"}
+        plan = ColumnPlan({"email": {"provider": provider, "cache_size": 10}})
+        assert plan.cache is not None
+
+    def test_cache_of_random_provider(self):
+        plan = ColumnPlan({"email": {"provider": {"name": "uuid4"}, "cache_size": 10}})
+        assert plan.cache is None
+
+    def test_invalid_provider(self):
+        with pytest.raises(InvalidProvider):
+            ColumnPlan({"email": {"provider": {"name": "foobar"}}})
+
+
+class TestTablePlan:
+    def test_from_definition(self):
+        plan = TablePlan.from_definition(
+            "auth_user",
+            {
+                "primary_key": "user_id",
+                "chunk_size": 10,
+                "fields": [
+                    {"data.first": {"provider": {"name": "clear"}}},
+                    {"data.last": {"provider": {"name": "clear"}}},
+                    {"email": {"provider": {"name": "md5"}}},
+                ],
+                "excludes": [{"email": ["\\S[^@]*@example\\.com"]}],
+            },
+        )
+        assert plan.table == "auth_user"
+        assert plan.primary_key == "user_id"
+        assert plan.chunk_size == 10
+        assert plan.column_names == ["data", "email"]
+        assert len(plan.excludes) == 1
+
+    @patch("pganonymize.plan.provider_registry.get_provider")
+    def test_providers_are_built_once(self, get_provider):
+        plan = TablePlan([{"email": {"provider": {"name": "md5"}}}])
+        for value in ("a", "b", "c"):
+            plan.process_row(OrderedDict([("email", value)]))
+        assert get_provider.call_count == 1
+
+    @pytest.mark.parametrize(
+        "row, expected",
+        [
+            [OrderedDict([("email", "foo@example.com")]), None],
+            [OrderedDict([("email", None)]), None],
+            [
+                OrderedDict([("email", "foo@bar.com")]),
+                OrderedDict([("email", "dummy")]),
+            ],
+        ],
+    )
+    def test_process_row(self, row, expected):
+        plan = TablePlan(
+            [{"email": {"provider": {"name": "set", "value": "dummy"}}}],
+            excludes=[{"email": ["\\S[^@]*@example\\.com"]}],
+        )
+        assert plan.process_row(row) == expected
+
+    def test_process_chunk(self):
+        plan = TablePlan(
+            [
+                {"first_name": {"provider": {"name": "set", "value": "dummy"}}},
+                {
+                    "data.email": {
+                        "provider": {"name": "md5"},
+                        "format": "{pga_value}-{first_name}-{id}",
+                    }
+                },
+            ],
+            excludes=[{"first_name": ["exclude"]}],
+        )
+        assert plan.row_columns == ["id", "first_name", "data"]
+        records = [
+            (1, "exclude me", None),
+            (2, None, None),
+            (3, "John", {"email": "foo"}),
+            (4, None, {"email": "bar"}),
+        ]
+        assert plan.process_chunk(records) == [
+            (3, "dummy", {"email": "acbd18db4cc2f85cedef654fccc4a4d8-dummy-3"}),
+            (4, None, {"email": "37b51d194a7513e45b56f6524f2d51f2-None-4"}),
+        ]
+
+    def test_process_chunk_invalid_excludes(self):
+        plan = TablePlan(
+            [{"first_name": {"provider": {"name": "clear"}}}],
+            excludes=[{"email": ["\\S[^@]*@example\\.com"]}],
+            table="auth_user",
+        )
+        with pytest.raises(BadSchemaFormat):
+            plan.process_chunk([(1, "John")])
+
+    @patch("pganonymize.plan.logging")
+    def test_log_statistics(self, mock_logging):
+        plan = TablePlan.from_definition("auth_user", {
+            "fields": [
+                {"email": {"provider": {"name": "md5"}, "cache_size": 10}},
+                {"username": {"provider": {"name": "fake.user_name", "unique": True, "capacity": 10}}},
+                {"last_name": {"provider": {"name": "clear"}}},
+            ],
+        })
+        plan.process_chunk([{"id": 1, "email": "foo", "username": "foo", "last_name": "foo"}])
+        plan.log_statistics()
+        assert [args[0][0] for args in mock_logging.info.call_args_list] == [
+            'Cache of field "email" of table auth_user: 0 hits, 1 misses, 0 evictions, hit rate 0.0%',
+            'Provider of field "username" of table auth_user: 1 unique values, 0 collisions (0.00%), '
+            '0 values with a counter',
+        ]
+
+    @patch("pganonymize.plan.logging")
+    def test_log_statistics_of_workers(self, mock_logging):
+        plan = TablePlan.from_definition("auth_user", {
+            "fields": [
+                {"email": {"provider": {"name": "md5"}, "cache_size": 10}},
+                {"username": {"provider": {"name": "fake.user_name"}}},
+            ],
+        })
+        plan.log_statistics([
+            [((3, 1, 0), None), (None, "1 unique value")],
+            [((5, 2, 1), None), (None, "2 unique values")],
+        ])
+        assert [args[0][0] for args in mock_logging.info.call_args_list] == [
+            'Cache of field "email" of table auth_user: 8 hits, 3 misses, 1 evictions, hit rate 72.7%',
+            'Provider of field "username" of table auth_user (worker 1): 1 unique value',
+            'Provider of field "username" of table auth_user (worker 2): 2 unique values',
+        ]
+
+    def test_process_chunk_with_threads(self):
+        plan = TablePlan(
+            [
+                {"email": {"provider": {"name": "pbkdf2", "secret": "secret", "key_scope": "chunk"}}},
+                {"data.token": {"provider": {"name": "pbkdf2", "secret": "secret"}}},
+                {"first_name": {"provider": {"name": "set", "value": "dummy"}, "format": "{pga_value} {email}"}},
+            ],
+            table="auth_user",
+        )
+        records = [(index, "user{}@example.com".format(index), {"token": str(index)}, "John") for index in range(5)]
+        with plan.start_threads(2):
+            with patch.object(plan, "submit_values", wraps=plan.submit_values) as submit_values:
+                result = plan.process_chunk(records)
+        assert submit_values.call_count == 2
+        service = EncryptingService("secret")
+        for index, (pk, email, data, first_name) in enumerate(result):
+            assert pk == index
+            assert service.decrypt_function(email) == "user{}@example.com".format(index)
+            assert service.decrypt_function(data["token"]) == str(index)
+            # The format is resolved with the encrypted value
+            assert first_name == "dummy {}".format(email)
+        # The batches of the threads share the key of the chunk
+        assert len({email.split("-")[0] for _, email, _, _ in result}) == 1
@@ -0,0 +1,61 @@
+from mock import call, patch
+
+from pganonymize.progress import (clear_checkpoints, clear_progress, complete_definition, create_progress_table,
+                                  get_completed_definitions, get_progress, set_progress)
+from tests.utils import get_connection, quote_ident
+
+
+@patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+class TestProgress:
+    def test_create_progress_table(self, quote_ident):
+        connection, cursor = get_connection()
+        create_progress_table(connection)
+        assert cursor.execute.call_args == call(
+            'CREATE TABLE IF NOT EXISTS "pganonymize_progress" '
+            '(table_name text PRIMARY KEY, last_primary_key text, completed_definitions integer NOT NULL DEFAULT 0)'
+        )
+        assert connection.commit.call_count == 1
+
+    def test_get_progress(self, quote_ident):
+        connection, cursor = get_connection([("pganonymize_progress",), ("42",)])
+        assert get_progress(connection, "auth_user") == "42"
+        assert cursor.execute.call_args == call(
+            'SELECT last_primary_key FROM "pganonymize_progress" WHERE table_name = %s', ("auth_user",)
+        )
+
+    def test_get_progress_without_table(self, quote_ident):
+        connection, cursor = get_connection([(None,)])
+        assert get_progress(connection, "auth_user") is None
+        assert cursor.execute.call_count == 1
+
+    def test_set_and_clear_progress(self, quote_ident):
+        connection, cursor = get_connection()
+        set_progress(connection, "auth_user", 42)
+        assert cursor.execute.call_args[0][1] == ("auth_user", "42")
+        clear_progress(connection, "auth_user")
+        assert cursor.execute.call_args == call(
+            'UPDATE "pganonymize_progress" SET last_primary_key = NULL WHERE table_name = %(table)s; '
+            'DELETE FROM "pganonymize_progress" WHERE table_name = %(table)s AND completed_definitions = 0',
+            {"table": "auth_user"}
+        )
+
+    def test_get_completed_definitions(self, quote_ident):
+        connection, cursor = get_connection([("pganonymize_progress",)], [[("auth_user", 2)]])
+        assert get_completed_definitions(connection) == {"auth_user": 2}
+
+    def test_get_completed_definitions_without_table(self, quote_ident):
+        connection, cursor = get_connection([(None,)])
+        assert get_completed_definitions(connection) == {}
+        assert cursor.execute.call_count == 1
+
+    def test_complete_definition_and_clear_checkpoints(self, quote_ident):
+        connection, cursor = get_connection()
+        complete_definition(connection, "auth_user")
+        assert cursor.execute.call_args == call(
+            'INSERT INTO "pganonymize_progress" (table_name, completed_definitions) VALUES (%s, 1) '
+            'ON CONFLICT (table_name) DO UPDATE SET completed_definitions = '
+            '"pganonymize_progress".completed_definitions + 1',
+            ("auth_user",)
+        )
+        clear_checkpoints(connection)
+        assert cursor.execute.call_args == call('DELETE FROM "pganonymize_progress"')
@@ -1,4 +1,5 @@
 import datetime
+import hashlib
 import operator
 import uuid
 from collections import OrderedDict
@@ -6,10 +7,12 @@ from collections import OrderedDict
 import pytest
 import six
 from mock import MagicMock, Mock, patch
+from psycopg2.sql import Identifier
 
 from pganonymize import exceptions, providers
 from pganonymize.encrypting.encrypt_service import EncryptingService
 from pganonymize.exceptions import InvalidProviderArgument
+from tests.utils import quote_ident
 
 
 def test_register():
@@ -101,6 +104,34 @@ class TestProviderRegistry:
         if provider is not None:
             assert isinstance(provider, providers.Provider)
 
+    def test_get_provider_cache(self):
+        registry = providers.ProviderRegistry(cache_size=2)
+        registry.register(Mock(spec=providers.Provider, regex_match=True), "foo.+")
+        for provider_id in ("foo.a", "foo.b", "foo.c", "foo.c"):
+            registry.get_provider(provider_id)
+        assert list(registry._cache.keys()) == ["foo.b", "foo.c"]
+
+    def test_register_invalidates_cache(self):
+        registry = providers.ProviderRegistry()
+        registry.register(Mock(spec=providers.Provider), "foo")
+        registry.get_provider("foo")
+        with pytest.raises(exceptions.InvalidProvider):
+            registry.get_provider("bar")
+        bar = Mock(spec=providers.Provider)
+        registry.register(bar, "bar")
+        assert registry._cache == {}
+        assert registry.get_provider("bar") is bar
+
+    def test_get_provider_keeps_registration_order(self):
+        registry = providers.ProviderRegistry()
+        regex = Mock(spec=providers.Provider, regex_match=True)
+        exact = Mock(spec=providers.Provider)
+        registry.register(regex, "foo.*")
+        registry.register(exact, "foobar")
+        registry.register(Mock(spec=providers.Provider), "baz")
+        assert registry.get_provider("foobar") is regex
+        assert registry.get_provider("baz") is registry.providers["baz"]
+
     def test_providers(self):
         pass
 
@@ -112,6 +143,87 @@ class TestProvider:
             provider.alter_value("Foo")
 
 
+class TestAlterValues:
+    @pytest.mark.parametrize(
+        "provider, values",
+        [
+            [providers.ClearProvider(), ["Foo", "Bar"]],
+            [providers.MaskProvider(sign="?"), ["Foo", "Baaaar"]],
+            [providers.MD5Provider(), ["foo", "bar"]],
+            [providers.MD5Provider(as_number=True), ["foo", "bar"]],
+            [providers.SetProvider(value="Baz"), ["Foo", "Bar"]],
+            [providers.KeepProvider(), ["Foo", "Bar"]],
+            [providers.DatetimeProvider(), ["Foo", "Bar"]],
+        ],
+    )
+    def test_matches_alter_value(self, provider, values):
+        assert provider.alter_values(values) == [
+            provider.alter_value(value) for value in values
+        ]
+
+    def test_choice(self):
+        choices = ["Foo", "Bar", "Baz"]
+        provider = providers.ChoiceProvider(values=choices)
+        result = provider.alter_values(["any_value"] * 10)
+        assert len(result) == 10
+        assert set(result) <= set(choices)
+
+    def test_uuid4(self):
+        result = providers.UUID4Provider().alter_values(["Foo"] * 10)
+        assert len(set(result)) == 10
+        for value in result:
+            assert isinstance(value, uuid.UUID)
+            assert value.version == 4
+
+    def test_empty(self):
+        assert providers.UUID4Provider().alter_values([]) == []
+        assert providers.ChoiceProvider(values=["Foo"]).alter_values([]) == []
+
+
+class TestToSql:
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    @pytest.mark.parametrize(
+        "provider, expected, expected_params",
+        [
+            [providers.ChoiceProvider(values=["a", "b"]), "(%s)[1 + floor(random() * 2)::int]", [["a", "b"]]],
+            [providers.ClearProvider(), "NULL", []],
+            [providers.MaskProvider(), 'repeat(%s, char_length("col"::text))', ["X"]],
+            [providers.MD5Provider(), 'md5("col"::text)', []],
+            [providers.SetProvider(value="Bar"), "%s", ["Bar"]],
+            [providers.SetProvider(value=None), "NULL", []],
+            [providers.UUID4Provider(), "gen_random_uuid()", []],
+            [providers.DatetimeProvider(), "CURRENT_DATE", []],
+            [providers.KeepProvider(), '"col"', []],
+        ],
+    )
+    def test_supported(self, quote_ident, provider, expected, expected_params):
+        params = []
+        assert provider.to_sql(Identifier("col"), params).as_string(Mock()) == expected
+        assert params == expected_params
+
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    def test_md5_as_number(self, quote_ident):
+        provider = providers.MD5Provider(as_number=True, as_number_length=4)
+        sql = provider.to_sql(Identifier("col"), []).as_string(Mock())
+        assert sql.startswith("mod((((('x' || substr(md5(\"col\"::text), 1, 8))::bit(32)::bigint::numeric * 4294967296")
+        assert sql.endswith(", 10000)")
+
+    @pytest.mark.parametrize(
+        "provider",
+        [
+            providers.ChoiceProvider(values=["a", 1]),
+            providers.ChoiceProvider(values=[]),
+            providers.SetProvider(value={"foo": "bar"}),
+            providers.FakeProvider(name="fake.first_name"),
+            providers.PBKDF2Provider(secret="secret"),
+        ],
+    )
+    def test_unsupported(self, provider):
+        params = []
+        assert provider.to_sql(Identifier("col"), params) is None
+        assert params == []
+
+
 class TestChoiceProvider:
     def test_alter_value(self):
         choices = ["Foo", "Bar", "Baz"]
@@ -158,6 +270,92 @@ class TestFakeProvider:
         with pytest.raises(exceptions.InvalidProviderArgument):
             provider.alter_value("Foo")
 
+    @patch("pganonymize.providers.fake_data")
+    def test_pool(self, mock_fake_data):
+        mock_fake_data.first_name.side_effect = ["A", "B", "C", "D"]
+        provider = providers.FakeProvider(name="fake.first_name", pool_size=2)
+        values = provider.alter_values(["x"] * 10) + [provider.alter_value("x")]
+        assert set(values) <= {"A", "B"}
+        assert mock_fake_data.first_name.call_count == 2
+
+    @patch("pganonymize.providers.fake_data")
+    def test_pool_refresh(self, mock_fake_data):
+        mock_fake_data.first_name.side_effect = ["A", "B", "C", "D"]
+        provider = providers.FakeProvider(name="fake.first_name", pool_size=2, pool_refresh=3)
+        assert set(provider.alter_values(["x"] * 3)) <= {"A", "B"}
+        assert set(provider.alter_values(["x"] * 3)) <= {"C", "D"}
+        assert mock_fake_data.first_name.call_count == 4
+
+    def test_unique_pool(self):
+        provider = providers.FakeProvider(name="fake.unique.first_name", pool_size=2)
+        with pytest.raises(exceptions.InvalidProviderArgument):
+            provider.alter_values(["x"])
+
+    @pytest.mark.parametrize("name", ["fake.email", "fake.unique.email"])
+    @patch("pganonymize.providers.fake_data")
+    def test_unique(self, mock_fake_data, name):
+        mock_fake_data.email.side_effect = ["a@example.com", "b@example.com", "a@example.com", "a@example.com"]
+        provider = providers.FakeProvider(name=name, unique=True, capacity=100, max_retries=1)
+        assert provider.get_statistics() is None
+        assert provider.alter_values(["x", "y"]) + [provider.alter_value("z")] == [
+            "a@example.com", "b@example.com", "1.a@example.com"
+        ]
+        assert mock_fake_data.unique.email.call_count == 0
+        assert provider.get_statistics() == "3 unique values, 2 collisions (40.00%), 1 values with a counter"
+
+    def test_deterministic(self):
+        provider = providers.FakeProvider(name="fake.email", deterministic=True, key="secret")
+        assert provider.deterministic
+        values = provider.alter_values(["foo", "bar", "foo"])
+        assert values[0] == values[2] != values[1]
+        # Other instances (e.g. in worker processes or later runs) return the same values
+        other = providers.FakeProvider(name="fake.email", deterministic=True, key="secret")
+        assert other.alter_value("bar") == values[1]
+        other_key = providers.FakeProvider(name="fake.email", deterministic=True, key="other")
+        assert other_key.alter_value("foo") != values[0]
+        assert not providers.FakeProvider(name="fake.email").deterministic
+
+    @patch.dict("os.environ", {"ANONYMIZATION_KEY": "secret"})
+    def test_deterministic_key_env(self):
+        provider = providers.FakeProvider(name="fake.email", deterministic=True, key_env="ANONYMIZATION_KEY")
+        other = providers.FakeProvider(name="fake.email", deterministic=True, key="secret")
+        assert provider.alter_value("foo") == other.alter_value("foo")
+
+    @pytest.mark.parametrize("kwargs", [
+        {"name": "fake.email", "key": "secret", "pool_size": 10},
+        {"name": "fake.email", "key": "secret", "unique": True},
+        {"name": "fake.unique.email", "key": "secret"},
+        {"name": "fake.email"},
+        {"name": "fake.email", "key": ""},
+        {"name": "fake.email", "key_env": "PGANONYMIZE_UNSET_KEY"},
+    ])
+    def test_deterministic_invalid(self, kwargs):
+        with pytest.raises(exceptions.InvalidProviderArgument):
+            providers.FakeProvider(deterministic=True, **kwargs)
+
+
+class TestMappingProvider:
+    def test_alter_values(self, tmp_path):
+        kwargs = {
+            "name": "mapping",
+            "store": str(tmp_path / "mappings.sqlite"),
+            "namespace": "email",
+            "provider": {"name": "uuid4"},
+        }
+        provider = providers.MappingProvider(**kwargs)
+        first = provider.alter_values(["a", "b", "a"])
+        assert first[0] == first[2] != first[1]
+        # Another column (or run) sharing the namespace gets the same pseudonyms
+        other = providers.MappingProvider(**kwargs)
+        assert other.alter_values(["b", "a"]) == [first[1], first[0]]
+        assert other.alter_value("a") == first[0]
+        assert other.cache.misses == 2
+
+    @pytest.mark.parametrize("kwargs", [{"provider": {"name": "uuid4"}}, {"store": "mappings.sqlite"}])
+    def test_invalid_arguments(self, kwargs):
+        with pytest.raises(InvalidProviderArgument):
+            providers.MappingProvider(name="mapping", **kwargs)
+
 
 class TestMaskProvider:
     @pytest.mark.parametrize(
@@ -231,6 +429,42 @@ class TestPBKDF2Provider:
 
         assert decrypted_data == SECRET_DATA
 
+    @pytest.mark.parametrize("key_scope, salts", [
+        ["cell", 3],
+        ["chunk", 2],
+        ["table", 1],
+    ])
+    @patch("pganonymize.encrypting.encrypt_service.hashlib.pbkdf2_hmac", wraps=hashlib.pbkdf2_hmac)
+    def test_key_scope(self, pbkdf2_hmac, key_scope, salts):
+        provider = providers.PBKDF2Provider(secret="secret_phrase", key_scope=key_scope)
+        encrypted = provider.alter_values(["foo", "bar"]) + provider.alter_values(["baz", 1])
+        assert encrypted[3] == 1
+        assert pbkdf2_hmac.call_count == salts
+        assert len({value.split("-")[0] for value in encrypted[:3]}) == salts
+        # Every value gets its own nonce
+        assert len({value.split("-")[1] for value in encrypted[:3]}) == 3
+        service = EncryptingService("secret_phrase")
+        assert [service.decrypt_function(value) for value in encrypted] == ["foo", "bar", "baz", 1]
+
+    @patch("pganonymize.providers.PBKDF2_MAX_KEY_USES", 2)
+    def test_key_rotation(self):
+        provider = providers.PBKDF2Provider(secret="secret_phrase", key_scope="table")
+        encrypted = provider.alter_values(["foo", "bar"]) + provider.alter_values(["baz"])
+        assert len({value.split("-")[0] for value in encrypted}) == 2
+
+    @patch("pganonymize.encrypting.encrypt_service.hashlib.pbkdf2_hmac", wraps=hashlib.pbkdf2_hmac)
+    def test_begin_chunk(self, pbkdf2_hmac):
+        provider = providers.PBKDF2Provider(secret="secret_phrase", key_scope="chunk")
+        provider.begin_chunk(4)
+        encrypted = provider.alter_batch(["foo", "bar"]) + provider.alter_batch(["baz", "qux"])
+        assert pbkdf2_hmac.call_count == 1
+        assert len({value.split("-")[0] for value in encrypted}) == 1
+
+    def test_invalid_key_scope(self):
+        provider = providers.PBKDF2Provider(secret="secret_phrase", key_scope="run")
+        with pytest.raises(InvalidProviderArgument):
+            provider.alter_value("SECRET_DATA")
+
     def test_no_pbkdf2_passphrase(self):
         provider = providers.PBKDF2Provider()
         with pytest.raises(InvalidProviderArgument) as exc_info:
@@ -0,0 +1,103 @@
+import pytest
+from mock import Mock, patch
+
+from pganonymize.plan import TablePlan
+from pganonymize.pushdown import anonymize_table_with_sql, build_pushdown
+from tests.utils import quote_ident
+
+
+def get_plan(fields, excludes=None):
+    return TablePlan(fields, excludes, primary_key="id", table="auth_user")
+
+
+FIELDS = [
+    {"first_name": {"provider": {"name": "set", "value": "Foo"}, "append": "-x"}},
+    {"email": {"provider": {"name": "md5"}}},
+]
+
+
+class TestBuildPushdown:
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    def test(self, quote_ident):
+        plan = get_plan(FIELDS, [{"email": ["\\S[^@]*@example\\.com"]}])
+        expressions, condition, params = build_pushdown(plan, "last_name LIKE 'A%'")
+        connection = Mock()
+        assert [(name, expression.as_string(connection)) for name, expression in expressions] == [
+            ("first_name", "(%s)::text || %s"),
+            ("email", 'md5("email"::text)'),
+        ]
+        assert condition.as_string(connection) == (
+            "(last_name LIKE 'A%%') AND "
+            'NOT (coalesce("email"::text ~* %s, false)) AND '
+            '("first_name" IS NOT NULL OR "email" IS NOT NULL)'
+        )
+        assert params == ["Foo", "-x", "^(?:\\S[^@]*@example\\.com)"]
+
+    @pytest.mark.parametrize(
+        "fields, excludes",
+        [
+            [[{"first_name": {"provider": {"name": "fake.first_name"}}}], None],
+            [[{"first_name": {"provider": {"name": "set", "value": "Foo"}, "format": "{pga_value}!"}}], None],
+            [[{"data.email": {"provider": {"name": "md5"}}}], None],
+            [FIELDS, [{"email": ["(?P<name>foo)"]}]],
+            [FIELDS, [{"email": [r"foo\b"]}]],
+            [FIELDS, [{"email": [r"\Bfoo"]}]],
+            [FIELDS, [{"last_name": ["foo"]}]],
+        ],
+    )
+    def test_unsupported(self, fields, excludes):
+        assert build_pushdown(get_plan(fields, excludes)) is None
+
+    @pytest.mark.parametrize("exists", [True, False])
+    def test_missing_function(self, exists):
+        cursor = Mock()
+        cursor.fetchall.return_value = [("gen_random_uuid", exists)]
+        connection = Mock()
+        connection.cursor.return_value = cursor
+        plan = get_plan([{"token": {"provider": {"name": "uuid4"}}}, {"key": {"provider": {"name": "uuid4"}}}])
+        for _ in range(2):
+            assert (build_pushdown(plan, connection=connection) is not None) == exists
+        # The function is only looked up once per connection
+        cursor.execute.assert_called_once_with(
+            "SELECT name, to_regproc(name) IS NOT NULL FROM unnest(%s::text[]) AS t(name)", (["gen_random_uuid"],)
+        )
+
+
+class TestAnonymizeTableWithSql:
+    def get_connection(self):
+        cursor = Mock()
+        cursor.fetchall.return_value = [("id", "integer"), ("first_name", "character varying"), ("email", "text")]
+        connection = Mock()
+        connection.cursor.return_value = cursor
+        return connection, cursor
+
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    def test_update(self, quote_ident):
+        connection, cursor = self.get_connection()
+        assert anonymize_table_with_sql(connection, get_plan(FIELDS), overwrite_values_in_source_tables=True)
+        assert cursor.execute.call_args[0] == (
+            'UPDATE "auth_user" SET '
+            '"first_name" = CASE WHEN "first_name" IS NULL THEN NULL ELSE ((%s)::text || %s)::character varying END, '
+            '"email" = CASE WHEN "email" IS NULL THEN NULL ELSE (md5("email"::text))::text END '
+            'WHERE ("first_name" IS NOT NULL OR "email" IS NOT NULL)',
+            ["Foo", "-x"],
+        )
+
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    def test_new_table(self, quote_ident):
+        connection, cursor = self.get_connection()
+        fields = [{"email": {"provider": {"name": "clear"}}}]
+        assert anonymize_table_with_sql(connection, get_plan(fields), "id > 10", target_schema="anonymized")
+        assert cursor.execute.call_args[0] == (
+            'DROP TABLE IF EXISTS "anonymized"."auth_user"; '
+            'CREATE TABLE "anonymized"."auth_user" AS (SELECT "id", '
+            'CASE WHEN "email" IS NULL THEN NULL ELSE (NULL)::text END AS "email" '
+            'FROM "auth_user" WHERE (id > 10) AND ("email" IS NOT NULL))',
+            [],
+        )
+
+    def test_unsupported(self):
+        connection, cursor = self.get_connection()
+        fields = [{"first_name": {"provider": {"name": "fake.first_name"}}}]
+        assert not anonymize_table_with_sql(connection, get_plan(fields), overwrite_values_in_source_tables=True)
+        cursor.execute.assert_not_called()
@@ -0,0 +1,101 @@
+import threading
+
+import pytest
+from mock import Mock, call, patch
+
+from pganonymize.scheduler import anonymize_tables_concurrently, is_table_locked, schedule_tables
+from tests.utils import get_connection
+
+
+class TestIsTableLocked:
+    @pytest.mark.parametrize("locked", [True, False])
+    def test(self, locked):
+        connection, cursor = get_connection([[locked]])
+        assert is_table_locked(connection, "auth_user") is locked
+        assert cursor.execute.call_args[0][1] == ("auth_user",)
+
+
+class TestScheduleTables:
+    def test_largest_first(self):
+        connection, _ = get_connection(fetchall=[[("small", 1, 10.0), ("large", 100, 1000.0)]])
+        definitions = [
+            {"small": {"search": "id = 1"}},
+            {"unknown": {}},
+            {"large": {}},
+            {"small": {"search": "id = 2"}},
+        ]
+        assert schedule_tables(connection, definitions) == [
+            [{"large": {}}],
+            [{"small": {"search": "id = 1"}}, {"small": {"search": "id = 2"}}],
+            [{"unknown": {}}],
+        ]
+
+
+class TestAnonymizeTablesConcurrently:
+    definitions = [{"table_a": {}}, {"table_b": {}}, {"table_c": {}}]
+
+    def test_commit(self):
+        connection, _ = get_connection([["00000003-0000001B-1"]], [[]])
+        worker_connections = []
+
+        def connection_factory(snapshot):
+            assert snapshot == "00000003-0000001B-1"
+            worker_connections.append(Mock())
+            return worker_connections[-1]
+
+        anonymize_table = Mock()
+        anonymize_tables_concurrently(connection, self.definitions, anonymize_table, connection_factory, 2)
+        assert 1 <= len(worker_connections) <= 2
+        assert sorted(list(args[0][1].keys())[0] for args in anonymize_table.call_args_list) == [
+            "table_a", "table_b", "table_c"
+        ]
+        for worker_connection in worker_connections:
+            assert worker_connection.commit.call_args_list == [call()]
+            assert worker_connection.rollback.call_count == 0
+            assert worker_connection.close.call_count == 1
+
+    @pytest.mark.parametrize("dry_run", [True, False])
+    def test_rollback(self, dry_run):
+        connection, _ = get_connection([["00000003-0000001B-1"]], [[]])
+        worker_connections = []
+
+        def connection_factory(snapshot):
+            worker_connections.append(Mock())
+            return worker_connections[-1]
+
+        def anonymize_table(worker_connection, definition):
+            if "table_b" in definition:
+                raise ValueError()
+
+        with pytest.raises(ValueError):
+            anonymize_tables_concurrently(
+                connection, self.definitions, anonymize_table, connection_factory, 2, dry_run=dry_run
+            )
+        for worker_connection in worker_connections:
+            assert worker_connection.commit.call_count == 0
+            assert worker_connection.rollback.call_count == 1
+            assert worker_connection.close.call_count == 1
+
+    @patch("pganonymize.scheduler.logging")
+    def test_failed_commit(self, mock_logging):
+        connection, _ = get_connection([["00000003-0000001B-1"]], [[]])
+        worker_connections = []
+
+        def connection_factory(snapshot):
+            worker_connections.append(Mock())
+            if len(worker_connections) == 2:
+                worker_connections[-1].commit.side_effect = ValueError()
+            return worker_connections[-1]
+
+        # Every group waits for the others, so that each one gets its own connection
+        barrier = threading.Barrier(3, timeout=5)
+
+        def anonymize_table(worker_connection, definition):
+            barrier.wait()
+
+        with pytest.raises(ValueError):
+            anonymize_tables_concurrently(connection, self.definitions, anonymize_table, connection_factory, 3)
+        assert worker_connections[0].commit.call_count == 1
+        assert worker_connections[1].commit.call_count == 1
+        assert all(worker_connection.rollback.call_count == 1 for worker_connection in worker_connections)
+        assert mock_logging.error.call_args[0][0] == "The run failed after the tables %s have been committed"
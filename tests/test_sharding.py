@@ -0,0 +1,75 @@
+import pytest
+from mock import Mock, patch
+
+from pganonymize.sharding import ShardedReader, get_shard_conditions
+from tests.utils import get_connection, quote_ident
+
+
+class TestGetShardConditions:
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    def test_integer_ranges(self, quote_ident):
+        connection, _ = get_connection([("bigint",), (1, 10)], encoding="UTF8")
+        conditions = get_shard_conditions(connection, "events", "id", 3, search="id > 0")
+        assert [condition.as_string(connection) for condition in conditions] == [
+            '"id" >= 1 AND "id" < 5',
+            '"id" >= 5 AND "id" < 9',
+            '"id" >= 9 AND "id" < 13',
+        ]
+        assert connection.cursor.return_value.execute.call_args_list[1][0][0] == (
+            'SELECT min("id"), max("id") FROM "events" WHERE id > 0'
+        )
+
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    def test_hash(self, quote_ident):
+        connection, _ = get_connection([("uuid",)], encoding="UTF8")
+        conditions = get_shard_conditions(connection, "events", "id", 2)
+        assert [condition.as_string(connection) for condition in conditions] == [
+            '(hashtext("id"::text) & 2147483647) % 2 = 0',
+            '(hashtext("id"::text) & 2147483647) % 2 = 1',
+        ]
+
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    def test_empty_table(self, quote_ident):
+        connection, _ = get_connection([("integer",), (None, None)], encoding="UTF8")
+        assert get_shard_conditions(connection, "events", "id", 2) == []
+
+
+class TestShardedReader:
+    def get_factory(self, chunks_by_query):
+        connections = []
+
+        def connection_factory(snapshot):
+            assert snapshot == "snapshot-id"
+            cursor = Mock()
+
+            def execute(query):
+                cursor.fetchmany.side_effect = chunks_by_query[query] + [[]]
+
+            cursor.execute.side_effect = execute
+            connection = Mock()
+            connection.cursor.return_value = cursor
+            connections.append(connection)
+            return connection
+
+        return connection_factory, connections
+
+    def test_iter(self):
+        chunks_by_query = {
+            "shard 1": [[{"id": 1}], [{"id": 2}]],
+            "shard 2": [[{"id": 3}]],
+        }
+        connection_factory, connections = self.get_factory(chunks_by_query)
+        reader = ShardedReader(connection_factory, "snapshot-id", ["shard 1", "shard 2"], 1)
+        chunks = list(reader)
+        assert sorted(chunk[0]["id"] for chunk in chunks) == [1, 2, 3]
+        assert len(connections) == 2
+        for connection in connections:
+            assert connection.close.call_count == 1
+
+    def test_failing_shard(self):
+        def connection_factory(snapshot):
+            raise ValueError("connection failed")
+
+        reader = ShardedReader(connection_factory, "snapshot-id", ["shard 1"], 1)
+        with pytest.raises(ValueError):
+            list(reader)
@@ -0,0 +1,130 @@
+from mock import Mock, patch
+from psycopg2.sql import SQL
+
+from pganonymize.swap import apply_anonymized_data_by_swap, build_swap_statements, get_swap_info
+from tests.utils import get_connection, quote_ident
+
+
+def get_info(**kwargs):
+    info = {
+        "oid": 1234,
+        "schema": "public",
+        "table": "auth_user",
+        "owner": "admin",
+        "comment": None,
+        "persistence": "p",
+        "replica_identity": "d",
+        "options": None,
+        "blockers": [],
+        "columns": ["id", "email", "is_active"],
+        "indexes": [
+            ("auth_user_pkey", "CREATE UNIQUE INDEX auth_user_pkey ON public.auth_user USING btree (id)",
+             "auth_user_pkey", "PRIMARY KEY (id)", False),
+            ("auth_user_email", "CREATE INDEX auth_user_email ON public.auth_user USING btree (lower(email))",
+             None, None, False),
+        ],
+        "foreign_keys": [("auth_user_group_fk", "FOREIGN KEY (group_id) REFERENCES auth_group(id)")],
+        "sequences": [("public", "auth_user_id_seq", "id")],
+        "grants": [(None, "SELECT", False), ("reader", "SELECT", True)],
+    }
+    info.update(kwargs)
+    return info
+
+
+@patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+class TestSwap:
+    def test_get_swap_info(self, quote_ident):
+        connection, cursor = get_connection(server_version=150000, fetchall=[
+            [(1234, "public", "admin", None, "p", "d", None)],
+            [(False,) * 11],
+            [("id",), ("email",)],
+            [],
+            [],
+            [("public", "auth_user_id_seq", "id")],
+            [],
+        ])
+        info = get_swap_info(connection, "auth_user")
+        assert info["blockers"] == []
+        assert info["oid"] == 1234
+        assert (info["persistence"], info["replica_identity"], info["options"]) == ("p", "d", None)
+        assert info["columns"] == ["id", "email"]
+        assert info["sequences"] == [("public", "auth_user_id_seq", "id")]
+
+    def test_get_swap_info_with_blockers(self, quote_ident):
+        connection, cursor = get_connection(server_version=150000, fetchall=[
+            [(1234, "public", "admin", None, "p", "d", None)],
+            [(False, False, True, False, True, False, False, False, True, False, False)],
+        ])
+        info = get_swap_info(connection, "auth_user")
+        assert info["blockers"] == ["referencing foreign keys", "triggers", "publications"]
+        assert "columns" not in info
+        assert cursor.execute.call_count == 2
+
+    def test_get_swap_info_old_server(self, quote_ident):
+        connection, cursor = get_connection(
+            fetchall=[[(1234, "public", "admin", None, "p", "d", None)]], server_version=110000
+        )
+        assert get_swap_info(connection, "auth_user")["blockers"] == ["PostgreSQL before version 12"]
+
+    def test_build_swap_statements(self, quote_ident):
+        connection = Mock()
+        statements = [
+            statement.as_string(connection)
+            for statement in build_swap_statements(get_info(), "tmp_auth_user", "id", ["email"])
+        ]
+        assert statements == [
+            'CREATE TABLE "public"."pga_new_1234" (LIKE "public"."auth_user" INCLUDING DEFAULTS INCLUDING CONSTRAINTS '
+            'INCLUDING GENERATED INCLUDING STORAGE INCLUDING COMMENTS)',
+            'INSERT INTO "public"."pga_new_1234" ("id", "email", "is_active") SELECT t."id", '
+            'CASE WHEN s."id" IS NULL THEN t."email" ELSE s."email" END, t."is_active" '
+            'FROM "public"."auth_user" t LEFT JOIN "tmp_auth_user" s ON s."id" = t."id"',
+            'ALTER TABLE "public"."pga_new_1234" ADD CONSTRAINT "pga_1234_0" PRIMARY KEY (id)',
+            'CREATE INDEX "pga_1234_1" ON "public"."pga_new_1234" USING btree (lower(email))',
+            'ALTER TABLE "public"."pga_new_1234" ADD CONSTRAINT "auth_user_group_fk" '
+            'FOREIGN KEY (group_id) REFERENCES auth_group(id)',
+            'ALTER SEQUENCE "public"."auth_user_id_seq" OWNED BY "public"."pga_new_1234"."id"',
+            'ALTER TABLE "public"."pga_new_1234" OWNER TO "admin"',
+            'GRANT SELECT ON "public"."pga_new_1234" TO PUBLIC',
+            'GRANT SELECT ON "public"."pga_new_1234" TO "reader" WITH GRANT OPTION',
+            'DROP TABLE "public"."auth_user"',
+            'ALTER TABLE "public"."pga_new_1234" RENAME TO "auth_user"',
+            'ALTER TABLE "public"."auth_user" RENAME CONSTRAINT "pga_1234_0" TO "auth_user_pkey"',
+            'ALTER INDEX "public"."pga_1234_1" RENAME TO "auth_user_email"',
+            'ANALYZE "public"."auth_user"',
+        ]
+
+    def test_build_swap_statements_with_table_properties(self, quote_ident):
+        info = get_info(persistence="u", replica_identity="i", options=["fillfactor=70", "autovacuum_enabled=false"])
+        info["indexes"][1] = info["indexes"][1][:4] + (True,)
+        statements = [
+            statement.as_string(Mock()) for statement in build_swap_statements(info, "tmp_auth_user", "id", ["email"])
+        ]
+        assert statements[0] == (
+            'CREATE UNLOGGED TABLE "public"."pga_new_1234" (LIKE "public"."auth_user" INCLUDING DEFAULTS '
+            'INCLUDING CONSTRAINTS INCLUDING GENERATED INCLUDING STORAGE INCLUDING COMMENTS) '
+            'WITH (fillfactor=70, autovacuum_enabled=false)'
+        )
+        assert statements[-2] == 'ALTER TABLE "public"."auth_user" REPLICA IDENTITY USING INDEX "auth_user_email"'
+
+    def test_build_swap_statements_with_full_replica_identity(self, quote_ident):
+        statements = build_swap_statements(get_info(replica_identity="f"), "tmp_auth_user", "id", ["email"])
+        assert statements[-2].as_string(Mock()) == 'ALTER TABLE "public"."auth_user" REPLICA IDENTITY FULL'
+
+    @patch("pganonymize.swap.Literal", side_effect=lambda value: SQL("'{}'".format(value)))
+    def test_build_swap_statements_with_comment(self, literal, quote_ident):
+        statements = build_swap_statements(get_info(comment="Users"), "tmp_auth_user", "id", ["email"])
+        assert statements[-2].as_string(Mock()) == 'COMMENT ON TABLE "public"."auth_user" IS \'Users\''
+
+    @patch("pganonymize.swap.get_swap_info")
+    def test_apply_anonymized_data_by_swap(self, get_swap_info, quote_ident):
+        get_swap_info.return_value = get_info()
+        connection, cursor = get_connection()
+        assert apply_anonymized_data_by_swap(connection, "tmp_auth_user", "auth_user", "id", ["email"]) is True
+        assert cursor.execute.call_count == 14
+
+    @patch("pganonymize.swap.get_swap_info")
+    def test_apply_anonymized_data_by_swap_with_blockers(self, get_swap_info, quote_ident):
+        get_swap_info.return_value = get_info(blockers=["triggers"])
+        connection, cursor = get_connection()
+        assert apply_anonymized_data_by_swap(connection, "tmp_auth_user", "auth_user", "id", ["email"]) is False
+        assert cursor.execute.call_count == 0
@@ -0,0 +1,53 @@
+import pytest
+from mock import Mock
+
+from pganonymize.exceptions import InvalidProviderArgument
+from pganonymize.unique import BloomFilter, ScalableBloomFilter, UniqueValues
+
+
+class TestBloomFilter:
+    def test_add(self):
+        bloom_filter = BloomFilter(1000, 0.001)
+        assert all(bloom_filter.add("user{}@example.com".format(number)) for number in range(1000))
+        assert not any(bloom_filter.add("user{}@example.com".format(number)) for number in range(1000))
+        assert bloom_filter.count == 1000
+
+    def test_size(self):
+        bloom_filter = BloomFilter(400000000, 0.001)
+        # About 14.4 bits and 10 hash functions per value
+        assert len(bloom_filter.bits) == 718879379
+        assert bloom_filter.hash_count == 10
+
+
+class TestScalableBloomFilter:
+    def test_add_past_capacity(self):
+        bloom_filter = ScalableBloomFilter(100, 0.001)
+        added = sum(bloom_filter.add("user{}@example.com".format(number)) for number in range(1000))
+        assert added >= 995
+        assert bloom_filter.count == added
+        assert [layer.capacity for layer in bloom_filter.filters] == [100, 200, 400, 800]
+        assert not any(bloom_filter.add("user{}@example.com".format(number)) for number in range(1000))
+
+
+class TestUniqueValues:
+    def test_retry(self):
+        unique_values = UniqueValues(Mock(side_effect=["a", "a", "b"]), 100, 0.001, 10, "{counter}.{value}")
+        assert [unique_values.next_value(), unique_values.next_value()] == ["a", "b"]
+        assert (unique_values.generated, unique_values.collisions, unique_values.fallbacks) == (2, 1, 0)
+        assert str(unique_values) == "2 unique values, 1 collisions (33.33%), 0 values with a counter"
+
+    def test_fallback(self):
+        unique_values = UniqueValues(Mock(return_value="a@example.com"), 100, 0.001, 2, "{counter}.{value}")
+        assert [unique_values.next_value() for _ in range(3)] == ["a@example.com", "1.a@example.com", "2.a@example.com"]
+        assert (unique_values.generated, unique_values.collisions, unique_values.fallbacks) == (3, 6, 2)
+
+    def test_fallback_past_capacity(self):
+        unique_values = UniqueValues(Mock(return_value="a@example.com"), 10, 0.001, 0, "{counter}.{value}")
+        values = [unique_values.next_value() for _ in range(1000)]
+        assert len(set(values)) == 1000
+
+    def test_fallback_of_number(self):
+        unique_values = UniqueValues(Mock(return_value=1), 100, 0.001, 2, "{counter}.{value}")
+        assert unique_values.next_value() == 1
+        with pytest.raises(InvalidProviderArgument):
+            unique_values.next_value()
@@ -1,21 +1,32 @@
 import math
 import os
-from collections import OrderedDict, namedtuple
+from collections import OrderedDict
 from unittest import mock
 
 import pytest
+import psycopg2.errors
 from mock import ANY, Mock, call, patch
+from psycopg2.sql import SQL
 
+from pganonymize.constants import COPY_BUFFER_SIZE
+from pganonymize.exceptions import BadSchemaFormat, InvalidProviderArgument
+from pganonymize.providers import MD5Provider
 from pganonymize.utils import (
+    anonymize_table,
     anonymize_tables,
+    apply_anonymized_data_in_batches,
     build_and_then_import_data,
     build_pg_json_object,
     create_database_dump,
     create_dict,
     get_column_values,
+    fetch_chunks,
     get_connection,
+    get_resume_condition,
+    get_table_count,
     import_data,
     load_config,
+    skip_completed_definitions,
     truncate_tables,
 )
 from tests.utils import quote_ident
@@ -35,6 +46,38 @@ class TestGetConnection:
         mock_connect.assert_called_once_with(**connection_data)
 
 
+class TestGetTableCount:
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    @pytest.mark.parametrize("strategy, dry_run, fetchone, expected, expected_executes", [
+        ["exact", False, [42], 42, [call('SELECT COUNT(*) FROM "auth_user"')]],
+        ["exact", True, None, 100, []],
+        [
+            "estimate", False, [41.0], 41,
+            [call("SELECT reltuples FROM pg_class WHERE oid = to_regclass(quote_ident(%s))", ("auth_user",))]
+        ],
+        [
+            "estimate", False, [-1.0], None,
+            [call("SELECT reltuples FROM pg_class WHERE oid = to_regclass(quote_ident(%s))", ("auth_user",))]
+        ],
+        ["none", False, None, None, []],
+    ])
+    def test(self, quote_ident, strategy, dry_run, fetchone, expected, expected_executes):
+        mock_cursor = Mock()
+        mock_cursor.fetchone.return_value = fetchone
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+        assert get_table_count(connection, "auth_user", dry_run, strategy) == expected
+        assert mock_cursor.execute.call_args_list == expected_executes
+
+
+class TestFetchChunks:
+    def test_until_exhausted(self):
+        mock_cursor = Mock()
+        mock_cursor.fetchmany.side_effect = [[(1,)], [(2,)], [(3,)], []]
+        assert list(fetch_chunks(mock_cursor, 1)) == [[(1,)], [(2,)], [(3,)]]
+        assert mock_cursor.fetchmany.call_args_list == [call(size=1)] * 4
+
+
 class TestTruncateTables:
     @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
     @pytest.mark.parametrize(
@@ -64,8 +107,6 @@ class TestTruncateTables:
 
 class TestImportData:
     @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
-    @patch("pgcopy.copy.util")
-    @patch("pgcopy.copy.inspect")
     @pytest.mark.parametrize(
         "tmp_table, cols, data",
         [
@@ -80,80 +121,46 @@ class TestImportData:
             ]
         ],
     )
-    def test(self, inspect, util, quote_ident, tmp_table, cols, data):
+    def test(self, quote_ident, tmp_table, cols, data):
         mock_cursor = Mock()
+        mock_cursor.fetchall.return_value = [("id", "int8"), ("location", "varchar")]
 
         connection = Mock()
         connection.cursor.return_value = mock_cursor
         connection.encoding = "UTF8"
-        Record = namedtuple(
-            "Record",
-            "attname,type_category,type_name,type_mod,not_null,typelem",
-        )
-
-        inspect.get_types.return_value = {
-            "id": Record(
-                attname="id",
-                type_category="N",
-                type_name="int8",
-                type_mod=-1,
-                not_null=False,
-                typelem=0,
-            ),
-            "location": Record(
-                attname="location",
-                type_category="S",
-                type_name="varchar",
-                type_mod=259,
-                not_null=False,
-                typelem=0,
-            ),
-        }
 
         import_data(connection, tmp_table, cols, data)
 
-        # assert connection.cursor.call_count == mock_cursor.close.call_count
-
+        assert mock_cursor.execute.call_args[0][1] == ("public", "src_tbl")
         mock_cursor.copy_expert.assert_called_once()
         expected = [
             call(
                 'COPY "public"."src_tbl" ("id", "location") FROM STDIN WITH BINARY',
                 ANY,
+                size=COPY_BUFFER_SIZE,
             )
         ]
         assert mock_cursor.copy_expert.call_args_list == expected
+        assert connection.cursor.call_count == mock_cursor.close.call_count
 
-    @patch("pganonymize.utils.CopyManager")
+    @patch("pganonymize.utils.ApplyStage")
+    @patch("pganonymize.utils.CopyWriter")
     @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
-    def test_anonymize_tables(self, quote_ident, copy_manager):
+    def test_anonymize_tables(self, quote_ident, copy_writer, apply_stage):
         mock_cursor = Mock()
         mock_cursor.fetchone.return_value = [2]
         mock_cursor.fetchmany.side_effect = [
             [
-                OrderedDict([("first_name", None), ("json_column", None)]),
-                OrderedDict(
-                    [
-                        ("first_name", "exclude me"),
-                        ("json_column", {"field1": "foo"}),
-                    ]
-                ),
-                OrderedDict(
-                    [
-                        ("first_name", "John Doe"),
-                        ("json_column", {"field1": "foo"}),
-                    ]
-                ),
-                OrderedDict(
-                    [
-                        ("first_name", "John Doe"),
-                        ("json_column", {"field2": "bar"}),
-                    ]
-                ),
-            ]
+                (1, None, None),
+                (2, "exclude me", {"field1": "foo"}),
+                (3, "John Doe", {"field1": "foo"}),
+                (4, "John Doe", {"field2": "bar"}),
+            ],
+            [],
         ]
-        cmm = Mock()
-        copy_manager.return_value = cmm
-        copy_manager.copy.return_value = []
+        writer = Mock()
+        copy_writer.return_value = writer
+        copy_writer.copy.return_value = []
 
         connection = Mock()
         connection.cursor.return_value = mock_cursor
@@ -162,7 +169,7 @@ class TestImportData:
 
         assert connection.cursor.call_count == 0
         assert mock_cursor.close.call_count == 0
-        assert copy_manager.copy.call_count == 0
+        assert copy_writer.copy.call_count == 0
 
         definitions = [
             {
@@ -209,33 +216,241 @@ class TestImportData:
             overwrite_values_in_source_tables=True,
         )
         assert connection.cursor.call_count == mock_cursor.close.call_count
-        assert copy_manager.call_args_list == [
+        assert copy_writer.call_args_list == [
             call(
                 connection,
                 "tmp_auth_user",
                 ["id", "first_name", "json_column"],
             )
         ]
-        assert cmm.copy.call_count == 1
-        assert cmm.copy.call_args_list == [
-            call(
-                [
-                    [
-                        "dummy nameappend-me",
-                        b'{"field1": "dummy json field1"}',
-                    ],
-                    [
-                        "dummy nameappend-me",
-                        b'{"field2": "dummy json field2"}',
-                    ],
-                ]
-            )
+        assert writer.copy.call_count == 1
+        assert list(writer.copy.call_args[0][0]) == [
+            (3, "dummy nameappend-me", {"field1": "dummy json field1"}),
+            (4, "dummy nameappend-me", {"field2": "dummy json field2"}),
         ]
 
 
+class TestAnonymizeTable:
+    @patch("pganonymize.utils.build_and_then_import_data")
+    @patch("pganonymize.utils.get_table_count")
+    @patch("pganonymize.utils.anonymize_table_with_sql", return_value=True)
+    @pytest.mark.parametrize("table_pushdown, dry_run, pushed_down", [
+        [None, False, True],
+        [False, False, False],
+        [None, True, False],
+    ])
+    def test_pushdown(
+        self, anonymize_table_with_sql, get_table_count, build_and_then_import_data, table_pushdown, dry_run,
+        pushed_down
+    ):
+        table_definition = {"fields": [{"first_name": {"provider": {"name": "clear"}}}], "search": "id > 1"}
+        if table_pushdown is not None:
+            table_definition["pushdown"] = table_pushdown
+        connection = Mock()
+        anonymize_table(connection, {"auth_user": table_definition}, dry_run=dry_run,
+                        overwrite_values_in_source_tables=True)
+        if pushed_down:
+            anonymize_table_with_sql.assert_called_once_with(connection, ANY, "id > 1", None, True)
+        else:
+            anonymize_table_with_sql.assert_not_called()
+        assert build_and_then_import_data.called is not pushed_down
+        assert get_table_count.called is not pushed_down
+
+
+class TestAnonymizeTableSwap:
+    @patch("pganonymize.utils.build_and_then_import_data")
+    @patch("pganonymize.utils.get_table_count", return_value=10)
+    @patch("pganonymize.utils.anonymize_table_with_sql", return_value=True)
+    def test(self, anonymize_table_with_sql, get_table_count, build_and_then_import_data):
+        table_definition = {"fields": [{"first_name": {"provider": {"name": "clear"}}}], "overwrite_strategy": "swap"}
+        anonymize_table(Mock(), {"auth_user": table_definition}, overwrite_values_in_source_tables=True,
+                        apply_batch_size=1000)
+        anonymize_table_with_sql.assert_not_called()
+        assert build_and_then_import_data.call_args[1]["overwrite_strategy"] == "swap"
+        assert build_and_then_import_data.call_args[1]["apply_batch_size"] is None
+
+    @patch("pganonymize.utils.build_and_then_import_data")
+    @patch("pganonymize.utils.get_table_count", return_value=10)
+    @patch("pganonymize.utils.anonymize_table_with_sql", return_value=False)
+    def test_parallel_tables(self, anonymize_table_with_sql, get_table_count, build_and_then_import_data):
+        table_definition = {"fields": [{"first_name": {"provider": {"name": "clear"}}}], "overwrite_strategy": "swap"}
+        anonymize_table(Mock(), {"auth_user": table_definition}, overwrite_values_in_source_tables=True, parallel=True)
+        assert build_and_then_import_data.call_args[1]["overwrite_strategy"] == "update"
+
+    @patch("pganonymize.utils.anonymize_tables_concurrently")
+    def test_anonymize_tables_in_parallel(self, anonymize_tables_concurrently):
+        definitions = [{"auth_user": {"overwrite_strategy": "swap"}}, {"auth_group": {}}]
+        anonymize_tables(Mock(), definitions, overwrite_values_in_source_tables=True, parallel_tables=2,
+                         connection_factory=Mock(), overwrite_strategy="swap")
+        anonymize = anonymize_tables_concurrently.call_args[0][2]
+        assert anonymize.keywords["parallel"] is True
+
+
+class TestAnonymizeTableIncremental:
+    @patch("pganonymize.utils.set_watermark")
+    @patch("pganonymize.utils.build_and_then_import_data")
+    @patch("pganonymize.utils.get_table_count", return_value=10)
+    @patch("pganonymize.utils.anonymize_table_with_sql", return_value=False)
+    @patch("pganonymize.utils.get_watermark_window", return_value=("id > 40 AND id <= 42", "42"))
+    @patch("pganonymize.utils.get_watermark", return_value="40")
+    def test(self, get_watermark, get_watermark_window, anonymize_table_with_sql, get_table_count,
+             build_and_then_import_data, set_watermark):
+        table_definition = {
+            "fields": [{"first_name": {"provider": {"name": "clear"}}}], "search": "active", "watermark": "id"
+        }
+        connection = Mock()
+        anonymize_table(connection, {"auth_user": table_definition}, overwrite_values_in_source_tables=True)
+        get_watermark_window.assert_called_once_with(connection, "auth_user", "id", "40", "active")
+        assert build_and_then_import_data.call_args[0][5] == "(active) AND id > 40 AND id <= 42"
+        set_watermark.assert_called_once_with(connection, "auth_user", "42")
+
+    @patch("pganonymize.utils.set_watermark")
+    @patch("pganonymize.utils.build_and_then_import_data")
+    @patch("pganonymize.utils.get_watermark_window", return_value=(None, "42"))
+    @patch("pganonymize.utils.get_watermark", return_value="42")
+    def test_unchanged(self, get_watermark, get_watermark_window, build_and_then_import_data, set_watermark):
+        table_definition = {"fields": [{"first_name": {"provider": {"name": "clear"}}}], "watermark": "id"}
+        anonymize_table(Mock(), {"auth_user": table_definition}, overwrite_values_in_source_tables=True)
+        build_and_then_import_data.assert_not_called()
+        set_watermark.assert_not_called()
+
+    @pytest.mark.parametrize("overwrite_strategy, raises", [["update", True], ["swap", False]])
+    @patch("pganonymize.utils.build_and_then_import_data")
+    @patch("pganonymize.utils.get_table_count", return_value=10)
+    @patch("pganonymize.utils.set_watermark")
+    @patch("pganonymize.utils.get_watermark_window", return_value=(None, "100"))
+    @patch("pganonymize.utils.get_watermark", return_value=None)
+    def test_xmin_with_apply_batch_size(self, get_watermark, get_watermark_window, set_watermark, get_table_count,
+                                        build_and_then_import_data, overwrite_strategy, raises):
+        table_definition = {
+            "fields": [{"first_name": {"provider": {"name": "clear"}}}], "watermark": "xmin", "apply_batch_size": 100,
+            "overwrite_strategy": overwrite_strategy,
+        }
+        if raises:
+            with pytest.raises(BadSchemaFormat):
+                anonymize_table(Mock(), {"auth_user": table_definition}, overwrite_values_in_source_tables=True)
+            build_and_then_import_data.assert_not_called()
+        else:
+            anonymize_table(Mock(), {"auth_user": table_definition}, overwrite_values_in_source_tables=True)
+            assert build_and_then_import_data.call_count == 1
+
+    @patch("pganonymize.utils.anonymize_table")
+    @patch("pganonymize.utils.create_watermark_table")
+    def test_create_watermark_table(self, create_watermark_table, anonymize_table):
+        connection, watermark_connection = Mock(), Mock()
+        definitions = [{"auth_user": {"watermark": "id"}}]
+        anonymize_tables(connection, definitions, overwrite_values_in_source_tables=True,
+                         connection_factory=Mock(return_value=watermark_connection))
+        # The table is committed on its own connection, not together with the truncated tables
+        create_watermark_table.assert_called_once_with(watermark_connection)
+        watermark_connection.close.assert_called_once_with()
+        connection.commit.assert_not_called()
+
+    @patch("pganonymize.utils.anonymize_table")
+    @patch("pganonymize.utils.create_watermark_table")
+    def test_create_watermark_table_without_connection_factory(self, create_watermark_table, anonymize_table):
+        connection = Mock()
+        anonymize_tables(connection, [{"auth_user": {"watermark": "id"}}], overwrite_values_in_source_tables=True)
+        create_watermark_table.assert_called_once_with(connection, commit=False)
+
+
+class TestAnonymizeTableResume:
+    @patch("pganonymize.utils.build_and_then_import_data")
+    @patch("pganonymize.utils.get_table_count", return_value=10)
+    @patch("pganonymize.utils.anonymize_table_with_sql")
+    @patch("pganonymize.utils.get_resume_condition", return_value="(id > 1) AND id > 42")
+    @patch("pganonymize.utils.get_progress", return_value="42")
+    def test(self, get_progress, get_resume_condition, anonymize_table_with_sql, get_table_count,
+             build_and_then_import_data):
+        table_definition = {"fields": [{"first_name": {"provider": {"name": "clear"}}}], "search": "id > 1"}
+        connection = Mock()
+        anonymize_table(connection, {"auth_user": table_definition}, overwrite_values_in_source_tables=True,
+                        apply_batch_size=1000)
+        anonymize_table_with_sql.assert_not_called()
+        get_resume_condition.assert_called_once_with(connection, "id", "42", "id > 1")
+        assert build_and_then_import_data.call_args[0][5] == "(id > 1) AND id > 42"
+        assert build_and_then_import_data.call_args[1]["apply_batch_size"] == 1000
+
+
+class TestResume:
+    def test_skip_completed_definitions(self):
+        definitions = [{"auth_user": {"search": "id < 10"}}, {"orders": {}}, {"auth_user": {"search": "id >= 10"}}]
+        assert skip_completed_definitions(definitions, {"auth_user": 1}) == definitions[1:]
+        assert skip_completed_definitions(definitions, {"auth_user": 2, "orders": 1}) == []
+
+    @patch("pganonymize.utils.clear_checkpoints")
+    @patch("pganonymize.utils.complete_definition")
+    @patch("pganonymize.utils.get_completed_definitions", return_value={"auth_user": 1})
+    @patch("pganonymize.utils.create_progress_table")
+    @patch("pganonymize.utils.anonymize_table")
+    def test_anonymize_tables(self, anonymize_table, create_progress_table, get_completed_definitions,
+                              complete_definition, clear_checkpoints):
+        definitions = [{"auth_user": {}}, {"orders": {}}]
+        connection = Mock()
+        anonymize_tables(connection, definitions, overwrite_values_in_source_tables=True, resume=True)
+        assert anonymize_table.call_count == 1
+        assert anonymize_table.call_args[0] == (connection, {"orders": {}})
+        complete_definition.assert_called_once_with(connection, "orders")
+        assert connection.commit.call_count == 1
+        clear_checkpoints.assert_called_once_with(connection)
+
+    @patch("pganonymize.utils.create_progress_table")
+    @patch("pganonymize.utils.anonymize_table")
+    def test_dry_run(self, anonymize_table, create_progress_table):
+        connection = Mock()
+        anonymize_tables(connection, [{"auth_user": {}}], dry_run=True, resume=True)
+        create_progress_table.assert_not_called()
+        assert connection.commit.call_count == 0
+
+
+class TestApplyInBatches:
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    @patch("pganonymize.utils.time.sleep")
+    @patch("pganonymize.utils.clear_progress")
+    @patch("pganonymize.utils.set_progress")
+    @patch("pganonymize.utils.create_progress_table")
+    def test(self, create_progress_table, set_progress, clear_progress, sleep, quote_ident):
+        mock_cursor = Mock()
+        mock_cursor.fetchone.side_effect = [(2,), (3,), None]
+        updates = []
+
+        def execute(sql, params=None):
+            if sql.startswith("UPDATE"):
+                updates.append(params)
+                if len(updates) == 2:
+                    raise psycopg2.errors.LockNotAvailable()
+
+        mock_cursor.execute.side_effect = execute
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+        columns = [{"first_name": {"provider": {"name": "clear"}}}]
+
+        apply_anonymized_data_in_batches(connection, "tmp_auth_user", "auth_user", "id", columns, 2, "1s")
+
+        assert updates == [{"last": None, "upper": 2}, {"last": 2, "upper": 3}, {"last": 2, "upper": 3}]
+        assert call("SET LOCAL lock_timeout = %s", ("1s",)) in mock_cursor.execute.call_args_list
+        assert mock_cursor.execute.call_args_list[-1][0] == (
+            'SELECT "id" FROM (SELECT "id" FROM "tmp_auth_user" WHERE %(last)s IS NULL OR "id" > %(last)s '
+            'ORDER BY "id" LIMIT %(limit)s) b ORDER BY "id" DESC LIMIT 1',
+            {"last": 3, "limit": 2},
+        )
+        assert set_progress.call_args_list == [call(connection, "auth_user", 2), call(connection, "auth_user", 3)]
+        assert connection.rollback.call_count == 1
+        sleep.assert_called_once_with(1)
+        clear_progress.assert_called_once_with(connection, "auth_user")
+        assert connection.commit.call_count == 4
+
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    @patch("pganonymize.utils.Literal", side_effect=lambda value: SQL("'{}'".format(value)))
+    def test_get_resume_condition(self, literal, quote_ident):
+        connection = Mock()
+        assert get_resume_condition(connection, "id", "42") == "\"id\" > '42'"
+        assert get_resume_condition(connection, "id", "42", "age > 1") == "(age > 1) AND \"id\" > '42'"
+
+
 class TestBuildAndThenImport:
     @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
-    @patch("pganonymize.utils.CopyManager")
+    @patch("pganonymize.utils.CopyWriter")
     @pytest.mark.parametrize(
         "table, primary_key, columns, total_count, chunk_size",
         [
@@ -254,24 +469,22 @@ class TestBuildAndThenImport:
     def test_build_and_then_import_data_overwrite_source(
         self,
         quote_ident,
-        copy_manager,
+        copy_writer,
         table,
         primary_key,
         columns,
         total_count,
         chunk_size,
     ):
-        fake_record = dict.fromkeys(
-            [list(definition.keys())[0] for definition in columns], ""
-        )
+        fake_record = (1, "", "")
         records = [
             [fake_record for row in range(0, chunk_size)]
             for x in range(0, int(math.ceil(total_count / chunk_size)))
         ]
 
         mock_cursor = Mock()
-        mock_cursor.fetchmany.side_effect = records
-        mock_cursor.fetchone.return_value = [{}]
+        mock_cursor.fetchmany.side_effect = records + [[]]
+        mock_cursor.fetchone.return_value = (10, 1000)
 
         connection = Mock()
         connection.cursor.return_value = mock_cursor
@@ -295,6 +508,12 @@ class TestBuildAndThenImport:
                 '                    FROM "src_tbl" WITH NO DATA'
             ),
             # noqa
+            call('ANALYZE "tmp_src_tbl"'),
+            call(
+                'SELECT (SELECT reltuples FROM pg_class WHERE oid = to_regclass(quote_ident(%s))), '
+                '(SELECT reltuples FROM pg_class WHERE oid = to_regclass(quote_ident(%s)))',
+                ("tmp_src_tbl", "src_tbl")
+            ),
             call('CREATE INDEX ON "tmp_src_tbl" ("id")'),
             call(
                 'UPDATE "src_tbl" t SET "col1" = s."col1", "COL2" = s."COL2" FROM "tmp_src_tbl" s WHERE t."id" = s."id"'
@@ -303,7 +522,31 @@ class TestBuildAndThenImport:
         assert mock_cursor.execute.call_args_list == expected_execute_calls
 
     @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
-    @patch("pganonymize.utils.CopyManager")
+    @patch("pganonymize.utils.CopyWriter")
+    @patch("pganonymize.utils.apply_anonymized_data_to_current_table")
+    @patch("pganonymize.utils.apply_anonymized_data_by_swap")
+    @patch("pganonymize.utils.ApplyStage")
+    @pytest.mark.parametrize("swapped", [True, False])
+    def test_build_and_then_import_data_swap(
+        self, apply_stage, apply_anonymized_data_by_swap, apply_anonymized_data_to_current_table, copy_writer,
+        quote_ident, swapped
+    ):
+        apply_anonymized_data_by_swap.return_value = swapped
+        mock_cursor = Mock()
+        mock_cursor.fetchmany.side_effect = [[(1, "a")], []]
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+        columns = [{"col1": {"provider": {"name": "md5"}}}]
+        build_and_then_import_data(
+            connection, "src_tbl", "id", columns, None, None, 1, 10, overwrite_values_in_source_tables=True,
+            overwrite_strategy="swap"
+        )
+        apply_anonymized_data_by_swap.assert_called_once_with(connection, "tmp_src_tbl", "src_tbl", "id", ["col1"])
+        assert apply_anonymized_data_to_current_table.called is not swapped
+        assert mock_cursor.close.called
+
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    @patch("pganonymize.utils.CopyWriter")
     @pytest.mark.parametrize(
         "table, primary_key, target_schema, columns, total_count, chunk_size",
         [
@@ -323,7 +566,7 @@ class TestBuildAndThenImport:
     def test_build_and_then_import_data_to_new_namespace(
         self,
         quote_ident,
-        copy_manager,
+        copy_writer,
         table,
         primary_key,
         target_schema,
@@ -331,16 +574,14 @@ class TestBuildAndThenImport:
         total_count,
         chunk_size,
     ):
-        fake_record = dict.fromkeys(
-            [list(definition.keys())[0] for definition in columns], ""
-        )
+        fake_record = (1, "", "")
         records = [
             [fake_record for row in range(0, chunk_size)]
             for x in range(0, int(math.ceil(total_count / chunk_size)))
         ]
 
         mock_cursor = Mock()
-        mock_cursor.fetchmany.side_effect = records
+        mock_cursor.fetchmany.side_effect = records + [[]]
         mock_cursor.fetchone.return_value = [{}]
 
         connection = Mock()
@@ -374,8 +615,135 @@ class TestBuildAndThenImport:
         ]  # noqa
         assert mock_cursor.execute.call_args_list == expected_execute_calls
 
-    @patch("pganonymize.utils.CopyManager")
-    def test_column_format(self, copy_manager):
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    @patch("pganonymize.utils.is_table_locked", return_value=False)
+    @patch("pganonymize.utils.export_snapshot", return_value="snapshot-id")
+    @patch("pganonymize.utils.CopyWriter")
+    @patch("pganonymize.utils.ApplyStage")
+    def test_build_and_then_import_data_pipeline(
+        self, apply_stage, copy_writer, export_snapshot, is_table_locked, quote_ident
+    ):
+        columns = [{"col1": {"provider": {"name": "md5"}}}]
+        records = [[(index, str(index))] for index in range(4)]
+        reader_cursor = Mock()
+        reader_cursor.fetchmany.side_effect = records + [[]]
+        reader_connection = Mock()
+        reader_connection.cursor.return_value = reader_cursor
+        connection_factory = Mock(return_value=reader_connection)
+        connection = Mock()
+
+        build_and_then_import_data(
+            connection,
+            "src_tbl",
+            "id",
+            columns,
+            None,
+            None,
+            4,
+            1,
+            overwrite_values_in_source_tables=True,
+            pipeline=True,
+            connection_factory=connection_factory,
+        )
+        assert [list(args[0][0]) for args in copy_writer.return_value.copy.call_args_list] == [
+            [(index, MD5Provider().alter_value(str(index)))] for index in range(4)
+        ]
+        # The data is read on its own connection, the COPY of the writer runs on the table connection
+        connection_factory.assert_called_once_with(snapshot="snapshot-id")
+        reader_cursor.execute.assert_called_once_with('SELECT "id", "col1" FROM "src_tbl"')
+        assert copy_writer.call_args[0][0] is connection
+        assert call(name="fetch_large_result") not in connection.cursor.call_args_list
+
+    @pytest.mark.parametrize("provider", [
+        {"name": "fake.email", "unique": True},
+        {"name": "fake.unique.email"},
+    ])
+    def test_build_and_then_import_data_unique_with_workers(self, provider):
+        connection = Mock()
+        with pytest.raises(InvalidProviderArgument):
+            build_and_then_import_data(
+                connection, "src_tbl", "id", [{"email": {"provider": provider}}], None, None, 4, 1, workers=2
+            )
+        connection.cursor.assert_not_called()
+
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    @patch("pganonymize.utils.is_table_locked", return_value=True)
+    def test_build_and_then_import_data_pipeline_of_locked_table(self, is_table_locked, quote_ident):
+        columns = [{"col1": {"provider": {"name": "md5"}}}]
+        connection_factory = Mock()
+        with pytest.raises(BadSchemaFormat):
+            build_and_then_import_data(
+                Mock(), "src_tbl", "id", columns, None, None, 4, 1, overwrite_values_in_source_tables=True,
+                pipeline=True, connection_factory=connection_factory,
+            )
+        connection_factory.assert_not_called()
+
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    @patch("pganonymize.utils.is_table_locked", return_value=True)
+    @patch("pganonymize.utils.CopyReader")
+    @patch("pganonymize.utils.CopyWriter")
+    @patch("pganonymize.utils.ApplyStage")
+    def test_build_and_then_import_data_copy_out_of_locked_table(
+        self, apply_stage, copy_writer, copy_reader, is_table_locked, quote_ident
+    ):
+        columns = [{"col1": {"provider": {"name": "set", "value": "foo"}}}]
+        connection = Mock()
+        connection.cursor.return_value.fetchmany.side_effect = [[(1, "bar")], []]
+        build_and_then_import_data(
+            connection, "src_tbl", "id", columns, None, None, 1, 10, overwrite_values_in_source_tables=True,
+            connection_factory=Mock(), copy_out=True, shards=2,
+        )
+        # The uncommitted changes of the table are only visible to the cursor of its own transaction
+        is_table_locked.assert_called_once_with(connection, "src_tbl")
+        copy_reader.assert_not_called()
+        assert call(name="fetch_large_result") in connection.cursor.call_args_list
+
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    def test_build_and_then_import_data_pipeline_without_connection_factory(self, quote_ident):
+        columns = [{"col1": {"provider": {"name": "md5"}}}]
+        with pytest.raises(BadSchemaFormat):
+            build_and_then_import_data(
+                Mock(), "src_tbl", "id", columns, None, None, 4, 1, overwrite_values_in_source_tables=True,
+                pipeline=True,
+            )
+
+    @patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+    @patch("pganonymize.utils.is_table_locked", return_value=False)
+    @patch("pganonymize.utils.export_snapshot", return_value="snapshot-id")
+    @patch("pganonymize.utils.get_column_types", return_value={"id": "int4", "col1": "text"})
+    @patch("pganonymize.utils.CopyReader")
+    @patch("pganonymize.utils.CopyWriter")
+    @patch("pganonymize.utils.ApplyStage")
+    def test_build_and_then_import_data_copy_out(
+        self, apply_stage, copy_writer, copy_reader, get_column_types, export_snapshot, is_table_locked, quote_ident
+    ):
+        columns = [{"col1": {"provider": {"name": "set", "value": "foo"}}}]
+        copy_reader.supports.return_value = True
+        copy_reader.return_value = iter([[(1, "bar")]])
+        connection_factory = Mock()
+        connection = Mock()
+
+        build_and_then_import_data(
+            connection,
+            "src_tbl",
+            "id",
+            columns,
+            None,
+            None,
+            1,
+            10,
+            overwrite_values_in_source_tables=True,
+            connection_factory=connection_factory,
+            copy_out=True,
+        )
+        copy_reader.supports.assert_called_once_with(["int4", "text"])
+        assert copy_reader.call_args[0][:2] == (connection_factory, "snapshot-id")
+        assert copy_reader.call_args[0][2:] == ('SELECT "id", "col1" FROM "src_tbl"', ["int4", "text"], 10)
+        assert call(name="fetch_large_result") not in connection.cursor.call_args_list
+        assert [list(args[0][0]) for args in copy_writer.return_value.copy.call_args_list] == [[(1, "foo")]]
+
+    @patch("pganonymize.utils.CopyWriter")
+    def test_column_format(self, copy_writer):
         columns = [
             {
                 "first_name": {
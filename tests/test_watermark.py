@@ -0,0 +1,62 @@
+import pytest
+from mock import call, patch
+from psycopg2.sql import SQL
+
+from pganonymize.watermark import create_watermark_table, get_watermark, get_watermark_window, set_watermark
+from tests.utils import get_connection, quote_ident
+
+
+@patch("psycopg2.extensions.quote_ident", side_effect=quote_ident)
+class TestWatermark:
+    def test_create_watermark_table(self, quote_ident):
+        connection, cursor = get_connection([(None,)])
+        create_watermark_table(connection)
+        assert cursor.execute.call_args == call(
+            'CREATE TABLE IF NOT EXISTS "pganonymize_watermarks" (table_name text PRIMARY KEY, watermark text NOT NULL)'
+        )
+        assert connection.commit.call_count == 1
+
+    def test_create_watermark_table_without_commit(self, quote_ident):
+        connection, cursor = get_connection([(None,)])
+        create_watermark_table(connection, commit=False)
+        assert cursor.execute.call_count == 2
+        assert connection.commit.call_count == 0
+
+    def test_create_existing_watermark_table(self, quote_ident):
+        connection, cursor = get_connection([("pganonymize_watermarks",)])
+        create_watermark_table(connection)
+        assert cursor.execute.call_count == 1
+        assert connection.commit.call_count == 0
+
+    def test_get_and_set_watermark(self, quote_ident):
+        connection, cursor = get_connection([("pganonymize_watermarks",), ("2024-01-01",)])
+        assert get_watermark(connection, "auth_user") == "2024-01-01"
+        set_watermark(connection, "auth_user", 42)
+        assert cursor.execute.call_args[0][1] == ("auth_user", "42")
+
+    def test_get_watermark_without_table(self, quote_ident):
+        connection, cursor = get_connection([(None,)])
+        assert get_watermark(connection, "auth_user") is None
+
+    @patch("pganonymize.watermark.Literal", side_effect=lambda value: SQL("'{}'".format(value)))
+    @pytest.mark.parametrize("last_watermark, search, max_value, expected", [
+        [None, None, "42", (None, "42")],
+        ["40", None, "42", ('"id" > \'40\' AND "id" <= \'42\'', "42")],
+        ["40", "active", None, (None, None)],
+    ])
+    def test_get_watermark_window(self, literal, quote_ident, last_watermark, search, max_value, expected):
+        connection, cursor = get_connection([(max_value,)])
+        assert get_watermark_window(connection, "auth_user", "id", last_watermark, search) == expected
+        sql = 'SELECT max("id")::text FROM "auth_user"'
+        assert cursor.execute.call_args == call(sql + " WHERE active" if search else sql)
+
+    @patch("pganonymize.watermark.Literal", side_effect=lambda value: SQL(str(value)))
+    @pytest.mark.parametrize("last_watermark, expected", [
+        [None, (None, "100")],
+        ["90", ("xmin::text::bigint > 90", "100")],
+        ["4294967000", (None, "100")],
+    ])
+    def test_get_watermark_window_xmin(self, literal, quote_ident, last_watermark, expected):
+        connection, cursor = get_connection([(100,)])
+        assert get_watermark_window(connection, "auth_user", "xmin", last_watermark) == expected
+        assert cursor.execute.call_args == call("SELECT txid_current() %% %s", (2 ** 32,))
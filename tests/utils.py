@@ -1,3 +1,23 @@
+from mock import Mock
+
+
+def get_connection(fetchone=None, fetchall=None, **attributes):
+    """
+    Return a mock connection and its cursor.
+
+    :param list fetchone: The results of the consecutive ``fetchone`` calls of the cursor.
+    :param list fetchall: The results of the consecutive ``fetchall`` calls of the cursor.
+    :param attributes: Attributes of the connection, e.g. its ``server_version``.
+    :rtype: tuple
+    """
+    cursor = Mock()
+    cursor.fetchone.side_effect = fetchone
+    cursor.fetchall.side_effect = fetchall
+    connection = Mock(**attributes)
+    connection.cursor.return_value = cursor
+    return connection, cursor
+
+
 # Don't use this function anywhere else that tests
 def quote_ident(a, real_db_connection):
     # quote_ident method implementation for test cases,